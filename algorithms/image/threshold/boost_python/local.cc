@@ -80,6 +80,7 @@ namespace dials { namespace algorithms { namespace boost_python {
                  double,
                  double,
                  int >())
+      .def("num_plans", &DispersionThreshold::num_plans)
       .def("__call__", &DispersionThreshold::threshold<int>)
       .def("__call__", &DispersionThreshold::threshold<double>)
       .def("__call__", &DispersionThreshold::threshold_w_gain<int>)
@@ -12,7 +12,9 @@
 #define DIALS_ALGORITHMS_IMAGE_THRESHOLD_UNIMODAL_H
 
 #include <cmath>
+#include <algorithm>
 #include <vector>
+#include <list>
 #include <iostream>
 #include <scitbx/array_family/tiny_types.h>
 #include <scitbx/array_family/ref_reductions.h>
@@ -339,15 +341,25 @@ namespace dials { namespace algorithms {
 
     /**
      * Enable more efficient memory usage by putting components required for the
-     * summed area table closer together in memory
+     * summed area table closer together in memory. The number of valid
+     * pixels only depends on the mask so is computed once in the plan.
      */
     template <typename T>
     struct Data {
-      int m;
       T   x;
       T   y;
     };
 
+    /**
+     * The parts of the threshold which only depend on the mask. For each
+     * pixel this is the number of valid pixels in the local area, set to zero
+     * where the pixel is masked or there are too few valid pixels.
+     */
+    struct Plan {
+      std::vector<char> mask;
+      std::vector<int> count;
+    };
+
     DispersionThreshold(int2 image_size,
               int2 kernel_size,
               double nsig_b,
@@ -378,10 +390,99 @@ namespace dials { namespace algorithms {
       // Allocate the buffer
       std::size_t element_size = sizeof(Data<double>);
       buffer_.resize(element_size * image_size[0] * image_size[1]);
+
+      // Keep plans for a few masks (e.g. for each panel of a detector), using
+      // up to about 256 MB
+      std::size_t plan_size = 5 * image_size[0] * image_size[1];
+      max_plans_ = std::max((std::size_t)1,
+        std::min((std::size_t)64, (std::size_t)(1 << 28) / plan_size));
+    }
+
+    /**
+     * @returns The number of plans held
+     */
+    std::size_t num_plans() const {
+      return plans_.size();
+    }
+
+    /**
+     * Get the plan for the mask, computing it if it is not one of the plans
+     * already held. The plans are kept in order of most recent use.
+     * @param mask The mask array
+     * @returns The plan
+     */
+    const Plan& get_plan(const af::const_ref< bool, af::c_grid<2> > &mask) {
+      DIALS_ASSERT(mask.accessor().all_eq(image_size_));
+      for (std::list<Plan>::iterator it = plans_.begin();
+           it != plans_.end(); ++it) {
+        if (std::equal(mask.begin(), mask.end(), it->mask.begin())) {
+          plans_.splice(plans_.begin(), plans_, it);
+          return plans_.front();
+        }
+      }
+      if (plans_.size() >= max_plans_) {
+        plans_.pop_back();
+      }
+      plans_.push_front(Plan());
+      compute_plan(plans_.front(), mask);
+      return plans_.front();
+    }
+
+    /**
+     * Compute the plan for the mask
+     * @param plan The plan
+     * @param mask The mask array
+     */
+    void compute_plan(Plan &plan,
+        const af::const_ref< bool, af::c_grid<2> > &mask) const {
+
+      // Get the size of the image
+      std::size_t ysize = image_size_[0];
+      std::size_t xsize = image_size_[1];
+
+      // The kernel size
+      int kxsize = kernel_size_[1];
+      int kysize = kernel_size_[0];
+
+      // Create the summed area table of the mask
+      std::vector<int> table(ysize * xsize);
+      for (std::size_t j = 0, k = 0; j < ysize; ++j) {
+        int m = 0;
+        for (std::size_t i = 0; i < xsize; ++i, ++k) {
+          m += mask[k] ? 1 : 0;
+          table[k] = (j == 0) ? m : table[k-xsize] + m;
+        }
+      }
+
+      // Compute the number of valid pixels in the local area
+      plan.count.resize(ysize * xsize);
+      for (std::size_t j = 0, k = 0; j < ysize; ++j) {
+        for (std::size_t i = 0 ; i < xsize; ++i, ++k) {
+          int i0 = i - kxsize - 1, i1 = i + kxsize;
+          int j0 = j - kysize - 1, j1 = j + kysize;
+          i1 = i1 < xsize ? i1 : xsize - 1;
+          j1 = j1 < ysize ? j1 : ysize - 1;
+          int k0 = j0*xsize;
+          int k1 = j1*xsize;
+          int m = 0;
+          if (i0 >= 0 && j0 >= 0) {
+            m += table[k0+i0] - (table[k1+i0] + table[k0+i1]);
+          } else if (i0 >= 0) {
+            m -= table[k1+i0];
+          } else if (j0 >= 0) {
+            m -= table[k0+i1];
+          }
+          m += table[k1+i1];
+          plan.count[k] = (mask[k] && m >= min_count_) ? m : 0;
+        }
+      }
+
+      // Save the mask
+      plan.mask.assign(mask.begin(), mask.end());
     }
 
     /**
-     * Compute the summed area tables for the mask, src and src^2.
+     * Compute the summed area tables for src and src^2.
      * @param src The input array
      * @param mask The mask array
      */
@@ -397,20 +498,16 @@ namespace dials { namespace algorithms {
 
       // Create the summed area table
       for (std::size_t j = 0, k = 0; j < ysize; ++j) {
-        int m = 0;
         T   x = 0;
         T   y = 0;
         for (std::size_t i = 0; i < xsize; ++i, ++k) {
           int mm = mask[k] ? 1 : 0;
-          m += mm;
           x += mm * src[k];
           y += mm * src[k] * src[k];
           if (j == 0) {
-            table[k].m = m;
             table[k].x = x;
             table[k].y = y;
           } else {
-            table[k].m = table[k-xsize].m + m;
             table[k].x = table[k-xsize].x + x;
             table[k].y = table[k-xsize].y + y;
           }
@@ -418,69 +515,86 @@ namespace dials { namespace algorithms {
       }
     }
 
+    /**
+     * Compute the sum of the pixel values and the sum of the squared pixel
+     * values in the local area around a pixel
+     * @param table The summed area table
+     * @param j The y coordinate
+     * @param i The x coordinate
+     * @param x The sum of the pixel values
+     * @param y The sum of the squared pixel values
+     */
+    template <typename T>
+    void local_sums(
+        const af::ref< Data<T> > &table,
+        std::size_t j,
+        std::size_t i,
+        double &x,
+        double &y) const {
+      std::size_t ysize = image_size_[0];
+      std::size_t xsize = image_size_[1];
+      int kxsize = kernel_size_[1];
+      int kysize = kernel_size_[0];
+      int i0 = i - kxsize - 1, i1 = i + kxsize;
+      int j0 = j - kysize - 1, j1 = j + kysize;
+      i1 = i1 < xsize ? i1 : xsize - 1;
+      j1 = j1 < ysize ? j1 : ysize - 1;
+      int k0 = j0*xsize;
+      int k1 = j1*xsize;
+      x = 0;
+      y = 0;
+      if (i0 >= 0 && j0 >= 0) {
+        const Data<T>& d00 = table[k0+i0];
+        const Data<T>& d10 = table[k1+i0];
+        const Data<T>& d01 = table[k0+i1];
+        x += d00.x - (d10.x + d01.x);
+        y += d00.y - (d10.y + d01.y);
+      } else if (i0 >= 0) {
+        const Data<T>& d10 = table[k1+i0];
+        x -= d10.x;
+        y -= d10.y;
+      } else if (j0 >= 0) {
+        const Data<T>& d01 = table[k0+i1];
+        x -= d01.x;
+        y -= d01.y;
+      }
+      const Data<T>& d11 = table[k1+i1];
+      x += d11.x;
+      y += d11.y;
+    }
+
     /**
      * Compute the threshold
+     * @param table The summed area table
+     * @param count The number of valid pixels in the local area
      * @param src - The input array
-     * @param mask - The mask array
      * @param dst The output array
      */
     template <typename T>
     void compute_threshold(
         af::ref< Data<T> > table,
+        const std::vector<int> &count,
         const af::const_ref< T, af::c_grid<2> > &src,
-        const af::const_ref< bool, af::c_grid<2> > &mask,
         af::ref< bool, af::c_grid<2> > dst) {
 
       // Get the size of the image
       std::size_t ysize = src.accessor()[0];
       std::size_t xsize = src.accessor()[1];
 
-      // The kernel size
-      int kxsize = kernel_size_[1];
-      int kysize = kernel_size_[0];
-
-      // Calculate the local mean at every point
+      // Only compute the local sums for pixels with enough valid neighbours
       for (std::size_t j = 0, k = 0; j < ysize; ++j) {
         for (std::size_t i = 0 ; i < xsize; ++i, ++k) {
-          int i0 = i - kxsize - 1, i1 = i + kxsize;
-          int j0 = j - kysize - 1, j1 = j + kysize;
-          i1 = i1 < xsize ? i1 : xsize - 1;
-          j1 = j1 < ysize ? j1 : ysize - 1;
-          int k0 = j0*xsize;
-          int k1 = j1*xsize;
-
-          // Compute the number of points valid in the local area,
-          // the sum of the pixel values and the sum of the squared pixel
-          // values.
-          double m = 0;
+          dst[k] = false;
+          if (count[k] == 0 || !(src[k] > threshold_)) {
+            continue;
+          }
+          double m = count[k];
           double x = 0;
           double y = 0;
-          if (i0 >= 0 && j0 >= 0) {
-            const Data<T>& d00 = table[k0+i0];
-            const Data<T>& d10 = table[k1+i0];
-            const Data<T>& d01 = table[k0+i1];
-            m += d00.m - (d10.m + d01.m);
-            x += d00.x - (d10.x + d01.x);
-            y += d00.y - (d10.y + d01.y);
-          } else if (i0 >= 0) {
-            const Data<T>& d10 = table[k1+i0];
-            m -= d10.m;
-            x -= d10.x;
-            y -= d10.y;
-          } else if (j0 >= 0) {
-            const Data<T>& d01 = table[k0+i1];
-            m -= d01.m;
-            x -= d01.x;
-            y -= d01.y;
-          }
-          const Data<T>& d11 = table[k1+i1];
-          m += d11.m;
-          x += d11.x;
-          y += d11.y;
+          local_sums(table, j, i, x, y);
 
           // Compute the thresholds
-          dst[k] = false;
-          if (mask[k] && m >= min_count_ && x >= 0 && src[k] > threshold_) {
+          if (x >= 0) {
             double a = m * y - x * x - x * (m-1);
             double b = m * src[k] - x;
             double c = x * nsig_b_ * std::sqrt(2*(m-1));
@@ -493,16 +607,17 @@ namespace dials { namespace algorithms {
 
     /**
      * Compute the threshold
+     * @param table The summed area table
+     * @param count The number of valid pixels in the local area
      * @param src - The input array
-     * @param mask - The mask array
      * @param gain - The gain array
      * @param dst The output array
      */
     template <typename T>
     void compute_threshold(
         af::ref< Data<T> > table,
+        const std::vector<int> &count,
         const af::const_ref< T, af::c_grid<2> > &src,
-        const af::const_ref< bool, af::c_grid<2> > &mask,
         const af::const_ref< double, af::c_grid<2> > &gain,
         af::ref< bool, af::c_grid<2> > dst) {
 
@@ -510,52 +625,20 @@ namespace dials { namespace algorithms {
       std::size_t ysize = src.accessor()[0];
       std::size_t xsize = src.accessor()[1];
 
-      // The kernel size
-      int kxsize = kernel_size_[1];
-      int kysize = kernel_size_[0];
-
-      // Calculate the local mean at every point
+      // Only compute the local sums for pixels with enough valid neighbours
       for (std::size_t j = 0, k = 0; j < ysize; ++j) {
         for (std::size_t i = 0 ; i < xsize; ++i, ++k) {
-          int i0 = i - kxsize - 1, i1 = i + kxsize;
-          int j0 = j - kysize - 1, j1 = j + kysize;
-          i1 = i1 < xsize ? i1 : xsize - 1;
-          j1 = j1 < ysize ? j1 : ysize - 1;
-          int k0 = j0*xsize;
-          int k1 = j1*xsize;
-
-          // Compute the number of points valid in the local area,
-          // the sum of the pixel values and the num of the squared pixel
-          // values.
-          double m = 0;
+          dst[k] = false;
+          if (count[k] == 0 || !(src[k] > threshold_)) {
+            continue;
+          }
+          double m = count[k];
           double x = 0;
           double y = 0;
-          if (i0 >= 0 && j0 >= 0) {
-            const Data<T>& d00 = table[k0+i0];
-            const Data<T>& d10 = table[k1+i0];
-            const Data<T>& d01 = table[k0+i1];
-            m += d00.m - (d10.m + d01.m);
-            x += d00.x - (d10.x + d01.x);
-            y += d00.y - (d10.y + d01.y);
-          } else if (i0 >= 0) {
-            const Data<T>& d10 = table[k1+i0];
-            m -= d10.m;
-            x -= d10.x;
-            y -= d10.y;
-          } else if (j0 >= 0) {
-            const Data<T>& d01 = table[k0+i1];
-            m -= d01.m;
-            x -= d01.x;
-            y -= d01.y;
-          }
-          const Data<T>& d11 = table[k1+i1];
-          m += d11.m;
-          x += d11.x;
-          y += d11.y;
+          local_sums(table, j, i, x, y);
 
           // Compute the thresholds
-          dst[k] = false;
-          if (mask[k] && m >= min_count_ && x >= 0 && src[k] > threshold_) {
+          if (x >= 0) {
             double a = m * y - x * x;
             double b = m * src[k] - x;
             double c = gain[k] * x * (m-1+nsig_b_ * std::sqrt(2*(m-1)));
@@ -583,6 +666,9 @@ namespace dials { namespace algorithms {
       DIALS_ASSERT(src.accessor().all_eq(mask.accessor()));
       DIALS_ASSERT(src.accessor().all_eq(dst.accessor()));
 
+      // Get the plan for the mask
+      const Plan &plan = get_plan(mask);
+
       // Get the table
       DIALS_ASSERT(sizeof(T) <= sizeof(double));
 
@@ -595,7 +681,7 @@ namespace dials { namespace algorithms {
       compute_sat(table, src, mask);
 
       // Compute the image threshold
-      compute_threshold(table, src, mask, dst);
+      compute_threshold(table, plan.count, src, dst);
     }
 
     /**
@@ -618,6 +704,9 @@ namespace dials { namespace algorithms {
       DIALS_ASSERT(src.accessor().all_eq(gain.accessor()));
       DIALS_ASSERT(src.accessor().all_eq(dst.accessor()));
 
+      // Get the plan for the mask
+      const Plan &plan = get_plan(mask);
+
       // Get the table
       DIALS_ASSERT(sizeof(T) <= sizeof(double));
 
@@ -628,7 +717,7 @@ namespace dials { namespace algorithms {
       compute_sat(table, src, mask);
 
       // Compute the image threshold
-      compute_threshold(table, src, mask, gain, dst);
+      compute_threshold(table, plan.count, src, gain, dst);
     }
 
   private:
@@ -640,6 +729,8 @@ namespace dials { namespace algorithms {
     double threshold_;
     int min_count_;
     std::vector<char> buffer_;
+    std::list<Plan> plans_;
+    std::size_t max_plans_;
   };
 
 
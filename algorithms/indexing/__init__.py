@@ -27,27 +27,53 @@ def index_reflections(
   UB_matrices = flex.mat3_double([cm.get_A() for cm in experiments.crystals()])
   imgset_ids = reflections['imageset_id'].select(sel)
 
-  for i_imgset, imgset in enumerate(experiments.imagesets()):
-    sel_imgset = (imgset_ids == i_imgset)
+  # look up the experiment for each crystal and imageset once, rather than
+  # searching the experiment list for every imageset
+  crystals = experiments.crystals()
+  imagesets = experiments.imagesets()
+  crystal_index = dict((id(c), i) for i, c in enumerate(crystals))
+  imageset_index = dict((id(im), i) for i, im in enumerate(imagesets))
+  expt_lookup = {}
+  for i_expt, expt in enumerate(experiments):
+    expt_lookup[(imageset_index[id(expt.imageset)],
+                 crystal_index[id(expt.crystal)])] = i_expt
+
+  # group the reflections by imageset with a single sort, so that the cost
+  # does not grow with the number of imagesets times the number of
+  # reflections
+  perm = flex.sort_permutation(imgset_ids, stable=True)
+  sorted_imgset_ids = imgset_ids.select(perm)
+  boundaries = [0]
+  if len(perm) > 1:
+    boundaries.extend(
+      (sorted_imgset_ids[1:] != sorted_imgset_ids[:-1]).iselection() + 1)
+  boundaries.append(len(perm))
+  n_rejects = 0
+  for i_start, i_end in zip(boundaries[:-1], boundaries[1:]):
+    if i_start == i_end:
+      continue
+    i_imgset = sorted_imgset_ids[i_start]
+    if i_imgset < 0 or i_imgset >= len(imagesets):
+      continue
+    sel_imgset = perm[i_start:i_end]
 
     result = AssignIndices(
       rlps.select(sel_imgset), phi.select(sel_imgset), UB_matrices, tolerance=tolerance)
 
     miller_indices = result.miller_indices()
     crystal_ids = result.crystal_ids()
-    n_rejects = result.n_rejects()
+    n_rejects += result.n_rejects()
 
     expt_ids = flex.int(crystal_ids.size(), -1)
-    for i_cryst, cryst in enumerate(experiments.crystals()):
-      sel_cryst = (crystal_ids == i_cryst)
-      for i_expt in experiments.where(
-        crystal=cryst, imageset=imgset):
-        expt_ids.set_selected(sel_cryst, i_expt)
+    for i_cryst in range(len(crystals)):
+      i_expt = expt_lookup.get((i_imgset, i_cryst))
+      if i_expt is not None:
+        expt_ids.set_selected(crystal_ids == i_cryst, i_expt)
 
     reflections['miller_index'].set_selected(isel.select(sel_imgset), miller_indices)
     reflections['id'].set_selected(isel.select(sel_imgset), expt_ids)
-    reflections.set_flags(
-      reflections['miller_index'] != (0,0,0), reflections.flags.indexed)
+  reflections.set_flags(
+    reflections['miller_index'] != (0,0,0), reflections.flags.indexed)
 
   if verbosity > 0:
     for i_expt, expt in enumerate(experiments):
@@ -59,9 +85,46 @@ def index_reflections(
     info("%i unindexed reflections" %n_rejects)
 
 
+class NearestNeighbourCache(object):
+  '''
+  Keep the nearest neighbours of the reciprocal lattice points between calls
+  to index_reflections_local. The neighbours depend only on the points and
+  not on the crystal models, so the k-d tree is only rebuilt when the points
+  change, e.g. when a new resolution limit or refined experimental geometry
+  changes them, rather than for every candidate model and macrocycle.
+
+  '''
+
+  def __init__(self):
+    self._rlps = None
+    self._nearest_neighbours = None
+    self._indices = None
+
+  def __call__(self, reciprocal_lattice_points, nearest_neighbours):
+    '''
+    Get the nearest neighbour indices for the reciprocal lattice points.
+
+    :param reciprocal_lattice_points: The reciprocal lattice points
+    :param nearest_neighbours: The number of neighbours for each point
+    :return: The neighbour indices, nearest_neighbours per point
+
+    '''
+    if (self._indices is None or
+        nearest_neighbours != self._nearest_neighbours or
+        len(reciprocal_lattice_points) != len(self._rlps) or
+        not reciprocal_lattice_points.as_double().all_eq(
+          self._rlps.as_double())):
+      self._rlps = reciprocal_lattice_points.deep_copy()
+      self._nearest_neighbours = nearest_neighbours
+      self._indices = nearest_neighbour_indices(
+        reciprocal_lattice_points, nearest_neighbours)
+    return self._indices
+
+
 def index_reflections_local(
     reflections, experiments, d_min=None,
-    epsilon=0.05, delta=8, l_min=0.8, nearest_neighbours=20, verbosity=0):
+    epsilon=0.05, delta=8, l_min=0.8, nearest_neighbours=20, verbosity=0,
+    neighbour_cache=None):
   from scitbx import matrix
   from libtbx.math_utils import nearest_integer as nint
   reciprocal_lattice_points = reflections['rlp']
@@ -84,9 +147,15 @@ def index_reflections_local(
 
   UB_matrices = flex.mat3_double([cm.get_A() for cm in experiments.crystals()])
 
-  result = AssignIndicesLocal(
-    rlps, phi, UB_matrices, epsilon=epsilon, delta=delta, l_min=l_min,
-    nearest_neighbours=nearest_neighbours)
+  if neighbour_cache is not None:
+    result = AssignIndicesLocal(
+      rlps, phi, UB_matrices,
+      nearest_neighbour_indices=neighbour_cache(rlps, nearest_neighbours),
+      epsilon=epsilon, delta=delta, l_min=l_min)
+  else:
+    result = AssignIndicesLocal(
+      rlps, phi, UB_matrices, epsilon=epsilon, delta=delta, l_min=l_min,
+      nearest_neighbours=nearest_neighbours)
   miller_indices = result.miller_indices()
   crystal_ids = result.crystal_ids()
   n_rejects = result.n_rejects()
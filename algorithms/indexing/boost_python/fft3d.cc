@@ -22,6 +22,9 @@ namespace dials { namespace algorithms { namespace boost_python {
        arg("s0"), arg("m2"),
        arg("rl_grid_spacing"), arg("d_min"), arg("b_iso")));
 
+    def("fft3d_real_part_squared", &fft3d_real_part_squared,
+      (arg("grid")));
+
     def("clean_3d", &clean_3d,
       (arg("dirty_beam"), arg("dirty_map"), arg("n_peaks"), arg("gamma")=1));
 
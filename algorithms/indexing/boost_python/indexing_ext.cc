@@ -53,6 +53,18 @@ namespace dials { namespace algorithms { namespace boost_python {
         arg("delta") = 8,
         arg("l_min") = 0.8,
         arg("nearest_neighbours") = 20)))
+      .def(init<af::const_ref<scitbx::vec3<double> > const &,
+                af::const_ref<double> const &,
+                af::const_ref<scitbx::mat3<double> > const &,
+                af::const_ref<std::size_t> const &,
+                const double, const double, const double>((
+        arg("reciprocal_space_points"),
+        arg("phi"),
+        arg("UB_matrices"),
+        arg("nearest_neighbour_indices"),
+        arg("epsilon") = 0.05,
+        arg("delta") = 8,
+        arg("l_min") = 0.8)))
       .def("miller_indices", &w_t::miller_indices)
       .def("crystal_ids", &w_t::crystal_ids)
       .def("n_rejects", &w_t::n_rejects);
@@ -60,6 +72,9 @@ namespace dials { namespace algorithms { namespace boost_python {
 
   BOOST_PYTHON_MODULE(dials_algorithms_indexing_ext)
   {
+    def("nearest_neighbour_indices", &nearest_neighbour_indices, (
+      arg("reciprocal_space_points"),
+      arg("nearest_neighbours")));
     export_fft3d();
     export_assign_indices();
     export_assign_indices_local();
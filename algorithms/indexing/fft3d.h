@@ -18,6 +18,11 @@
 #include <scitbx/math/utils.h>
 
 #include <cstdlib>
+#include <complex>
+#include <vector>
+#include <algorithm>
+#include <scitbx/fftpack/real_to_complex.h>
+#include <scitbx/fftpack/complex_to_complex.h>
 #include <scitbx/array_family/versa_matrix.h>
 #include <dials/array_family/scitbx_shared_and_versa.h>
 #include <dials/algorithms/spot_prediction/rotation_angles.h>
@@ -173,6 +178,101 @@ namespace dials { namespace algorithms {
   }
 
 
+  /**
+   * Compute the square of the real part of the forward FFT of a real grid,
+   * overwriting the grid. The FFT of real data is Hermitian, so only half of
+   * the transform is computed and stored, and the other half of the output
+   * is filled in from F(-h) = conj(F(h)). The 1D transforms along each axis
+   * are spread over the OpenMP threads.
+   * @param grid The real grid to transform in place
+   */
+  void fft3d_real_part_squared(af::ref<double, af::c_grid<3> > const & grid) {
+    typedef std::complex<double> complex_t;
+    typedef af::c_grid<3>::index_type index_t;
+    index_t const n = index_t(grid.accessor());
+    const int n0 = int(n[0]);
+    const int n1 = int(n[1]);
+    const int n2 = int(n[2]);
+    const int h = n2 / 2 + 1;
+    DIALS_ASSERT(n0 > 0 && n1 > 0 && n2 > 0);
+
+    scitbx::fftpack::real_to_complex<double> fft2(n2);
+    scitbx::fftpack::complex_to_complex<double> fft1(n1);
+    scitbx::fftpack::complex_to_complex<double> fft0(n0);
+    std::vector<complex_t> half((std::size_t)n0 * n1 * h);
+
+    // Real to complex transform along the fastest axis
+    #pragma omp parallel
+    {
+      std::vector<double> seq(2 * h);
+      std::vector<double> scratch(2 * n2);
+      #pragma omp for
+      for (int ij = 0; ij < n0 * n1; ++ij) {
+        const double *line = &grid[(std::size_t)ij * n2];
+        std::copy(line, line + n2, seq.begin());
+        fft2.forward(&seq[0], &scratch[0]);
+        complex_t *out = &half[(std::size_t)ij * h];
+        for (int k = 0; k < h; ++k) {
+          out[k] = complex_t(seq[2*k], seq[2*k+1]);
+        }
+      }
+    }
+
+    // Complex to complex transform along the middle axis
+    #pragma omp parallel
+    {
+      std::vector<complex_t> seq(n1);
+      std::vector<double> scratch(2 * n1);
+      #pragma omp for
+      for (int ik = 0; ik < n0 * h; ++ik) {
+        const int i = ik / h;
+        const int k = ik % h;
+        complex_t *base = &half[(std::size_t)i * n1 * h + k];
+        for (int j = 0; j < n1; ++j) {
+          seq[j] = base[(std::size_t)j * h];
+        }
+        fft1.forward(reinterpret_cast<double*>(&seq[0]), &scratch[0]);
+        for (int j = 0; j < n1; ++j) {
+          base[(std::size_t)j * h] = seq[j];
+        }
+      }
+    }
+
+    // Complex to complex transform along the slowest axis
+    #pragma omp parallel
+    {
+      std::vector<complex_t> seq(n0);
+      std::vector<double> scratch(2 * n0);
+      #pragma omp for
+      for (int jk = 0; jk < n1 * h; ++jk) {
+        complex_t *base = &half[jk];
+        for (int i = 0; i < n0; ++i) {
+          seq[i] = base[(std::size_t)i * n1 * h];
+        }
+        fft0.forward(reinterpret_cast<double*>(&seq[0]), &scratch[0]);
+        for (int i = 0; i < n0; ++i) {
+          base[(std::size_t)i * n1 * h] = seq[i];
+        }
+      }
+    }
+
+    // Expand the half transform and square the real part
+    #pragma omp parallel for
+    for (int i = 0; i < n0; ++i) {
+      const int i_conj = (n0 - i) % n0;
+      for (int j = 0; j < n1; ++j) {
+        const int j_conj = (n1 - j) % n1;
+        const complex_t *row = &half[((std::size_t)i * n1 + j) * h];
+        const complex_t *row_conj = &half[((std::size_t)i_conj * n1 + j_conj) * h];
+        double *out = &grid[((std::size_t)i * n1 + j) * n2];
+        for (int k = 0; k < n2; ++k) {
+          double v = k < h ? row[k].real() : row_conj[n2 - k].real();
+          out[k] = v * v;
+        }
+      }
+    }
+  }
+
   void map_centroids_to_reciprocal_space_grid(
     af::ref<double, af::c_grid<3> > const & grid,
     af::const_ref<vec3<double> > const & reciprocal_space_vectors,
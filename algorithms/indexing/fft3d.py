@@ -140,23 +140,27 @@ class indexer_fft3d(indexer_base):
     #(512**3)*8*2*bytes_to_gb
     #2.0
 
-    fft = fftpack.complex_to_complex_3d(self.gridding)
-    grid_complex = flex.complex_double(
-      reals=self.reciprocal_space_grid,
-      imags=flex.double(self.reciprocal_space_grid.size(), 0))
-    grid_transformed = fft.forward(grid_complex)
-    #self.grid_real = flex.pow2(flex.abs(grid_transformed))
-    self.grid_real = flex.pow2(flex.real(grid_transformed))
-    #self.grid_real = flex.pow2(flex.imag(self.grid_transformed))
-    del grid_transformed
+    # real-to-complex transform of the grid, overwriting the grid with the
+    # square of the real part of the transform, so only the grid and half of
+    # the transform are held in memory
+    import omptbx
+    from dials.algorithms.indexing import fft3d_real_part_squared
+    omptbx.omp_set_num_threads(
+      min(omptbx.omp_get_num_procs(), self.params.nproc))
+    self.grid_real = self.reciprocal_space_grid
+    del self.reciprocal_space_grid
+    fft3d_real_part_squared(self.grid_real)
 
   def find_peaks(self):
-    grid_real_binary = self.grid_real.deep_copy()
-    rmsd = math.sqrt(
-      flex.mean(flex.pow2(grid_real_binary.as_1d()-flex.mean(grid_real_binary.as_1d()))))
-    grid_real_binary.set_selected(grid_real_binary < (self.params.rmsd_cutoff)*rmsd, 0)
-    grid_real_binary.as_1d().set_selected(grid_real_binary.as_1d() > 0, 1)
-    grid_real_binary = grid_real_binary.iround()
+    # threshold the map directly into the binary map, without copying the map
+    grid_real = self.grid_real.as_1d()
+    n = grid_real.size()
+    mv = flex.mean_and_variance(grid_real)
+    rmsd = math.sqrt(mv.unweighted_sample_variance() * (n - 1) / n)
+    grid_real_binary = flex.int(self.grid_real.accessor(), 0)
+    grid_real_binary.as_1d().set_selected(
+      (grid_real >= (self.params.rmsd_cutoff)*rmsd) & (grid_real > 0), 1)
+    del grid_real
     from cctbx import masks
     flood_fill = masks.flood_fill(grid_real_binary, self.fft_cell)
     if flood_fill.n_voids() < 4:
@@ -602,12 +606,12 @@ class indexer_fft3d(indexer_base):
                         self.imagesets[0].get_goniometer().get_rotation_axis(),
                         rlgrid, d_min, self.params.b_iso)
 
-    fft = fftpack.complex_to_complex_3d(self.gridding)
-    grid_complex = flex.complex_double(
-      reals=grid,
-      imags=flex.double(grid.size(), 0))
-    grid_transformed = fft.forward(grid_complex)
-    grid_real = flex.pow2(flex.real(grid_transformed))
+    from dials.algorithms.indexing import fft3d_real_part_squared
+    if self.params.debug:
+      self.debug_write_ccp4_map(grid, "sampling_volume.map")
+    grid_real = grid
+    del grid
+    fft3d_real_part_squared(grid_real)
 
     gamma = 1
     peaks = flex.vec3_double()
@@ -635,7 +639,6 @@ class indexer_fft3d(indexer_base):
       #print p, peaks_frac[-1]
 
     if self.params.debug:
-      self.debug_write_ccp4_map(grid, "sampling_volume.map")
       self.debug_write_ccp4_map(grid_real, "sampling_volume_FFT.map")
       self.debug_write_ccp4_map(dirty_map, "clean.map")
 
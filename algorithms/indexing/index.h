@@ -158,6 +158,42 @@ namespace dials { namespace algorithms {
   };
 
 
+  /**
+   * Find the nearest neighbours of each reciprocal lattice point.
+   * @param reciprocal_space_points The reciprocal lattice points
+   * @param nearest_neighbours The number of neighbours for each point
+   * @returns The indices of the neighbours, nearest_neighbours per point
+   */
+  inline
+  af::shared<std::size_t> nearest_neighbour_indices(
+      af::const_ref<scitbx::vec3<double> > const & reciprocal_space_points,
+      const int nearest_neighbours) {
+    using annlib_adaptbx::AnnAdaptor;
+    DIALS_ASSERT(nearest_neighbours > 0);
+
+    // convert into a single array for input to AnnAdaptor
+    // based on flex.vec_3.as_double()
+    // scitbx/array_family/boost_python/flex_vec3_double.cpp
+    af::shared<double> rlps_double(
+      reciprocal_space_points.size()*3, af::init_functor_null<double>());
+    double* r = rlps_double.begin();
+    for(std::size_t i=0;i<reciprocal_space_points.size();i++) {
+      for(std::size_t j=0;j<3;j++) {
+        *r++ = reciprocal_space_points[i][j];
+      }
+    }
+
+    AnnAdaptor ann = AnnAdaptor(rlps_double, 3, nearest_neighbours);
+    ann.query(rlps_double);
+
+    std::size_t n = reciprocal_space_points.size() * nearest_neighbours;
+    af::shared<std::size_t> result(n);
+    for (std::size_t i = 0; i < n; ++i) {
+      result[i] = ann.nn[i];
+    }
+    return result;
+  }
+
   template <typename Edge>
   struct record_dfs_order : public boost::default_dfs_visitor
   {
@@ -188,10 +224,66 @@ namespace dials { namespace algorithms {
         /*subtree_ids_(reciprocal_space_points.size(), 0),*/
         crystal_ids_(reciprocal_space_points.size(), -1),
         n_rejects_(0) {
+      af::shared<std::size_t> nn = nearest_neighbour_indices(
+        reciprocal_space_points, nearest_neighbours);
+      compute(reciprocal_space_points, phi, UB_matrices,
+              nn.const_ref(), nearest_neighbours, epsilon, delta, l_min);
+    }
+
+    /**
+     * Assign indices using precomputed nearest neighbours, e.g. kept from a
+     * previous call with the same reciprocal lattice points.
+     */
+    AssignIndicesLocal(
+      af::const_ref<scitbx::vec3<double> > const & reciprocal_space_points,
+      af::const_ref<double> const & phi,
+      af::const_ref<scitbx::mat3<double> > const & UB_matrices,
+      af::const_ref<std::size_t> const & nearest_neighbour_indices,
+      const double epsilon=0.05,
+      const double delta=5,
+      const double l_min=0.8
+      )
+      : miller_indices_(
+          reciprocal_space_points.size(), cctbx::miller::index<>(0,0,0)),
+        crystal_ids_(reciprocal_space_points.size(), -1),
+        n_rejects_(0) {
+      DIALS_ASSERT(reciprocal_space_points.size() > 0);
+      DIALS_ASSERT(nearest_neighbour_indices.size() %
+                   reciprocal_space_points.size() == 0);
+      const std::size_t nearest_neighbours =
+        nearest_neighbour_indices.size() / reciprocal_space_points.size();
+      compute(reciprocal_space_points, phi, UB_matrices,
+              nearest_neighbour_indices, nearest_neighbours,
+              epsilon, delta, l_min);
+    }
+
+    af::shared<cctbx::miller::index<> > miller_indices() {
+      return miller_indices_;
+    }
+
+    af::shared<int> crystal_ids() {
+      return crystal_ids_;
+    }
+
+    std::size_t n_rejects() {
+      return n_rejects_;
+    }
+
+  private:
+
+    void compute(
+      af::const_ref<scitbx::vec3<double> > const & reciprocal_space_points,
+      af::const_ref<double> const & phi,
+      af::const_ref<scitbx::mat3<double> > const & UB_matrices,
+      af::const_ref<std::size_t> const & nn,
+      const std::size_t nearest_neighbours,
+      const double epsilon,
+      const double delta,
+      const double l_min) {
 
       DIALS_ASSERT(reciprocal_space_points.size() == phi.size());
+      DIALS_ASSERT(nn.size() == reciprocal_space_points.size() * nearest_neighbours);
 
-      using annlib_adaptbx::AnnAdaptor;
       using namespace boost;
       typedef property<edge_weight_t, double> EdgeWeightProperty;
       typedef adjacency_list<vecS, vecS, undirectedS, no_property,
@@ -203,21 +295,6 @@ namespace dials { namespace algorithms {
       typedef boost::property_map< Graph, boost::vertex_index_t>::type VertexIndexMap;
       typedef boost::property_map< Graph, boost::edge_weight_t>::type WeightMap;
 
-      // convert into a single array for input to AnnAdaptor
-      // based on flex.vec_3.as_double()
-      // scitbx/array_family/boost_python/flex_vec3_double.cpp
-      af::shared<double> rlps_double(
-        reciprocal_space_points.size()*3, af::init_functor_null<double>());
-      double* r = rlps_double.begin();
-      for(std::size_t i=0;i<reciprocal_space_points.size();i++) {
-        for(std::size_t j=0;j<3;j++) {
-          *r++ = reciprocal_space_points[i][j];
-        }
-      }
-
-      AnnAdaptor ann = AnnAdaptor(rlps_double, 3, nearest_neighbours);
-      ann.query(rlps_double);
-
       typedef std::pair<const int, const int> pair_t;
 
       double sum_l_ij = 0;
@@ -237,7 +314,7 @@ namespace dials { namespace algorithms {
           std::size_t i_k = i * nearest_neighbours;
           for (std::size_t i_ann=0; i_ann < nearest_neighbours; i_ann++) {
             std::size_t i_k_plus_i_ann = i_k + i_ann;
-            std::size_t j = ann.nn[i_k_plus_i_ann];
+            std::size_t j = nn[i_k_plus_i_ann];
             if (boost::edge(i, j, G).second) {
               continue;
             }
@@ -365,19 +442,6 @@ namespace dials { namespace algorithms {
 
     }
 
-    af::shared<cctbx::miller::index<> > miller_indices() {
-      return miller_indices_;
-    }
-
-    af::shared<int> crystal_ids() {
-      return crystal_ids_;
-    }
-
-    std::size_t n_rejects() {
-      return n_rejects_;
-    }
-
-  private:
     af::shared<cctbx::miller::index<> > miller_indices_;
     af::shared<std::size_t> subtree_ids_;
     af::shared<int> crystal_ids_;
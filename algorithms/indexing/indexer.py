@@ -281,6 +281,18 @@ indexing {
   {
     characteristic_grid = 0.02
       .type = float(value_min=0)
+    coarse_to_fine {
+      enable = False
+        .type = bool
+        .help = "Search a coarse grid of directions first, then search the"
+                "fine grid only around the best coarse directions."
+      coarse_grid = 0.1
+        .type = float(value_min=0)
+        .help = "The characteristic grid spacing of the coarse search."
+      n_candidates = 100
+        .type = int(value_min=1)
+        .help = "The number of coarse search vectors to refine on the fine grid."
+    }
   }
 }
 """
@@ -336,6 +348,56 @@ class vector_group(object):
     return matrix.col((sum_x, sum_y, sum_z))/len(self.vectors)
 
 
+def screen_basis_vector_combinations(vectors, combinations, min_angle):
+  '''
+  Screen combinations of basis vectors in a single vectorised pass, rejecting
+  those where the first two vectors are nearly parallel or where the third
+  vector is nearly coplanar with the first two.
+
+  :param vectors: The list of candidate basis vectors
+  :param combinations: The flex.vec3_int of (i, j, k) vector indices
+  :param min_angle: The minimum angle (in radians)
+  :return: A flex.bool selection of the combinations to keep
+
+  '''
+  if len(combinations) == 0:
+    return flex.bool()
+  vectors = flex.vec3_double([v.elems for v in vectors])
+  i, j, k = combinations.as_vec3_double().parts()
+  a = vectors.select(flex.size_t([int(x) for x in i]))
+  b = vectors.select(flex.size_t([int(x) for x in j]))
+  c = vectors.select(flex.size_t([int(x) for x in k]))
+
+  # angle(a, b) < min_angle or pi - angle(a, b) < min_angle
+  cos_ab = a.dot(b) / (a.norms() * b.norms())
+  sel = flex.abs(cos_ab) <= math.cos(min_angle)
+
+  # abs(pi/2 - angle(a x b, c)) < min_angle, which does not depend on the
+  # signs of the vectors
+  a_cross_b = a.cross(b)
+  cos_abc = a_cross_b.dot(c) / (a_cross_b.norms() * c.norms())
+  sel &= flex.abs(cos_abc) >= math.sin(min_angle)
+  return sel
+
+# the indexer, basis vectors and symmetry cache used by the worker processes
+# in find_candidate_orientation_matrices, inherited when the workers fork
+_pool_candidate_search = None
+
+def _pool_candidate_crystal_model(combination):
+  '''
+  Build the crystal model for a combination of basis vectors in a worker
+  process. Each worker has its own copy of the symmetry cache, which is kept
+  for all the combinations that worker is given.
+
+  :param combination: The (i, j, k) basis vector indices
+  :return: The crystal model or None if the combination is rejected
+
+  '''
+  indexer, vectors, symmetry_cache = _pool_candidate_search
+  i, j, k = combination
+  return indexer._basis_vectors_to_crystal_model(
+    vectors[i], vectors[j], vectors[k], symmetry_cache)
+
 def is_approximate_integer_multiple(vec_a, vec_b,
                                     relative_tolerance=0.2,
                                     angular_tolerance=5.0):
@@ -367,6 +429,8 @@ class indexer_base(object):
     self.params = params.indexing
     self.all_params = params
     self.refined_experiments = None
+    from dials.algorithms.indexing import NearestNeighbourCache
+    self._neighbour_cache = NearestNeighbourCache()
 
     for imageset in imagesets[1:]:
       if imageset.get_detector().is_similar_to(self.imagesets[0].get_detector()):
@@ -972,93 +1036,160 @@ class indexer_base(object):
     sel &= k > j
     combinations = combinations.select(sel)
 
-    half_pi = 0.5 * math.pi
+    # reject the combinations with nearly parallel or coplanar vectors
+    # before building any crystal models
     min_angle = 20/180 * math.pi # 20 degrees, arbitrary cutoff
-    for i, j, k in combinations:
-      a = vectors[i]
-      b = vectors[j]
-      angle = a.angle(b)
-      if angle < min_angle or (math.pi-angle) < min_angle:
-        continue
-      a_cross_b = a.cross(b)
-      gamma = a.angle(b)
-      if gamma < half_pi:
-        # all angles obtuse if possible please
-        b = -b
-        gamma = math.pi - gamma
-        a_cross_b = -a_cross_b
-      c = vectors[k]
-      if abs(half_pi-a_cross_b.angle(c)) < min_angle:
-        continue
-      alpha = b.angle(c, deg=True)
-      if alpha < half_pi:
-        c = -c
-      #beta = c.angle(a, deg=True)
-      if a_cross_b.dot(c) < 0:
-        # we want right-handed basis set, therefore invert all vectors
-        a = -a
-        b = -b
-        c = -c
-        #assert a.cross(b).dot(c) > 0
-      model = Crystal(a, b, c, space_group_symbol="P 1")
-      uc = model.get_unit_cell()
-      model_orig = model
-      best_model = None
-      min_bmsd = 1e8
-      cb_op_to_niggli = uc.change_of_basis_op_to_niggli_cell()
-      model = model.change_basis(cb_op_to_niggli)
-      #print model.get_unit_cell()
-      uc = model.get_unit_cell()
-      if self.target_symmetry_primitive is not None:
-        max_delta = self.params.known_symmetry.max_delta
-        from dials.algorithms.indexing.symmetry import find_matching_symmetry
-        best_subgroup = find_matching_symmetry(
-          uc, self.target_symmetry_primitive.space_group(),
-          max_delta=max_delta)
-        cb_op_extra = None
-        if best_subgroup is None:
-          if self.target_symmetry_reference_setting is not None:
-            # if we have been told we have a centred unit cell check that
-            # indexing hasn't found the centred unit cell instead of the
-            # primitive cell
-            best_subgroup = find_matching_symmetry(
-              uc, self.target_symmetry_reference_setting.space_group().build_derived_point_group(),
-              max_delta=max_delta)
-            cb_op_extra = self.cb_op_reference_to_primitive
-            if best_subgroup is None:
-              continue
-          else:
+    combinations = combinations.select(
+      screen_basis_vector_combinations(vectors, combinations, min_angle))
+
+    # symmetry matches memoised by reduced cell
+    symmetry_cache = {}
+    def candidate_crystal_model(combination):
+      i, j, k = combination
+      return self._basis_vectors_to_crystal_model(
+        vectors[i], vectors[j], vectors[k], symmetry_cache)
+
+    # test the combinations in order until enough candidate models are found,
+    # using a single pool of processes when nproc > 1. The results come back
+    # in order, and the pool is terminated as soon as there are enough.
+    nproc = min(self.params.nproc, len(combinations))
+    if nproc > 1:
+      import multiprocessing
+      global _pool_candidate_search
+      _pool_candidate_search = (self, vectors, symmetry_cache)
+      pool = multiprocessing.Pool(processes=nproc)
+      try:
+        models = pool.imap(
+          _pool_candidate_crystal_model, list(combinations), chunksize=4)
+        for model in models:
+          if model is None:
             continue
-        cb_op_inp_best = best_subgroup['cb_op_inp_best']
-        best_subsym = best_subgroup['best_subsym']
-        cb_op_best_ref = best_subsym.change_of_basis_op_to_reference_setting()
-        ref_subsym = best_subsym.change_basis(cb_op_best_ref)
-        cb_op_ref_primitive = ref_subsym.change_of_basis_op_to_primitive_setting()
-        cb_op_to_primitive = cb_op_ref_primitive * cb_op_best_ref * cb_op_inp_best
-        if cb_op_extra is not None:
-          cb_op_to_primitive = cb_op_extra * cb_op_to_primitive
-        best_model = model.change_basis(cb_op_to_primitive)
-        if (self.target_symmetry_primitive.unit_cell () is not None
-            and not best_model.get_unit_cell().is_similar_to(
-          self.target_symmetry_primitive.unit_cell(),
-          relative_length_tolerance=self.params.known_symmetry.relative_length_tolerance,
-            absolute_angle_tolerance=self.params.known_symmetry.absolute_angle_tolerance)):
+          candidate_crystal_models.append(model)
+          if len(candidate_crystal_models) == max_combinations:
+            break
+      finally:
+        pool.terminate()
+        pool.join()
+        _pool_candidate_search = None
+    else:
+      for combination in combinations:
+        model = candidate_crystal_model(combination)
+        if model is None:
           continue
-      else:
-        best_model = model
-
-      if best_model is None:
-        continue
-
-      uc = best_model.get_unit_cell()
-      params = uc.parameters()
-      if uc.volume() > (params[0]*params[1]*params[2]/100):
-        # unit cell volume cutoff from labelit 2004 paper
-        candidate_crystal_models.append(best_model)
+        candidate_crystal_models.append(model)
         if len(candidate_crystal_models) == max_combinations:
-          return candidate_crystal_models
+          break
     return candidate_crystal_models
 
+  def _basis_vectors_to_crystal_model(self, a, b, c, symmetry_cache=None):
+    '''
+    Build the crystal model for a combination of basis vectors.
+
+    :param a: The first basis vector
+    :param b: The second basis vector
+    :param c: The third basis vector
+    :param symmetry_cache: A dictionary of symmetry matches by reduced cell
+    :return: The crystal model or None if the combination is rejected
+
+    '''
+    half_pi = 0.5 * math.pi
+    min_angle = 20/180 * math.pi # 20 degrees, arbitrary cutoff
+    angle = a.angle(b)
+    if angle < min_angle or (math.pi-angle) < min_angle:
+      return None
+    a_cross_b = a.cross(b)
+    gamma = a.angle(b)
+    if gamma < half_pi:
+      # all angles obtuse if possible please
+      b = -b
+      gamma = math.pi - gamma
+      a_cross_b = -a_cross_b
+    if abs(half_pi-a_cross_b.angle(c)) < min_angle:
+      return None
+    alpha = b.angle(c, deg=True)
+    if alpha < half_pi:
+      c = -c
+    #beta = c.angle(a, deg=True)
+    if a_cross_b.dot(c) < 0:
+      # we want right-handed basis set, therefore invert all vectors
+      a = -a
+      b = -b
+      c = -c
+      #assert a.cross(b).dot(c) > 0
+    model = Crystal(a, b, c, space_group_symbol="P 1")
+    uc = model.get_unit_cell()
+    cb_op_to_niggli = uc.change_of_basis_op_to_niggli_cell()
+    model = model.change_basis(cb_op_to_niggli)
+    #print model.get_unit_cell()
+    uc = model.get_unit_cell()
+    if self.target_symmetry_primitive is not None:
+      cb_op_to_primitive = self._find_cb_op_to_target_symmetry(
+        uc, symmetry_cache)
+      if cb_op_to_primitive is None:
+        return None
+      best_model = model.change_basis(cb_op_to_primitive)
+      if (self.target_symmetry_primitive.unit_cell () is not None
+          and not best_model.get_unit_cell().is_similar_to(
+        self.target_symmetry_primitive.unit_cell(),
+        relative_length_tolerance=self.params.known_symmetry.relative_length_tolerance,
+          absolute_angle_tolerance=self.params.known_symmetry.absolute_angle_tolerance)):
+        return None
+    else:
+      best_model = model
+
+    uc = best_model.get_unit_cell()
+    params = uc.parameters()
+    if uc.volume() > (params[0]*params[1]*params[2]/100):
+      # unit cell volume cutoff from labelit 2004 paper
+      return best_model
+    return None
+
+  def _find_cb_op_to_target_symmetry(self, unit_cell, symmetry_cache=None):
+    '''
+    Find the change of basis operator from a reduced cell to the primitive
+    setting of the target symmetry. Niggli reduction maps combinations of
+    basis vectors describing the same lattice to the same cell, so the
+    result is memoised by the rounded cell parameters.
+
+    :param unit_cell: The Niggli reduced unit cell
+    :param symmetry_cache: A dictionary of previous results
+    :return: The change of basis operator or None if there is no match
+
+    '''
+    key = tuple([round(p, 2) for p in unit_cell.parameters()])
+    if symmetry_cache is not None and key in symmetry_cache:
+      return symmetry_cache[key]
+
+    max_delta = self.params.known_symmetry.max_delta
+    from dials.algorithms.indexing.symmetry import find_matching_symmetry
+    best_subgroup = find_matching_symmetry(
+      unit_cell, self.target_symmetry_primitive.space_group(),
+      max_delta=max_delta)
+    cb_op_extra = None
+    cb_op_to_primitive = None
+    if best_subgroup is None:
+      if self.target_symmetry_reference_setting is not None:
+        # if we have been told we have a centred unit cell check that
+        # indexing hasn't found the centred unit cell instead of the
+        # primitive cell
+        best_subgroup = find_matching_symmetry(
+          unit_cell, self.target_symmetry_reference_setting.space_group().build_derived_point_group(),
+          max_delta=max_delta)
+        cb_op_extra = self.cb_op_reference_to_primitive
+    if best_subgroup is not None:
+      cb_op_inp_best = best_subgroup['cb_op_inp_best']
+      best_subsym = best_subgroup['best_subsym']
+      cb_op_best_ref = best_subsym.change_of_basis_op_to_reference_setting()
+      ref_subsym = best_subsym.change_basis(cb_op_best_ref)
+      cb_op_ref_primitive = ref_subsym.change_of_basis_op_to_primitive_setting()
+      cb_op_to_primitive = cb_op_ref_primitive * cb_op_best_ref * cb_op_inp_best
+      if cb_op_extra is not None:
+        cb_op_to_primitive = cb_op_extra * cb_op_to_primitive
+
+    if symmetry_cache is not None:
+      symmetry_cache[key] = cb_op_to_primitive
+    return cb_op_to_primitive
+
   def choose_best_orientation_matrix(self, candidate_orientation_matrices):
 
     solution_scorer = self.params.basis_vector_combinations.solution_scorer
@@ -1077,33 +1208,6 @@ class indexer_base(object):
         volume_cutoff=filter_params.volume_cutoff,
         n_indexed_cutoff=filter_params.n_indexed_cutoff)
 
-    def run_one_refinement(args):
-      params, reflections, experiments = args
-      indexed_reflections = reflections.select(reflections['id'] > -1)
-      from dials.algorithms.refinement import RefinerFactory
-      try:
-        logger = logging.getLogger()
-        disabled = logger.disabled
-        logger.disabled = True
-        refiner = RefinerFactory.from_parameters_data_experiments(
-          params, indexed_reflections, experiments,
-          verbosity=0)
-        refiner.run()
-      except (RuntimeError, Sorry), e:
-        return
-      else:
-        rmsds = refiner.rmsds()
-        xy_rmsds = math.sqrt(rmsds[0]**2 + rmsds[1]**2)
-        model_likelihood = 1.0 - xy_rmsds
-        soln = Solution(model_likelihood=model_likelihood,
-                        crystal=experiments.crystals()[0],
-                        rmsds=rmsds,
-                        n_indexed=len(indexed_reflections),
-                        fraction_indexed=float(len(indexed_reflections))/len(reflections))
-        return soln
-      finally:
-        logger.disabled = disabled
-
     import copy
     params = copy.deepcopy(self.all_params)
     params.refinement.parameterisation.crystal.scan_varying = False
@@ -1115,65 +1219,27 @@ class indexer_base(object):
     params.refinement.reflections.reflections_per_degree = min(
       params.refinement.reflections.reflections_per_degree, 20)
 
-    args = []
-
-    from dials.algorithms.indexing.compare_orientation_matrices \
-         import difference_rotation_matrix_and_euler_angles
-    for cm in candidate_orientation_matrices:
-      sel = ((self.reflections['id'] == -1) &
-             (1/self.reflections['rlp'].norms() > self.d_min))
-      refl = self.reflections.select(sel)
-      experiments = ExperimentList()
-      for imageset in self.imagesets:
-        experiments.append(Experiment(imageset=imageset,
-                                      beam=imageset.get_beam(),
-                                      detector=imageset.get_detector(),
-                                      goniometer=imageset.get_goniometer(),
-                                      scan=imageset.get_scan(),
-                                      crystal=cm))
-      self.index_reflections(experiments, refl)
-
-      if (self.target_symmetry_primitive is not None
-          and self.target_symmetry_primitive.space_group() is not None):
-        new_crystal, cb_op_to_primitive = self.apply_symmetry(
-          experiments[0].crystal, self.target_symmetry_primitive,
-          space_group_only=True)
-        if new_crystal is None:
-          continue
-        experiments[0].crystal.update(new_crystal)
-        if not cb_op_to_primitive.is_identity_op():
-          miller_indices = refl['miller_index'].select(refl['id'] == 0)
-          miller_indices = cb_op_to_primitive.apply(miller_indices)
-          refl['miller_index'].set_selected(refl['id'] == 0, miller_indices)
-        if 0 and self.cb_op_primitive_to_given is not None:
-          experiments[0].crystal.update(
-            experiments[0].crystal.change_basis(self.cb_op_primitive_to_given))
-          miller_indices = refl['miller_index'].select(refl['id'] == 0)
-          miller_indices = self.cb_op_primitive_to_given.apply(miller_indices)
-          refl['miller_index'].set_selected(refl['id'] == 0, miller_indices)
-
-      if (self.refined_experiments is not None and
-          len(self.refined_experiments) > 0):
-        orientation_too_similar = False
-        cryst_b = experiments[0].crystal
-        for i_a, cryst_a in enumerate(self.refined_experiments.crystals()):
-          R_ab, euler_angles, cb_op_ab = \
-            difference_rotation_matrix_and_euler_angles(cryst_a, cryst_b)
-          min_angle = self.params.multiple_lattice_search.minimum_angular_separation
-          #print euler_angles
-          if max([abs(ea) for ea in euler_angles]) < min_angle: # degrees
-            orientation_too_similar = True
-            break
-        if orientation_too_similar:
-          debug("skipping crystal: too similar to other crystals")
-          continue
+    # the reflections available for indexing are the same for every candidate,
+    # so select them once here and share them with the worker processes,
+    # which only receive the candidate crystal models
+    sel = ((self.reflections['id'] == -1) &
+           (1/self.reflections['rlp'].norms() > self.d_min))
+    reflections = self.reflections.select(sel)
+    if self.params.index_assignment.method == 'local':
+      # find the nearest neighbours before the workers are started, so they
+      # are shared by all the candidates
+      self._neighbour_cache(
+        reflections['rlp'],
+        self.params.index_assignment.local.nearest_neighbours)
 
-      args.append((params, refl, experiments))
+    def evaluate_candidate(cm):
+      return self._evaluate_candidate_orientation_matrix(
+        cm, reflections, params)
 
     from libtbx import easy_mp
     results = easy_mp.parallel_map(
-      run_one_refinement,
-      args,
+      evaluate_candidate,
+      candidate_orientation_matrices,
       processes=self.params.nproc,
       preserve_exception_message=True,
     )
@@ -1195,6 +1261,83 @@ class indexer_base(object):
     else:
       return None, None
 
+  def _evaluate_candidate_orientation_matrix(self, cm, reflections, params):
+    '''
+    Index the reflections with a candidate crystal model and refine it.
+
+    :param cm: The candidate crystal model
+    :param reflections: The reflections available for indexing
+    :param params: The refinement parameters
+    :return: The Solution or None if the candidate is rejected
+
+    '''
+    from dials.algorithms.indexing.compare_orientation_matrices \
+         import difference_rotation_matrix_and_euler_angles
+    refl = reflections.copy()
+    experiments = ExperimentList()
+    for imageset in self.imagesets:
+      experiments.append(Experiment(imageset=imageset,
+                                    beam=imageset.get_beam(),
+                                    detector=imageset.get_detector(),
+                                    goniometer=imageset.get_goniometer(),
+                                    scan=imageset.get_scan(),
+                                    crystal=cm))
+    self.index_reflections(experiments, refl)
+
+    if (self.target_symmetry_primitive is not None
+        and self.target_symmetry_primitive.space_group() is not None):
+      new_crystal, cb_op_to_primitive = self.apply_symmetry(
+        experiments[0].crystal, self.target_symmetry_primitive,
+        space_group_only=True)
+      if new_crystal is None:
+        return None
+      experiments[0].crystal.update(new_crystal)
+      if not cb_op_to_primitive.is_identity_op():
+        miller_indices = refl['miller_index'].select(refl['id'] == 0)
+        miller_indices = cb_op_to_primitive.apply(miller_indices)
+        refl['miller_index'].set_selected(refl['id'] == 0, miller_indices)
+      if 0 and self.cb_op_primitive_to_given is not None:
+        experiments[0].crystal.update(
+          experiments[0].crystal.change_basis(self.cb_op_primitive_to_given))
+        miller_indices = refl['miller_index'].select(refl['id'] == 0)
+        miller_indices = self.cb_op_primitive_to_given.apply(miller_indices)
+        refl['miller_index'].set_selected(refl['id'] == 0, miller_indices)
+
+    if (self.refined_experiments is not None and
+        len(self.refined_experiments) > 0):
+      cryst_b = experiments[0].crystal
+      min_angle = self.params.multiple_lattice_search.minimum_angular_separation
+      for i_a, cryst_a in enumerate(self.refined_experiments.crystals()):
+        R_ab, euler_angles, cb_op_ab = \
+          difference_rotation_matrix_and_euler_angles(cryst_a, cryst_b)
+        #print euler_angles
+        if max([abs(ea) for ea in euler_angles]) < min_angle: # degrees
+          debug("skipping crystal: too similar to other crystals")
+          return None
+
+    indexed_reflections = refl.select(refl['id'] > -1)
+    from dials.algorithms.refinement import RefinerFactory
+    logger = logging.getLogger()
+    disabled = logger.disabled
+    try:
+      logger.disabled = True
+      refiner = RefinerFactory.from_parameters_data_experiments(
+        params, indexed_reflections, experiments,
+        verbosity=0)
+      refiner.run()
+    except (RuntimeError, Sorry), e:
+      return None
+    finally:
+      logger.disabled = disabled
+    rmsds = refiner.rmsds()
+    xy_rmsds = math.sqrt(rmsds[0]**2 + rmsds[1]**2)
+    model_likelihood = 1.0 - xy_rmsds
+    return Solution(model_likelihood=model_likelihood,
+                    crystal=experiments.crystals()[0],
+                    rmsds=rmsds,
+                    n_indexed=len(indexed_reflections),
+                    fraction_indexed=float(len(indexed_reflections))/len(refl))
+
   def apply_symmetry(self, crystal_model, target_symmetry,
                      cell_only=False,
                      space_group_only=False):
@@ -1264,7 +1407,8 @@ class indexer_base(object):
         experiments, self.d_min, epsilon=params_local.epsilon,
         delta=params_local.delta, l_min=params_local.l_min,
         nearest_neighbours=params_local.nearest_neighbours,
-        verbosity=verbosity)
+        verbosity=verbosity,
+        neighbour_cache=self._neighbour_cache)
     else:
       params_simple = self.params.index_assignment.simple
       from dials.algorithms.indexing import index_reflections
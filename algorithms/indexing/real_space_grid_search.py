@@ -24,6 +24,74 @@ from dxtbx.model.experiment.experiment_list import Experiment, ExperimentList
 from logging import info, debug
 
 
+def compute_functional_batch(reciprocal_lattice_points, vectors, nproc=1,
+                             max_block_size=2**24):
+  '''
+  Compute the real space grid search functional, the sum of cos(2 pi S.v)
+  over all reciprocal lattice points S, for many search vectors v at once.
+  The vectors are processed in blocks, each block as a single matrix product,
+  with the blocks split over the available processes.
+
+  :param reciprocal_lattice_points: The reciprocal lattice points
+  :param vectors: The search vectors
+  :param nproc: The number of processes
+  :param max_block_size: The maximum number of elements in a block
+  :return: The functional for each vector
+
+  '''
+  import numpy as np
+  if len(vectors) == 0:
+    return flex.double()
+  S = reciprocal_lattice_points.as_double().as_numpy_array().reshape(-1, 3)
+  V = vectors.as_double().as_numpy_array().reshape(-1, 3)
+  block_size = max(1, max_block_size // max(1, len(S)))
+  n_blocks = int(math.ceil(len(V) / block_size))
+  if nproc > 1 and n_blocks < nproc:
+    block_size = int(math.ceil(len(V) / nproc))
+    n_blocks = int(math.ceil(len(V) / block_size))
+
+  def compute_block(i_block):
+    Vi = V[i_block*block_size:(i_block+1)*block_size]
+    return np.cos((2 * math.pi) * np.dot(S, Vi.T)).sum(axis=0)
+
+  if nproc > 1 and n_blocks > 1:
+    from libtbx import easy_mp
+    results = easy_mp.parallel_map(
+      func=compute_block,
+      iterable=range(n_blocks),
+      processes=min(nproc, n_blocks),
+      method="multiprocessing",
+      preserve_order=True,
+      preserve_exception_message=True)
+  else:
+    results = [compute_block(i) for i in range(n_blocks)]
+  return flex.double(np.concatenate(results).tolist())
+
+
+def local_grid_directions(centre, radius, step):
+  '''
+  Generate a grid of unit vectors on the spherical cap around a direction.
+
+  :param centre: The unit vector at the centre of the cap
+  :param radius: The angular radius of the cap (radians)
+  :param step: The angular grid spacing (radians)
+  :return: The unit vectors
+
+  '''
+  centre = matrix.col(centre).normalize()
+  u = centre.ortho().normalize()
+  w = centre.cross(u).normalize()
+  n = int(math.floor(radius / step))
+  directions = flex.vec3_double()
+  for i in range(-n, n+1):
+    for j in range(-n, n+1):
+      if (i*i + j*j) * step * step > radius * radius:
+        continue
+      d = centre + u * math.tan(i * step) + w * math.tan(j * step)
+      directions.append(d.normalize().elems)
+  return directions
+
+
 class indexer_real_space_grid_search(indexer_base):
 
   def __init__(self, reflections, imagesets, params):
@@ -61,21 +129,50 @@ class indexer_real_space_grid_search(indexer_base):
     from rstbx.dps_core import SimpleSamplerTool
     assert self.target_symmetry_primitive is not None
     assert self.target_symmetry_primitive.unit_cell() is not None
-    SST = SimpleSamplerTool(
-      self.params.real_space_grid_search.characteristic_grid)
-    SST.construct_hemisphere_grid(SST.incr)
+    grid_params = self.params.real_space_grid_search
     cell_dimensions = self.target_symmetry_primitive.unit_cell().parameters()[:3]
-    unique_cell_dimensions = set(cell_dimensions)
-    info(
-      "Number of search vectors: %i" %(len(SST.angles) * len(unique_cell_dimensions)))
-    vectors = flex.vec3_double()
-    function_values = flex.double()
-    for i, direction in enumerate(SST.angles):
-      for l in unique_cell_dimensions:
-        v = matrix.col(direction.dvec) * l
-        f = compute_functional(v.elems)
-        vectors.append(v.elems)
-        function_values.append(f)
+    unique_cell_dimensions = sorted(set(cell_dimensions))
+    nproc = self.params.nproc
+
+    def hemisphere_directions(characteristic_grid):
+      SST = SimpleSamplerTool(characteristic_grid)
+      SST.construct_hemisphere_grid(SST.incr)
+      return flex.vec3_double([direction.dvec for direction in SST.angles])
+
+    def search_vectors(directions, lengths):
+      vectors = flex.vec3_double()
+      for l in lengths:
+        vectors.extend(directions * l)
+      return vectors
+
+    if grid_params.coarse_to_fine.enable:
+      # search a coarse grid of directions, then search the fine grid only
+      # in the neighbourhood of the best coarse directions
+      coarse_grid = grid_params.coarse_to_fine.coarse_grid
+      directions = hemisphere_directions(coarse_grid)
+      vectors = search_vectors(directions, unique_cell_dimensions)
+      function_values = compute_functional_batch(
+        reciprocal_lattice_points, vectors, nproc=nproc)
+      perm = flex.sort_permutation(function_values, reverse=True)
+      n_candidates = min(
+        grid_params.coarse_to_fine.n_candidates, len(perm))
+      fine_vectors = flex.vec3_double()
+      for i in perm[:n_candidates]:
+        v = matrix.col(vectors[i])
+        fine_directions = local_grid_directions(
+          v.normalize(), coarse_grid, grid_params.characteristic_grid)
+        fine_vectors.extend(fine_directions * v.length())
+      info("Number of search vectors: %i coarse, %i fine" %(
+        len(vectors), len(fine_vectors)))
+      vectors.extend(fine_vectors)
+      function_values.extend(compute_functional_batch(
+        reciprocal_lattice_points, fine_vectors, nproc=nproc))
+    else:
+      directions = hemisphere_directions(grid_params.characteristic_grid)
+      vectors = search_vectors(directions, unique_cell_dimensions)
+      info("Number of search vectors: %i" %len(vectors))
+      function_values = compute_functional_batch(
+        reciprocal_lattice_points, vectors, nproc=nproc)
 
     perm = flex.sort_permutation(function_values, reverse=True)
     vectors = vectors.select(perm)
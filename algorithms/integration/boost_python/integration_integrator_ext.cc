@@ -249,10 +249,17 @@ namespace dials { namespace algorithms { namespace boost_python {
       .def("nframes", &JobList::Job::nframes)
       ;
 
+    void (JobList::*job_list_add_block_size)(
+        tiny<int,2>, tiny<int,2>, int) = &JobList::add;
+    void (JobList::*job_list_add_jobs)(
+        tiny<int,2>, tiny<int,2>,
+        const af::const_ref< tiny<int,2> >&) = &JobList::add;
+
     class_<JobList>("JobList")
       .def(init< tiny<int,2>,
                  const af::const_ref< tiny<int,2> >& >())
-      .def("add", &JobList::add)
+      .def("add", job_list_add_block_size)
+      .def("add", job_list_add_jobs)
       .def("__len__", &JobList::size)
       .def("__getitem__", &JobList::operator[],
           return_internal_reference<>())
@@ -287,6 +294,10 @@ namespace dials { namespace algorithms { namespace boost_python {
                 bool>())
       .def("compute_max_memory_usage",
           &ShoeboxProcessor::compute_max_memory_usage)
+      .def("spill", &ShoeboxProcessor::spill)
+      .def("close_spill", &ShoeboxProcessor::close_spill)
+      .def("spill_size", &ShoeboxProcessor::spill_size)
+      .def("num_spilled", &ShoeboxProcessor::num_spilled)
       .def("next", &ShoeboxProcessor::next<double>)
       .def("next", &ShoeboxProcessor::next<int>)
       .def("frame0", &ShoeboxProcessor::frame0)
@@ -203,6 +203,34 @@ namespace dials { namespace algorithms {
       groups_.add(int2(j0, j1), expr, range);
     }
 
+    /**
+     * Add a new group of jobs covering a range of experiments with the
+     * frames of each job given explicitly.
+     * @param expr The range of experiments
+     * @param range The range of frames
+     * @param jobs The frames of each job
+     */
+    void add(tiny<int,2> expr,
+             tiny<int,2> range,
+             const af::const_ref< tiny<int,2> > &jobs) {
+      DIALS_ASSERT(jobs.size() > 0);
+      DIALS_ASSERT(jobs.front()[0] == range[0]);
+      DIALS_ASSERT(jobs.back()[1] == range[1]);
+      std::size_t j0 = size();
+      std::size_t index = groups_.size();
+      DIALS_ASSERT(jobs[0][1] > jobs[0][0]);
+      jobs_.push_back(Job(index, expr, jobs[0]));
+      for (std::size_t i = 1; i < jobs.size(); ++i) {
+        DIALS_ASSERT(jobs[i][1] > jobs[i][0]);
+        DIALS_ASSERT(jobs[i][0] > jobs[i-1][0]);
+        DIALS_ASSERT(jobs[i][1] > jobs[i-1][1]);
+        DIALS_ASSERT(jobs[i][0] <= jobs[i-1][1]);
+        jobs_.push_back(Job(index, expr, jobs[i]));
+      }
+      std::size_t j1 = size();
+      groups_.add(int2(j0, j1), expr, range);
+    }
+
     /**
      * @returns The requested job
      */
@@ -57,6 +57,16 @@ def generate_phil_scope():
                   "that 100*threshold % of reflections are guarenteed to be"
                   "fully contained in 1 block"
 
+        auto_mode = *extent cost
+          .type = choice
+          .help = "For block size auto, how the blocks are chosen. With extent,"
+                  "blocks of fixed size are computed from the threshold as"
+                  "described above. With cost, the cost of each frame is"
+                  "estimated from the number of shoebox pixels recorded on it"
+                  "and the size of the detector and the blocks are chosen to"
+                  "balance the cost across the processors, with the size"
+                  "from the threshold used as the minimum block size."
+
         force = False
           .type = bool
           .help = "If the number of processors is 1 and force is False, then the"
@@ -67,6 +77,48 @@ def generate_phil_scope():
           .type = float(value_min=0.0,value_max=1.0)
           .help = "The maximum percentage of total physical memory to use for"
                   "allocating shoebox arrays."
+
+        scheduler = *static dynamic
+          .type = choice
+          .help = "How blocks are scheduled when nproc > 1. With static, all"
+                  "tasks are created up front and the results are accumulated"
+                  "in order. With dynamic, tasks are created as needed, idle"
+                  "processes pull the next block as soon as they finish and"
+                  "results are accumulated in the order they arrive. The"
+                  "dynamic scheduler is only available with the"
+                  "multiprocessing method."
+
+        max_tasks_in_flight = 0
+          .type = int(value_min=0)
+          .help = "For the dynamic scheduler, the maximum number of tasks (and"
+                  "hence reflection tables) submitted to the processes at"
+                  "once. If 0, then 2*nproc tasks are used."
+
+        max_image_cache_memory = 0
+          .type = float(value_min=0.0)
+          .help = "The maximum memory (in GB) used by each process to cache"
+                  "decoded images so that frames shared by overlapping blocks"
+                  "are only read once. The cache is cleared when processing"
+                  "finishes. If 0, then images are not cached."
+
+        read_ahead = 0
+          .type = int(value_min=0)
+          .help = "The number of images to read ahead of processing in a"
+                  "background thread so that reading overlaps with shoebox"
+                  "extraction and processing. Only the time spent waiting on"
+                  "file I/O overlaps with processing, since image decoding"
+                  "does not release the GIL. If 0, then images are read in"
+                  "the processing thread."
+
+        spill_directory = None
+          .type = path
+          .help = "A scratch directory to which shoebox data are spilled when"
+                  "the shoeboxes of a block would exceed the memory limit. The"
+                  "shoeboxes which do not fit in memory are written to a memory"
+                  "mapped file and only loaded when complete. If set, the"
+                  "number of processors is not reduced to fit the memory"
+                  "limit. This is not used for flattened shoeboxes or when"
+                  "saving shoeboxes for debugging."
       }
 
       debug {
@@ -314,8 +366,14 @@ class Parameters(object):
     block.size = params.block.size
     block.units = params.block.units
     block.threshold = params.block.threshold
+    block.auto_mode = params.block.auto_mode
     block.force = params.block.force
     block.max_memory_usage = params.block.max_memory_usage
+    block.scheduler = params.block.scheduler
+    block.max_tasks_in_flight = params.block.max_tasks_in_flight
+    block.max_image_cache_memory = params.block.max_image_cache_memory
+    block.read_ahead = params.block.read_ahead
+    block.spill_directory = params.block.spill_directory
 
     # Set the modelling processor parameters
     result.modelling.mp = mp
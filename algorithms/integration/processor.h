@@ -20,6 +20,11 @@
 #include <list>
 #include <vector>
 #include <ctime>
+#include <fstream>
+#include <cstring>
+#include <boost/shared_ptr.hpp>
+#include <boost/interprocess/file_mapping.hpp>
+#include <boost/interprocess/mapped_region.hpp>
 #include <dials/model/data/image.h>
 #include <dials/model/data/shoebox.h>
 #include <dials/array_family/reflection_table.h>
@@ -76,7 +81,9 @@ namespace dials { namespace algorithms {
           frame0_(frame0),
           frame1_(frame1),
           frame_(frame0),
-          nframes_(frame1 - frame0) {
+          nframes_(frame1 - frame0),
+          spill_size_(0),
+          num_spilled_(0) {
       DIALS_ASSERT(frame0_ < frame1_);
       DIALS_ASSERT(npanels_ > 0);
       DIALS_ASSERT(data.is_consistent());
@@ -113,6 +120,7 @@ namespace dials { namespace algorithms {
         }
       }
       DIALS_ASSERT(count == num);
+      spill_offset_.resize(shoebox.size(), spill_npos());
     }
 
     /**
@@ -155,6 +163,102 @@ namespace dials { namespace algorithms {
       return max_memory_usage;
     }
 
+    /**
+     * Spill shoeboxes to a memory mapped file. Shoeboxes are kept in memory
+     * in the order in which they are started while the memory used is within
+     * the limit. The data and mask of the remaining shoeboxes are written to
+     * the file frame by frame and are only allocated in memory when complete
+     * and ready to be processed. This must be called before processing.
+     * @param filename The spill file
+     * @param max_memory The maximum memory to use for shoeboxes in memory
+     * @returns The size of the spill file in bytes
+     */
+    std::size_t spill(const std::string &filename, std::size_t max_memory) {
+      using namespace boost::interprocess;
+      typedef Shoebox<>::float_type float_type;
+      DIALS_ASSERT(frame_ == frame0_);
+      DIALS_ASSERT(flatten_ == false);
+      DIALS_ASSERT(save_ == false);
+      DIALS_ASSERT(spill_size_ == 0);
+      af::const_ref< Shoebox<> > shoebox =
+        data_.get< Shoebox<> >("shoebox").const_ref();
+
+      // Decide which shoeboxes to keep in memory and compute the offsets of
+      // the spilled shoeboxes in the file
+      std::size_t cur_memory_usage = 0;
+      for (int frame = frame0_; frame < frame1_; ++frame) {
+        std::size_t memory_to_free = 0;
+        for (std::size_t p = 0; p < npanels_; ++p) {
+          af::const_ref<std::size_t> ind = indices(frame, p);
+          for (std::size_t i = 0; i < ind.size(); ++i) {
+            DIALS_ASSERT(ind[i] < shoebox.size());
+            const Shoebox<>& sbox = shoebox[ind[i]];
+            std::size_t size = sbox.xsize() * sbox.ysize() * sbox.zsize();
+            std::size_t nbytes = size * (
+                sizeof(float_type) +
+                sizeof(float_type) +
+                sizeof(int));
+            if (frame == sbox.bbox[4]) {
+              if (cur_memory_usage + nbytes <= max_memory) {
+                cur_memory_usage += nbytes;
+              } else {
+                spill_offset_[ind[i]] = spill_size_;
+                spill_size_ += size * (sizeof(float_type) + sizeof(int));
+                num_spilled_++;
+              }
+            }
+            if (frame == sbox.bbox[5]-1 && !is_spilled(ind[i])) {
+              memory_to_free += nbytes;
+            }
+          }
+        }
+        DIALS_ASSERT(memory_to_free <= cur_memory_usage);
+        cur_memory_usage -= memory_to_free;
+      }
+      DIALS_ASSERT(cur_memory_usage == 0);
+
+      // Create the zero filled file and map it into memory
+      if (spill_size_ > 0) {
+        {
+          std::filebuf fbuf;
+          fbuf.open(filename.c_str(),
+            std::ios_base::in | std::ios_base::out |
+            std::ios_base::trunc | std::ios_base::binary);
+          DIALS_ASSERT(fbuf.is_open());
+          fbuf.pubseekoff(spill_size_ - 1, std::ios_base::beg);
+          fbuf.sputc(0);
+        }
+        spill_file_ = boost::shared_ptr<file_mapping>(
+          new file_mapping(filename.c_str(), read_write));
+        spill_region_ = boost::shared_ptr<mapped_region>(
+          new mapped_region(*spill_file_, read_write));
+        DIALS_ASSERT(spill_region_->get_size() == spill_size_);
+      }
+      return spill_size_;
+    }
+
+    /**
+     * Unmap the spill file so it can be removed
+     */
+    void close_spill() {
+      spill_region_.reset();
+      spill_file_.reset();
+    }
+
+    /**
+     * @returns The size of the spill file in bytes
+     */
+    std::size_t spill_size() const {
+      return spill_size_;
+    }
+
+    /**
+     * @returns The number of shoeboxes spilled to file
+     */
+    std::size_t num_spilled() const {
+      return num_spilled_;
+    }
+
     /**
      * Extract the pixels from the image and copy to the relevant shoeboxes.
      * @param image The image to process
@@ -185,6 +289,14 @@ namespace dials { namespace algorithms {
         for (std::size_t i = 0; i < ind.size(); ++i) {
           DIALS_ASSERT(ind[i] < shoebox.size());
           Shoebox<>& sbox = shoebox[ind[i]];
+          if (is_spilled(ind[i])) {
+            extract_spilled(sbox, spill_offset_[ind[i]], data, mask);
+            if (frame_ == sbox.bbox[5]-1) {
+              load_spilled(sbox, spill_offset_[ind[i]]);
+              process_indices.push_back(ind[i]);
+            }
+            continue;
+          }
           if (frame_ == sbox.bbox[4]) {
             DIALS_ASSERT(sbox.is_allocated() == false);
             sbox.allocate();
@@ -310,6 +422,92 @@ namespace dials { namespace algorithms {
 
   private:
 
+    /**
+     * @returns The offset value for shoeboxes which are not spilled
+     */
+    static std::size_t spill_npos() {
+      return static_cast<std::size_t>(-1);
+    }
+
+    /**
+     * @returns Is the shoebox spilled to file
+     */
+    bool is_spilled(std::size_t index) const {
+      DIALS_ASSERT(index < spill_offset_.size());
+      return spill_offset_[index] != spill_npos();
+    }
+
+    /**
+     * Copy the pixels for the current frame into the spill file
+     * @param sbox The shoebox
+     * @param offset The offset of the shoebox in the spill file
+     * @param data The image data
+     * @param mask The image mask
+     */
+    template <typename T>
+    void extract_spilled(
+        const Shoebox<> &sbox,
+        std::size_t offset,
+        const af::const_ref< T, af::c_grid<2> > &data,
+        const af::const_ref< bool, af::c_grid<2> > &mask) {
+      typedef Shoebox<>::float_type float_type;
+      DIALS_ASSERT(spill_region_);
+      int6 b = sbox.bbox;
+      DIALS_ASSERT(frame_ >= b[4] && frame_ < b[5]);
+      int x0 = b[0];
+      int x1 = b[1];
+      int y0 = b[2];
+      int y1 = b[3];
+      std::size_t xs = x1 - x0;
+      std::size_t ys = y1 - y0;
+      std::size_t zs = b[5] - b[4];
+      std::size_t z = frame_ - b[4];
+      std::size_t yi = data.accessor()[0];
+      std::size_t xi = data.accessor()[1];
+      int xb = x0 >= 0 ? 0 : std::abs(x0);
+      int yb = y0 >= 0 ? 0 : std::abs(y0);
+      int xe = x1 <= xi ? xs : xs-(x1-(int)xi);
+      int ye = y1 <= yi ? ys : ys-(y1-(int)yi);
+      DIALS_ASSERT(ye > yb && yb >= 0 && ye <= ys);
+      DIALS_ASSERT(xe > xb && xb >= 0 && xe <= xs);
+      DIALS_ASSERT(yb + y0 >= 0 && ye + y0 <= yi);
+      DIALS_ASSERT(xb + x0 >= 0 && xe + x0 <= xi);
+      std::size_t size = xs * ys * zs;
+      DIALS_ASSERT(offset + size * (sizeof(float_type) + sizeof(int))
+          <= spill_size_);
+      char *base = static_cast<char*>(spill_region_->get_address()) + offset;
+      float_type *sdata = reinterpret_cast<float_type*>(base);
+      int *smask = reinterpret_cast<int*>(base + size * sizeof(float_type));
+      for (std::size_t y = yb; y < ye; ++y) {
+        for (std::size_t x = xb; x < xe; ++x) {
+          std::size_t k = (z * ys + y) * xs + x;
+          sdata[k] = data(y+y0,x+x0);
+          smask[k] = mask(y+y0,x+x0) ? Valid : 0;
+        }
+      }
+    }
+
+    /**
+     * Allocate the shoebox and copy the data and mask from the spill file
+     * @param sbox The shoebox
+     * @param offset The offset of the shoebox in the spill file
+     */
+    void load_spilled(Shoebox<> &sbox, std::size_t offset) {
+      typedef Shoebox<>::float_type float_type;
+      DIALS_ASSERT(spill_region_);
+      DIALS_ASSERT(sbox.is_allocated() == false);
+      sbox.allocate();
+      std::size_t size = sbox.data.size();
+      DIALS_ASSERT(sbox.mask.size() == size);
+      DIALS_ASSERT(offset + size * (sizeof(float_type) + sizeof(int))
+          <= spill_size_);
+      const char *base =
+        static_cast<const char*>(spill_region_->get_address()) + offset;
+      std::memcpy(sbox.data.begin(), base, size * sizeof(float_type));
+      std::memcpy(sbox.mask.begin(), base + size * sizeof(float_type),
+          size * sizeof(int));
+    }
+
     /**
      * Get an index array specifying which reflections are recorded on a given
      * frame and panel.
@@ -342,6 +540,11 @@ namespace dials { namespace algorithms {
     std::size_t nframes_;
     std::vector<std::size_t> indices_;
     std::vector<std::size_t> offset_;
+    std::vector<std::size_t> spill_offset_;
+    std::size_t spill_size_;
+    std::size_t num_spilled_;
+    boost::shared_ptr<boost::interprocess::file_mapping> spill_file_;
+    boost::shared_ptr<boost::interprocess::mapped_region> spill_region_;
   };
 
 }}
@@ -12,6 +12,7 @@ from __future__ import division
 from dials_algorithms_integration_integrator_ext import *
 from dials import phil
 import libtbx
+import os
 
 
 class _Job(object):
@@ -23,6 +24,213 @@ class _Job(object):
 job = _Job()
 
 
+class ImageCache(object):
+  '''
+  A least recently used cache of corrected images and masks. Images are keyed
+  by the image path and the frame index so that frames shared by overlapping
+  blocks are only decoded once per process. The cache is bounded by the
+  memory used by the image data and is cleared when processing finishes.
+
+  '''
+
+  def __init__(self, max_memory=0):
+    '''
+    Initialise the cache
+
+    :param max_memory: The maximum memory to use (bytes)
+
+    '''
+    from collections import OrderedDict
+    self.max_memory = max_memory
+    self.memory = 0
+    self.items = OrderedDict()
+
+  def resize(self, max_memory):
+    '''
+    Set the maximum memory and evict images if necessary
+
+    :param max_memory: The maximum memory to use (bytes)
+
+    '''
+    self.max_memory = max_memory
+    self._evict()
+
+  def read(self, imageset, index, frame):
+    '''
+    Get the corrected image and mask, reading them if they are not cached
+
+    :param imageset: The imageset
+    :param index: The index of the image within the imageset
+    :param frame: The frame number of the image
+    :return: The image, the mask and whether the image was cached
+
+    '''
+    if self.max_memory <= 0:
+      return imageset.get_corrected_data(index), imageset.get_mask(index), False
+    key = (imageset.get_path(index), frame)
+    try:
+      image, mask, size = self.items.pop(key)
+      self.items[key] = (image, mask, size)
+      return image, mask, True
+    except KeyError:
+      pass
+    image = imageset.get_corrected_data(index)
+    mask = imageset.get_mask(index)
+    size = sum(len(d) for d in image) * 8 + sum(len(m) for m in mask)
+    if size <= self.max_memory:
+      self.items[key] = (image, mask, size)
+      self.memory += size
+      self._evict()
+    return image, mask, False
+
+  def clear(self):
+    '''
+    Remove all the images from the cache
+
+    '''
+    self.items.clear()
+    self.memory = 0
+
+  def __len__(self):
+    '''
+    :return: The number of cached images
+
+    '''
+    return len(self.items)
+
+  def _evict(self):
+    '''
+    Remove the least recently used images until within the memory limit
+
+    '''
+    while self.memory > self.max_memory and len(self.items) > 0:
+      key, (image, mask, size) = self.items.popitem(last=False)
+      self.memory -= size
+
+
+image_cache = ImageCache()
+
+
+class ImageReader(object):
+  '''
+  A class to read the images of an imageset in order. If read_ahead is greater
+  than zero, the images are read in a background thread into a bounded queue
+  so that reading overlaps with processing; otherwise they are read on
+  demand. Images are read through the image cache.
+
+  Neither the image reading nor ShoeboxProcessor.next release the GIL, so
+  only the time the reader spends blocked on file I/O overlaps with
+  processing; decoding the images is still serialised with processing. The
+  read ahead is therefore only of benefit where reading is I/O bound, e.g. on
+  a slow network filesystem.
+
+  '''
+
+  def __init__(self, imageset, frame0, read_ahead=0):
+    '''
+    Initialise the reader
+
+    :param imageset: The imageset to read
+    :param frame0: The frame number of the first image
+    :param read_ahead: The maximum number of images to read ahead
+
+    '''
+    assert read_ahead >= 0, "Read ahead must be >= 0"
+    self.imageset = imageset
+    self.frame0 = frame0
+    self.read_ahead = read_ahead
+    self.read_time = 0.0
+    self.wait_time = 0.0
+    self.num_read = 0
+    self.num_cached = 0
+    self._stopped = False
+
+  def __iter__(self):
+    '''
+    Iterate through the images
+
+    :return: The image and mask for each frame
+
+    '''
+    if self.read_ahead == 0:
+      return self._iter_sync()
+    return self._iter_async()
+
+  def _read(self, index):
+    '''
+    Read an image and update the counters
+
+    '''
+    from time import time
+    st = time()
+    image, mask, cached = image_cache.read(
+      self.imageset, index, self.frame0 + index)
+    if cached:
+      self.num_cached += 1
+    else:
+      self.num_read += 1
+    self.read_time += time() - st
+    return image, mask
+
+  def _iter_sync(self):
+    '''
+    Read the images in the calling thread
+
+    '''
+    for i in range(len(self.imageset)):
+      image, mask = self._read(i)
+      self.wait_time = self.read_time
+      yield image, mask
+
+  def _iter_async(self):
+    '''
+    Read the images in a background thread. The thread only runs in parallel
+    with processing while it is blocked on I/O, since neither decoding nor
+    processing releases the GIL.
+
+    '''
+    from threading import Thread
+    from Queue import Queue
+    from time import time
+    queue = Queue(maxsize=self.read_ahead)
+    thread = Thread(target=self._run, args=(queue,))
+    thread.daemon = True
+    self._stopped = False
+    thread.start()
+    try:
+      for i in range(len(self.imageset)):
+        st = time()
+        image, mask, error = queue.get()
+        self.wait_time += time() - st
+        if error is not None:
+          raise RuntimeError(error)
+        yield image, mask
+    finally:
+      self._stopped = True
+      thread.join()
+
+  def _run(self, queue):
+    '''
+    Read the images and put them on the queue until finished or stopped
+
+    '''
+    from Queue import Full
+    from traceback import format_exc
+    for i in range(len(self.imageset)):
+      try:
+        item = self._read(i) + (None,)
+      except Exception:
+        item = (None, None, format_exc())
+      while not self._stopped:
+        try:
+          queue.put(item, timeout=0.1)
+          break
+        except Full:
+          pass
+      if self._stopped or item[2] is not None:
+        break
+
+
 class Parameters(object):
   '''
   Class to handle parameters for the processor
@@ -64,15 +272,27 @@ class Parameters(object):
       self.size = libtbx.Auto
       self.units = 'degrees'
       self.threshold = 0.99
+      self.auto_mode = 'extent'
       self.force = False
       self.max_memory_usage = 0.75
+      self.scheduler = 'static'
+      self.max_tasks_in_flight = 0
+      self.max_image_cache_memory = 0
+      self.read_ahead = 0
+      self.spill_directory = None
 
     def update(self, other):
       self.size = other.size
       self.units = other.units
       self.threshold = other.threshold
+      self.auto_mode = other.auto_mode
       self.force = other.force
       self.max_memory_usage = other.max_memory_usage
+      self.scheduler = other.scheduler
+      self.max_tasks_in_flight = other.max_tasks_in_flight
+      self.max_image_cache_memory = other.max_image_cache_memory
+      self.read_ahead = other.read_ahead
+      self.spill_directory = other.spill_directory
 
   class Shoebox(object):
     '''
@@ -134,18 +354,33 @@ class TimingInfo(object):
   '''
   def __init__(self):
     self.read = 0
+    self.read_wait = 0
     self.extract = 0
     self.initialize = 0
     self.process = 0
     self.finalize = 0
     self.total = 0
     self.user = 0
+    self.num_frames = 0
+    self.num_read = 0
+    self.num_cached = 0
+    self.spill = 0
+    self.num_spilled = 0
+    self.num_shoeboxes = 0
 
   def __str__(self):
     ''' Convert to string. '''
     from libtbx.table_utils import format as table
+    if self.num_frames > 0:
+      reads_per_frame = self.num_read / self.num_frames
+    else:
+      reads_per_frame = 0
     rows = [
       ["Read time"        , "%.2f seconds" % (self.read)       ],
+      ["Read wait time"   , "%.2f seconds" % (self.read_wait)  ],
+      ["Images read"      , "%d (%.2f per frame)" % (
+        self.num_read, reads_per_frame)                          ],
+      ["Images cached"    , "%d" % (self.num_cached)           ],
       ["Extract time"     , "%.2f seconds" % (self.extract)    ],
       ["Pre-process time" , "%.2f seconds" % (self.initialize) ],
       ["Process time"     , "%.2f seconds" % (self.process)    ],
@@ -153,6 +388,11 @@ class TimingInfo(object):
       ["Total time"       , "%.2f seconds" % (self.total)      ],
       ["User time"        , "%.2f seconds" % (self.user)       ],
     ]
+    if self.num_spilled > 0:
+      in_memory = 1.0 - self.num_spilled / self.num_shoeboxes
+      rows.append(
+        ["Shoebox spill"  , "%g GB (%.1f%% in memory)" % (
+          self.spill/1e9, 100.0 * in_memory)                     ])
     return table(rows, justify='right', prefix=' ')
 
 
@@ -214,40 +454,162 @@ class Processor(object):
     info(self.manager.summary())
     info(' Using %s with %d parallel job(s) and %d thread(s) per job\n' % (
       mp_method, mp_nproc, mp_nthreads))
-    if mp_nproc > 1:
-      def process_output(result):
-        import logging
-        for message in result[1]:
-          logging.log(message.levelno, message.msg)
-        self.manager.accumulate(result[0])
-        result[0].reflections = None
-        result[0].data = None
-      def execute_task(task):
-        from cStringIO import StringIO
-        from dials.util import log
-        import logging
-        log.config_simple_cached()
-        result = task()
-        handlers = logging.getLogger().handlers
-        assert len(handlers) == 1, "Invalid number of logging handlers"
-        return result, handlers[0].messages()
-      easy_mp.parallel_map(
-        func=execute_task,
-        iterable=list(self.manager.tasks()),
-        processes=mp_nproc,
-        callback=process_output,
-        method=mp_method,
-        preserve_order=True,
-        preserve_exception_message=True)
-    else:
-      for task in self.manager.tasks():
-        self.manager.accumulate(task())
+    try:
+      if mp_nproc > 1:
+        def process_output(result):
+          import logging
+          for message in result[1]:
+            logging.log(message.levelno, message.msg)
+          self.manager.accumulate(result[0])
+          result[0].reflections = None
+          result[0].data = None
+        if (self.manager.params.block.scheduler == 'dynamic' and
+            mp_method == 'multiprocessing'):
+          self._process_dynamic(mp_nproc, process_output)
+        else:
+          easy_mp.parallel_map(
+            func=_execute_parallel_task,
+            iterable=list(self.manager.tasks()),
+            processes=mp_nproc,
+            callback=process_output,
+            method=mp_method,
+            preserve_order=True,
+            preserve_exception_message=True)
+      else:
+        for task in self.manager.tasks():
+          self.manager.accumulate(task())
+    finally:
+
+      # The cached images are not needed once the tasks are done and would
+      # otherwise be held, and inherited by forked processes, indefinitely
+      image_cache.clear()
     self.manager.finalize()
     end_time = time()
     self.manager.time.user_time = end_time - start_time
     result1, result2 = self.manager.result()
     return result1, result2, self.manager.time
 
+  def _process_dynamic(self, nproc, callback):
+    '''
+    Process the tasks with a set of worker processes which pull the next task
+    from a queue as soon as they become idle. Tasks are created lazily and the
+    number of tasks submitted at any one time is bounded so that only a few
+    reflection tables are held in the parent process at once. Results are
+    passed to the callback in the order in which they finish.
+
+    :param nproc: The number of processes
+    :param callback: The function to call with each result
+
+    '''
+    from multiprocessing import Process, Queue
+    from Queue import Empty
+
+    # Get the maximum number of tasks to have in flight
+    max_in_flight = self.manager.params.block.max_tasks_in_flight
+    if max_in_flight == 0:
+      max_in_flight = 2 * nproc
+    max_in_flight = max(max_in_flight, nproc)
+
+    # The workers take tasks from one queue and put the results on another.
+    # If a worker dies, the task it was running is lost and its result never
+    # arrives, so check that the workers are still alive while waiting
+    task_queue = Queue()
+    result_queue = Queue()
+    workers = []
+    for i in range(nproc):
+      worker = Process(
+        target=_execute_dynamic_tasks,
+        args=(task_queue, result_queue))
+      worker.daemon = True
+      worker.start()
+      workers.append(worker)
+    tasks = iter(self.manager.tasks())
+    try:
+      num_in_flight = 0
+      exhausted = False
+      while True:
+        while not exhausted and num_in_flight < max_in_flight:
+          try:
+            task = next(tasks)
+          except StopIteration:
+            exhausted = True
+            break
+          task_queue.put(task)
+          del task
+          num_in_flight += 1
+        if num_in_flight == 0:
+          break
+        while True:
+          try:
+            result, error = result_queue.get(timeout=1)
+            break
+          except Empty:
+            if any(w.exitcode is not None for w in workers):
+              raise RuntimeError(
+                'An integration worker process exited unexpectedly')
+        num_in_flight -= 1
+        if error is not None:
+          raise RuntimeError(error)
+        callback(result)
+    except Exception:
+      for worker in workers:
+        worker.terminate()
+      raise
+    else:
+      for worker in workers:
+        task_queue.put(None)
+    finally:
+      for worker in workers:
+        worker.join()
+
+
+def _execute_dynamic_tasks(task_queue, result_queue):
+  '''
+  Execute tasks from the queue in a worker process until given None.
+
+  :param task_queue: The queue of tasks
+  :param result_queue: The queue to put the results on
+
+  '''
+  while True:
+    task = task_queue.get()
+    if task is None:
+      break
+    result_queue.put(_execute_parallel_task_and_catch(task))
+
+
+def _execute_parallel_task(task):
+  '''
+  Execute a task in a worker process.
+
+  :param task: The task to execute
+  :return: The result and the log messages
+
+  '''
+  from dials.util import log
+  import logging
+  log.config_simple_cached()
+  result = task()
+  handlers = logging.getLogger().handlers
+  assert len(handlers) == 1, "Invalid number of logging handlers"
+  return result, handlers[0].messages()
+
+
+def _execute_parallel_task_and_catch(task):
+  '''
+  Execute a task in a worker process and return any error as a string, so
+  that it can be passed back to the parent process with the results.
+
+  :param task: The task to execute
+  :return: The result and log messages, and the error message or None
+
+  '''
+  from traceback import format_exc
+  try:
+    return _execute_parallel_task(task), None
+  except Exception:
+    return None, format_exc()
+
 
 class Result(object):
   '''
@@ -295,6 +657,12 @@ class NullTask(object):
     '''
     result = Result(self.index, self.reflections, None)
     result.read_time = 0
+    result.read_wait_time = 0
+    result.num_read = 0
+    result.num_cached = 0
+    result.spill_size = 0
+    result.num_spilled = 0
+    result.num_shoeboxes = 0
     result.extract_time = 0
     result.process_time = 0
     result.total_time = 0
@@ -408,17 +776,29 @@ class Task(object):
     memory_info = machine_memory_info()
     total_memory = memory_info.memory_total()
     sbox_memory = processor.compute_max_memory_usage()
+    spill_filename = None
     if total_memory is not None:
       assert total_memory > 0, "Your system appears to have no memory!"
       assert self.params.block.max_memory_usage >  0.0, "maximum memory usage must be > 0"
       assert self.params.block.max_memory_usage <= 1.0, "maximum memory usage must be <= 1"
       limit_memory = total_memory * self.params.block.max_memory_usage
-      if sbox_memory > limit_memory:
+      if sbox_memory > limit_memory and self.can_spill():
+        spill_filename = self.create_spill_file()
+        spill_size = processor.spill(spill_filename, int(limit_memory))
+        info(' Memory usage:')
+        info('  Total system memory: %g GB' % (total_memory/1e9))
+        info('  Limit shoebox memory: %g GB' % (limit_memory/1e9))
+        info('  Required shoebox memory: %g GB' % (sbox_memory/1e9))
+        info('  Spilled %d shoeboxes (%g GB) to %s' % (
+          processor.num_spilled(), spill_size/1e9, spill_filename))
+        info('')
+      elif sbox_memory > limit_memory:
         raise RuntimeError('''
         There was a problem allocating memory for shoeboxes. Possible solutions
-        include increasing the percentage of memory allowed for shoeboxes or
-        decreasing the block size. This could also be caused by a highly mosaic
-        crystal model - is your crystal really this mosaic?
+        include increasing the percentage of memory allowed for shoeboxes,
+        decreasing the block size or setting a directory to spill shoeboxes
+        to. This could also be caused by a highly mosaic crystal model - is
+        your crystal really this mosaic?
           Total system memory: %g GB
           Limit shoebox memory: %g GB
           Required shoebox memory: %g GB
@@ -430,23 +810,27 @@ class Task(object):
         info('  Required shoebox memory: %g GB' % (sbox_memory/1e9))
         info('')
 
+    # Set the size of the image cache
+    image_cache.resize(int(self.params.block.max_image_cache_memory * 1e9))
+
     # Loop through the imageset, extract pixels and process reflections
-    read_time = 0.0
-    for i in range(len(imageset)):
-      st = time()
-      image = imageset.get_corrected_data(i)
-      mask = imageset.get_mask(i)
-      if self.params.lookup.mask is not None:
-        assert len(mask) == len(self.params.lookup.mask), \
-          "Mask/Image are incorrect size %d %d" % (
-            len(mask),
-            len(self.params.lookup.mask))
-        mask = tuple(m1 & m2 for m1, m2 in zip(self.params.lookup.mask, mask))
-
-      read_time += time() - st
-      processor.next(make_image(image, mask), self.executor)
-      del image
-      del mask
+    reader = ImageReader(imageset, frame0, self.params.block.read_ahead)
+    try:
+      for image, mask in reader:
+        if self.params.lookup.mask is not None:
+          assert len(mask) == len(self.params.lookup.mask), \
+            "Mask/Image are incorrect size %d %d" % (
+              len(mask),
+              len(self.params.lookup.mask))
+          mask = tuple(m1 & m2 for m1, m2 in zip(self.params.lookup.mask, mask))
+
+        processor.next(make_image(image, mask), self.executor)
+        del image
+        del mask
+    finally:
+      if spill_filename is not None:
+        processor.close_spill()
+        os.remove(spill_filename)
     assert processor.finished(), "Data processor is not finished"
 
     # Optionally save the shoeboxes
@@ -472,12 +856,45 @@ class Task(object):
 
     # Return the result
     result = Result(self.index, self.reflections, self.executor.data())
-    result.read_time = read_time
+    result.read_time = reader.read_time
+    result.read_wait_time = reader.wait_time
+    result.num_read = reader.num_read
+    result.num_cached = reader.num_cached
+    result.spill_size = processor.spill_size()
+    result.num_spilled = processor.num_spilled()
+    result.num_shoeboxes = len(self.reflections)
     result.extract_time = processor.extract_time()
     result.process_time = processor.process_time()
     result.total_time = time() - start_time
     return result
 
+  def can_spill(self):
+    '''
+    Check if shoeboxes can be spilled to file. Flattened shoeboxes and
+    shoeboxes saved for debugging have to be kept in memory.
+
+    :return: True/False shoeboxes can be spilled
+
+    '''
+    return (self.params.block.spill_directory is not None and
+            self.params.shoebox.flatten == False and
+            self.params.debug.output == False)
+
+  def create_spill_file(self):
+    '''
+    Create a uniquely named file in the spill directory
+
+    :return: The filename
+
+    '''
+    from tempfile import mkstemp
+    fd, filename = mkstemp(
+      suffix='.spill',
+      prefix='shoeboxes_%d_' % self.index,
+      dir=self.params.block.spill_directory)
+    os.close(fd)
+    return filename
+
 
 class Manager(object):
   '''
@@ -511,6 +928,9 @@ class Manager(object):
     # Set the finalized flag to False
     self.finalized = False
 
+    # Set whether the blocks are balanced by cost
+    self.balanced = False
+
     # Initialise the timing information
     self.time = TimingInfo()
 
@@ -581,6 +1001,12 @@ class Manager(object):
     self.data[result.index] = result.data
     self.manager.accumulate(result.index, result.reflections)
     self.time.read += result.read_time
+    self.time.read_wait += result.read_wait_time
+    self.time.num_read += result.num_read
+    self.time.num_cached += result.num_cached
+    self.time.spill += result.spill_size
+    self.time.num_spilled += result.num_spilled
+    self.time.num_shoeboxes += result.num_shoeboxes
     self.time.extract += result.extract_time
     self.time.process += result.process_time
     self.time.total += result.total_time
@@ -650,6 +1076,7 @@ class Manager(object):
         block_size = nframes[cutoff] * 2
         self.params.block.size = block_size
         self.params.block.units = 'frames'
+        self.balanced = self.params.block.auto_mode == 'cost'
 
   def compute_jobs(self):
     '''
@@ -674,6 +1101,7 @@ class Manager(object):
       if scan is not None:
         assert len(imgs) == len(scan), "Invalid scan range"
         array_range = scan.get_array_range()
+      self.time.num_frames += array_range[1] - array_range[0]
       if self.params.block.size is None:
         block_size_frames = array_range[1] - array_range[0]
       elif self.params.block.units == 'radians':
@@ -686,9 +1114,136 @@ class Manager(object):
         block_size_frames = int(ceil(self.params.block.size))
       else:
         raise RuntimeError('Unknown block_size_units = %s' % block_size_units)
-      self.jobs.add((i0, i1), array_range, block_size_frames)
+      if self.balanced:
+        self.jobs.add((i0, i1), array_range, self.compute_balanced_jobs(
+          i0, i1, array_range, block_size_frames, imgs.get_detector(),
+          max_memory=self.compute_max_job_memory()))
+      else:
+        self.jobs.add((i0, i1), array_range, block_size_frames)
     assert len(self.jobs) > 0, "Invalid number of jobs"
 
+  def compute_max_job_memory(self):
+    '''
+    Compute the shoebox memory available to each job when nproc jobs are
+    processed at once.
+
+    :return: The memory in bytes or None if the total memory is not known
+
+    '''
+    from libtbx.introspection import machine_memory_info
+    total_memory = machine_memory_info().memory_total()
+    if total_memory is None:
+      return None
+    limit_memory = total_memory * self.params.block.max_memory_usage
+    return limit_memory / self.params.mp.nproc
+
+  def compute_balanced_jobs(self,
+                            i0,
+                            i1,
+                            array_range,
+                            min_block_size,
+                            detector,
+                            max_memory=None,
+                            read_cost=0.02):
+    '''
+    Compute jobs which balance the cost of processing across the processors.
+
+    The cost of each frame is estimated as the number of shoebox pixels
+    recorded on the frame, which is proportional to the work done to extract
+    and process the reflections, plus the cost of reading the frame. The
+    frames are then divided into segments of approximately equal cost and
+    each job covers two adjacent segments so that, as with fixed size blocks,
+    adjacent jobs overlap by half. There are at least 2*nproc jobs, so the
+    dynamic scheduler can balance the load, and enough that the shoeboxes of
+    each job fit in the memory available to one process. Each segment covers
+    at least half the minimum block size.
+
+    :param i0: The first experiment in the group
+    :param i1: The last experiment in the group
+    :param array_range: The range of frames
+    :param min_block_size: The minimum block size in frames
+    :param detector: The detector model
+    :param max_memory: The maximum shoebox memory (in bytes) for each job
+    :param read_cost: The cost of reading a pixel relative to processing a
+                      shoebox pixel
+    :return: The list of job frame ranges
+
+    '''
+    from dials.array_family import flex
+    from scitbx.array_family import shared
+    from math import ceil
+    frame0, frame1 = array_range
+    nframes = frame1 - frame0
+
+    # The number of shoebox pixels on each frame is the cumulative sum of the
+    # area of the bounding boxes starting on each frame minus those ending
+    selection = (self.reflections['id'] >= i0) & (self.reflections['id'] < i1)
+    x0, x1, y0, y1, z0, z1 = self.reflections['bbox'].select(selection).parts()
+    z0.set_selected(z0 < frame0, frame0)
+    z1.set_selected(z1 > frame1, frame1)
+    selection = z1 > z0
+    area = ((x1 - x0) * (y1 - y0)).select(selection).as_double()
+    diff = [0] * (nframes + 1)
+    if len(area) > 0:
+      starts = flex.weighted_histogram(
+        z0.select(selection).as_double(), area,
+        data_min=frame0 - 0.5, data_max=frame1 + 0.5, n_slots=nframes + 1)
+      ends = flex.weighted_histogram(
+        z1.select(selection).as_double(), area,
+        data_min=frame0 - 0.5, data_max=frame1 + 0.5, n_slots=nframes + 1)
+      diff = starts.slots() - ends.slots()
+    pixels = []
+    current = 0
+    for f in range(nframes):
+      current += diff[f]
+      pixels.append(current)
+    npixels = sum(p.get_image_size()[0] * p.get_image_size()[1]
+                  for p in detector)
+    cost = [p + read_cost * npixels for p in pixels]
+
+    # Each job is two segments, so limit the shoebox memory of a segment to
+    # half that of a job. Use the bytes per pixel of the shoebox data,
+    # background and mask
+    bytes_per_pixel = 12
+    if max_memory is not None:
+      max_segment_pixels = max_memory / (2.0 * bytes_per_pixel)
+    else:
+      max_segment_pixels = None
+
+    # Choose the number of segments from the number of processors and the
+    # memory limit, keeping each segment at least half the minimum block size
+    min_size = max(1, int(ceil(min_block_size / 2.0)))
+    nsegments = 2 * self.params.mp.nproc + 1
+    if max_segment_pixels is not None:
+      nsegments = max(nsegments,
+                      int(ceil(sum(pixels) / max_segment_pixels)) + 1)
+    nsegments = min(nsegments, nframes // min_size)
+    if nsegments < 3:
+      return shared.tiny_int_2([(frame0, frame1)])
+
+    # Split into segments of equal cost, also ending a segment early if the
+    # next frame would take it over the memory limit
+    target = sum(cost) / nsegments
+    boundaries = [frame0]
+    accumulated = 0
+    segment_pixels = 0
+    for f in range(nframes):
+      accumulated += cost[f]
+      segment_pixels += pixels[f]
+      frame = frame0 + f + 1
+      over_memory = (max_segment_pixels is not None and f + 1 < nframes and
+                     segment_pixels + pixels[f+1] > max_segment_pixels)
+      if ((accumulated >= target * len(boundaries) or over_memory) and
+          frame - boundaries[-1] >= min_size and
+          frame1 - frame >= min_size):
+        boundaries.append(frame)
+        segment_pixels = 0
+    boundaries.append(frame1)
+    if len(boundaries) < 4:
+      return shared.tiny_int_2([(frame0, frame1)])
+    return shared.tiny_int_2([
+      (boundaries[i], boundaries[i+2]) for i in range(len(boundaries)-2)])
+
   def split_reflections(self):
     '''
     Split the reflections into partials or over job boundaries
@@ -727,6 +1282,7 @@ class Manager(object):
     from libtbx.introspection import machine_memory_info
     from math import floor
     from dials.array_family import flex
+    from logging import info
 
     # Set the memory usage per processor
     if (self.params.mp.method == 'multiprocessing' and self.params.mp.nproc > 1):
@@ -744,7 +1300,12 @@ class Manager(object):
         assert total_memory > 0, "Your system appears to have no memory!"
         limit_memory = total_memory * self.params.block.max_memory_usage
         njobs = int(floor(limit_memory / max_memory))
-        if njobs < 1:
+        if self.params.block.spill_directory is not None:
+          if njobs < self.params.mp.nproc:
+            info(' Shoeboxes exceeding the memory limit will be spilled to %s\n' % (
+              self.params.block.spill_directory))
+          self.params.block.max_memory_usage /= self.params.mp.nproc
+        elif njobs < 1:
           raise RuntimeError('''
             No enough memory to run integration jobs. Possible solutions
             include increasing the percentage of memory allowed for shoeboxes or
@@ -804,6 +1365,8 @@ class Manager(object):
     # The format string
     if self.params.block.size is None:
       block_size = "auto"
+    elif self.balanced:
+      block_size = "auto (balanced by cost, min %s)" % self.params.block.size
     else:
       block_size = str(self.params.block.size)
     fmt = (
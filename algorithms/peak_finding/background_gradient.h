@@ -0,0 +1,91 @@
+/*
+ * background_gradient.h
+ *
+ *  Copyright (C) 2026 Diamond Light Source
+ *
+ *  This code is distributed under the BSD license, a copy of which is
+ *  included in the root directory of this package.
+ */
+#ifndef DIALS_ALGORITHMS_PEAK_FINDING_BACKGROUND_GRADIENT_H
+#define DIALS_ALGORITHMS_PEAK_FINDING_BACKGROUND_GRADIENT_H
+
+#include <scitbx/vec2.h>
+#include <scitbx/matrix/inversion.h>
+#include <dials/array_family/scitbx_shared_and_versa.h>
+#include <dials/model/data/shoebox.h>
+#include <dials/error.h>
+
+namespace dials { namespace algorithms {
+
+  using scitbx::vec2;
+  using scitbx::matrix::inversion_in_place;
+  using dials::model::Shoebox;
+
+  /**
+   * Compute the gradient of a plane fitted to the background around each of a
+   * list of flattened shoeboxes. The background is taken as the pixels within
+   * buffer_size pixels of the shoebox edge whose values are strictly within
+   * the trusted range of the panel. The plane is fitted in the same way as
+   * the Linear2dModeller so the gradients are identical to fitting each
+   * shoebox in turn.
+   * @param shoeboxes The list of flattened shoeboxes
+   * @param trusted_range The trusted range for each panel
+   * @param buffer_size The number of pixels around the edge to use
+   * @returns The gradient in x and y for each shoebox
+   */
+  inline
+  af::shared< vec2<double> > background_gradients(
+      const af::const_ref< Shoebox<> > &shoeboxes,
+      const af::const_ref< vec2<double> > &trusted_range,
+      int buffer_size) {
+    DIALS_ASSERT(buffer_size >= 0);
+    af::shared< vec2<double> > result(shoeboxes.size());
+    for (std::size_t n = 0; n < shoeboxes.size(); ++n) {
+      const Shoebox<> &sbox = shoeboxes[n];
+      DIALS_ASSERT(sbox.panel < trusted_range.size());
+      DIALS_ASSERT(sbox.data.accessor()[0] == 1);
+      int ysize = sbox.data.accessor()[1];
+      int xsize = sbox.data.accessor()[2];
+      double tmin = trusted_range[sbox.panel][0];
+      double tmax = trusted_range[sbox.panel][1];
+
+      // Accumulate the normal equations from the background pixels
+      double A[9] = { 0, 0, 0, 0, 0, 0, 0, 0, 0 };
+      double B[3] = { 0, 0, 0 };
+      int count = 0;
+      for (int j = 0; j < ysize; ++j) {
+        bool jfg = j >= buffer_size && j < ysize - buffer_size;
+        for (int i = 0; i < xsize; ++i) {
+          if (jfg && i >= buffer_size && i < xsize - buffer_size) {
+            continue;
+          }
+          double p = (double)sbox.data(0, j, i);
+          if (p > tmin && p < tmax) {
+            double x = (i + 0.5);
+            double y = (j + 0.5);
+            A[0] += 1;
+            A[1] += x;
+            A[2] += y;
+            A[4] += x * x;
+            A[5] += x * y;
+            A[8] += y * y;
+            B[0] += p;
+            B[1] += x * p;
+            B[2] += y * p;
+            count++;
+          }
+        }
+      }
+      A[3] = A[1];
+      A[6] = A[2];
+      A[7] = A[5];
+      inversion_in_place(A, 3, B, 1);
+      DIALS_ASSERT(count > 3);
+      result[n] = vec2<double>(B[1], B[2]);
+    }
+    return result;
+  }
+
+}} // namespace dials::algorithms
+
+#endif /* DIALS_ALGORITHMS_PEAK_FINDING_BACKGROUND_GRADIENT_H */
@@ -10,6 +10,8 @@
  */
 #include <boost/python.hpp>
 #include <boost/python/def.hpp>
+#include <dials/algorithms/peak_finding/background_gradient.h>
+#include <dials/algorithms/peak_finding/hot_pixels.h>
 
 namespace dials { namespace algorithms { namespace boost_python {
 
@@ -17,6 +19,15 @@ namespace dials { namespace algorithms { namespace boost_python {
 
   BOOST_PYTHON_MODULE(dials_algorithms_peak_finding_ext)
   {
+    def("background_gradients", &background_gradients, (
+      arg("shoeboxes"),
+      arg("trusted_range"),
+      arg("buffer_size")));
+
+    def("mark_hot_pixels", &mark_hot_pixels, (
+      arg("mask"),
+      arg("shoeboxes"),
+      arg("panel")));
   }
 
 }}}
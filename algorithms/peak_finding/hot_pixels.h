@@ -0,0 +1,72 @@
+/*
+ * hot_pixels.h
+ *
+ *  Copyright (C) 2026 Diamond Light Source
+ *
+ *  This code is distributed under the BSD license, a copy of which is
+ *  included in the root directory of this package.
+ */
+#ifndef DIALS_ALGORITHMS_PEAK_FINDING_HOT_PIXELS_H
+#define DIALS_ALGORITHMS_PEAK_FINDING_HOT_PIXELS_H
+
+#include <dials/array_family/scitbx_shared_and_versa.h>
+#include <dials/model/data/shoebox.h>
+#include <dials/error.h>
+
+namespace dials { namespace algorithms {
+
+  using dials::model::Shoebox;
+
+  /**
+   * Mark the hot pixels in the mask for a panel. A pixel is hot if it has a
+   * non-zero mask value on every frame of one of the shoeboxes. Only
+   * shoeboxes on the given panel are used.
+   * @param mask The panel mask (hot pixels are set to false)
+   * @param shoeboxes The list of possible hot spots
+   * @param panel The panel number
+   * @returns The number of pixels newly marked as hot
+   */
+  inline
+  std::size_t mark_hot_pixels(
+      af::ref< bool, af::c_grid<2> > mask,
+      const af::const_ref< Shoebox<> > &shoeboxes,
+      std::size_t panel) {
+    std::size_t count = 0;
+    int height = mask.accessor()[0];
+    int width = mask.accessor()[1];
+    for (std::size_t n = 0; n < shoeboxes.size(); ++n) {
+      const Shoebox<> &sbox = shoeboxes[n];
+      if (sbox.panel != panel) {
+        continue;
+      }
+      DIALS_ASSERT(sbox.is_consistent());
+      int x0 = sbox.bbox[0];
+      int y0 = sbox.bbox[2];
+      std::size_t zsize = sbox.mask.accessor()[0];
+      std::size_t ysize = sbox.mask.accessor()[1];
+      std::size_t xsize = sbox.mask.accessor()[2];
+      for (std::size_t j = 0; j < ysize; ++j) {
+        for (std::size_t i = 0; i < xsize; ++i) {
+          bool hot = true;
+          for (std::size_t k = 0; k < zsize && hot; ++k) {
+            hot = sbox.mask(k, j, i) != 0;
+          }
+          if (hot) {
+            int y = y0 + (int)j;
+            int x = x0 + (int)i;
+            DIALS_ASSERT(y >= 0 && y < height);
+            DIALS_ASSERT(x >= 0 && x < width);
+            if (mask(y, x)) {
+              mask(y, x) = false;
+              count++;
+            }
+          }
+        }
+      }
+    }
+    return count;
+  }
+
+}} // namespace dials::algorithms
+
+#endif /* DIALS_ALGORITHMS_PEAK_FINDING_HOT_PIXELS_H */
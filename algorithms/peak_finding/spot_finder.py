@@ -22,7 +22,8 @@ class Extract(object):
                threshold_image,
                mask,
                max_strong_pixel_fraction,
-               region_of_interest):
+               region_of_interest,
+               incremental=False):
       '''
       Initialise with imageset and threshold function, both need to be picklable
       for this to be called using multiprocessing.
@@ -30,6 +31,7 @@ class Extract(object):
       :param imageset: The imageset to process
       :param threshold_image: The threshold algorithm
       :param mask: The mask to use
+      :param incremental: Label the spots as each image is added
 
       '''
       self.threshold_image = threshold_image
@@ -37,16 +39,22 @@ class Extract(object):
       self.mask = mask
       self.max_strong_pixel_fraction = max_strong_pixel_fraction
       self.region_of_interest = region_of_interest
+      self.incremental = incremental
       if self.mask is not None:
         detector = self.imageset.get_detector()
         assert(len(self.mask) == len(detector))
 
   def __call__(self, index):
       '''
-      Extract pixels from a block of images.
+      Extract pixels from a block of images. In incremental mode the spots
+      are labelled as each image is added and only the pixels of spots
+      which can still grow are kept. The spots which touch the first or last
+      image of the block are returned as pixel lists so that they can be
+      merged with the neighbouring blocks.
 
       :param index: The image indices to extract
-      :return: The extracted spots
+      :return: The list of pixel lists for each panel or, in incremental
+               mode, the spots and the list of pixel lists for each panel
 
       '''
       from dials.model.data import PixelList
@@ -66,10 +74,19 @@ class Extract(object):
       # Create the list of pixel lists
       plists = [PixelList(p.get_image_size()[::-1], startz)
         for p in self.imageset.get_detector()]
+      if self.incremental:
+        incremental = IncrementalExtractSpots(None, hold_first_frame=True)
+        shoeboxes = flex.shoebox()
 
       # Iterate through the range of images
       for ind in range(*index):
 
+        # In incremental mode each image gets new pixel lists
+        if self.incremental:
+          plists = [PixelList(
+            p.get_image_size()[::-1], startz + ind - index[0])
+            for p in self.imageset.get_detector()]
+
         # Get the image and mask
         image = self.imageset.get_corrected_data(ind)
         mask = self.imageset.get_mask(ind)
@@ -108,45 +125,92 @@ class Extract(object):
               ''' % (num_strong, max_strong))
           pl.add_image(im, threshold_mask)
 
+        # Label the spots and keep the ones which can no longer grow
+        if self.incremental:
+          shoeboxes.extend(incremental.add_pixels(plists))
+
       # Return the pixel lists
+      if self.incremental:
+        return shoeboxes, incremental.finish_pixel_lists()
       return plists
 
 
-class ProgressUpdater(object):
+class PixelListMerger(object):
   '''
-  Class to update the progress bar from multi processing callback.
+  Class to merge the pixel lists for blocks of images which arrive in any
+  order. The pixel lists for adjacent blocks are merged as soon as both are
+  available, so the lists are reduced as the blocks are processed rather
+  than all being held until the end.
 
   '''
 
-  def __init__(self, total):
+  def __init__(self):
     '''
-    Initialise the progress bar.
+    Initialise the merger.
 
-    :param total: The total to count up to
+    '''
+    self._by_start = {}
+    self._by_end = {}
 
+  def add(self, index, plists):
     '''
-    from dials.util.command_line import ProgressBar
-    self.total = total
-    self.num = 0
-    self.progress = ProgressBar(title='Extracting strong pixels from images')
+    Add the pixel lists for a block of images.
 
-  def __call__(self, result):
+    :param index: The range of image indices in the block
+    :param plists: The list of pixel lists for each panel
+
+    '''
+    start, end = index
+    if start in self._by_end:
+      prev_start = self._by_end.pop(start)
+      prev_end, prev_plists = self._by_start.pop(prev_start)
+      plists = self._merge(prev_plists, plists)
+      start = prev_start
+    if end in self._by_start:
+      next_end, next_plists = self._by_start.pop(end)
+      del self._by_end[next_end]
+      plists = self._merge(plists, next_plists)
+      end = next_end
+    self._by_start[start] = (end, plists)
+    self._by_end[end] = start
+
+  def finish(self):
     '''
-    Update the progress bar.
+    :return: The merged list of pixel lists for each panel
 
-    :param result: The result
+    '''
+    assert len(self._by_start) == 1, "Blocks of images are not contiguous"
+    return self._by_start.values()[0][1]
 
+  def _merge(self, plists1, plists2):
     '''
-    self.num += 1
-    percent = 100.0 * (self.num+1) / self.total
-    self.progress.update(percent)
+    Merge the pixel lists for two adjacent blocks.
+
+    '''
+    from dials.array_family import flex
+    assert len(plists1) == len(plists2), "Inconsistent number of panels"
+    return [flex.pixel_list([p1, p2]).merge()
+            for p1, p2 in zip(plists1, plists2)]
+
+
+# The extract function for each worker process
+_extract_function = None
 
-  def finished(self):
-     '''
-     Finish the progress bar.
+def _initialise_extract(function):
+  '''
+  Set the extract function in a worker process. This is done once per
+  process so the imageset is not sent with every block of images.
+
+  '''
+  global _extract_function
+  _extract_function = function
 
-     '''
-     self.progress.finished('Extracted strong pixels from images')
+def _extract_block(index):
+  '''
+  Extract the pixels from a block of images in a worker process.
+
+  '''
+  return index, _extract_function(index)
 
 
 class ExtractSpots(object):
@@ -161,7 +225,9 @@ class ExtractSpots(object):
                mp_method='multiprocessing',
                nproc=1,
                max_strong_pixel_fraction=0.1,
-               region_of_interest=None):
+               region_of_interest=None,
+               block_size=None,
+               incremental=False):
     '''
     Initialise the class with the strategy
 
@@ -170,6 +236,8 @@ class ExtractSpots(object):
     :param mp_method: The multi processing method
     :param nproc: The number of processors
     :param max_strong_pixel_fraction: The maximum number of strong pixels
+    :param block_size: The number of images in each block of work
+    :param incremental: Label spots image by image to bound the memory
 
     '''
     # Set the required strategies
@@ -179,6 +247,8 @@ class ExtractSpots(object):
     self.nproc = nproc
     self.max_strong_pixel_fraction = max_strong_pixel_fraction
     self.region_of_interest = region_of_interest
+    self.block_size = block_size
+    self.incremental = incremental
 
   def __call__(self, imageset):
     '''
@@ -188,47 +258,74 @@ class ExtractSpots(object):
     :return: The list of spot shoeboxes
 
     '''
-    from dials.util.command_line import Command
     from dials.array_family import flex
     from dxtbx.imageset import ImageSweep
     from libtbx import easy_mp
     from logging import info
+    from math import ceil
 
     # Change the number of processors if necessary
     nproc = self.nproc
     if nproc > len(imageset):
       nproc = len(imageset)
 
+    # Split the images into small blocks so the work is balanced between
+    # the processes. By default there are about 4 blocks per process.
+    if nproc == 1:
+      nblocks = 1
+    elif self.block_size is None:
+      nblocks = min(4 * nproc, len(imageset))
+    else:
+      nblocks = int(ceil(len(imageset) / self.block_size))
+      nblocks = max(nproc, min(nblocks, len(imageset)))
+    blocks = self._calculate_blocks(imageset, nblocks)
+
+    # In incremental mode the spots in 3D are labelled as each image is
+    # added, so only the pixels of spots which can still grow are held
+    if isinstance(imageset, ImageSweep):
+      twod = False
+    else:
+      twod = True
+    incremental = self.incremental and not twod
+
     # Extract the pixels in blocks of images in parallel
     info("Extracting strong pixels from images (may take a while)")
-    pl = easy_mp.parallel_map(
-      func=Extract(
-        imageset,
-        self.threshold_image,
-        self.mask,
-        self.max_strong_pixel_fraction,
-        self.region_of_interest),
-      iterable=self._calculate_blocks(imageset, nproc),
-      processes=nproc,
-      method=self.mp_method,
-      preserve_order=True,
-      asynchronous=False)
+    function = Extract(
+      imageset,
+      self.threshold_image,
+      self.mask,
+      self.max_strong_pixel_fraction,
+      self.region_of_interest,
+      incremental=incremental)
+    merger = PixelListMerger()
+    shoeboxes = flex.shoebox()
+    def add_result(index, result):
+      if incremental:
+        spots, result = result
+        shoeboxes.extend(spots)
+      merger.add(index, result)
+    if len(blocks) == 1:
+      add_result(blocks[0], function(blocks[0]))
+    elif self.mp_method == 'multiprocessing':
+      self._extract_dynamic(function, blocks, nproc, add_result)
+    else:
+      for index, result in zip(blocks, easy_mp.parallel_map(
+          func=function,
+          iterable=blocks,
+          processes=nproc,
+          method=self.mp_method,
+          preserve_order=True,
+          asynchronous=False)):
+        add_result(index, result)
+    pl = merger.finish()
     info("Extracted strong pixels from images")
-
-    # Merge pixel lists into a single list for each panel
-    len_pl = sum(len(p) for p in pl)
-    info('Merging {0} pixel lists'.format(len_pl))
-    pl = [flex.pixel_list(p).merge() for p in zip(*pl)]
     np = sum([len(p.values()) for p in pl])
-    info('Merged {0} pixel lists with {1} pixels'.format(len_pl, np))
+    info('Merged {0} blocks of images with {1} pixels'.format(len(blocks), np))
+    if incremental:
+      info('Labelled {0} spots while extracting'.format(len(shoeboxes)))
 
     # Extract the pixel lists into a list of reflections
     info('Extracting spots')
-    shoeboxes = flex.shoebox()
-    if isinstance(imageset, ImageSweep):
-      twod = False
-    else:
-      twod = True
     for i, p in enumerate(pl):
       if p.num_pixels() > 0:
         shoeboxes.extend(flex.shoebox(p, i, 0, twod))
@@ -237,6 +334,33 @@ class ExtractSpots(object):
     # Return the shoeboxes
     return shoeboxes
 
+  def _extract_dynamic(self, function, blocks, nproc, callback):
+    '''
+    Extract the pixels from the blocks of images using a pool of processes.
+    Each process takes the next block when it finishes the last, and the
+    result for each block is passed to the callback as soon as it returns.
+
+    :param function: The extract function
+    :param blocks: The list of blocks of images
+    :param nproc: The number of processes
+    :param callback: The function to call with each block and result
+
+    '''
+    from multiprocessing import Pool
+    pool = Pool(
+      processes=nproc,
+      initializer=_initialise_extract,
+      initargs=(function,))
+    try:
+      for index, result in pool.imap_unordered(_extract_block, blocks):
+        callback(index, result)
+      pool.close()
+    except Exception:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+
   def _calculate_blocks(self, imageset, nblocks):
     '''
     Calculate the blocks.
@@ -262,6 +386,236 @@ class ExtractSpots(object):
     return [(i, j) for i, j in zip(blocks[0:-1], blocks[1:])]
 
 
+class IncrementalExtractSpots(object):
+  '''
+  Class to find spots in a sweep one image at a time. The strong pixels from
+  each new image are merged with the pixels of the spots which are still open
+  (i.e. which have pixels on the last image) and the spots whose extent in z
+  has closed are returned. This gives the same spots as labelling the whole
+  sweep at once but only needs the open spots to be kept in memory.
+
+  '''
+
+  def __init__(self,
+               threshold_image,
+               mask=None,
+               max_strong_pixel_fraction=0.1,
+               region_of_interest=None,
+               hold_first_frame=False):
+    '''
+    Initialise the class with the strategy
+
+    :param threshold_image: The image thresholding strategy
+    :param mask: The mask to use
+    :param max_strong_pixel_fraction: The maximum number of strong pixels
+    :param region_of_interest: The region of interest to look for spots
+    :param hold_first_frame: Keep the spots on the first frame open
+
+    '''
+    self.threshold_image = threshold_image
+    self.mask = mask
+    self.max_strong_pixel_fraction = max_strong_pixel_fraction
+    self.region_of_interest = region_of_interest
+    self.hold_first_frame = hold_first_frame
+    self.first_frame = None
+    self.pixels = None
+    self.held = None
+
+  def add_image(self, imageset, index):
+    '''
+    Threshold an image and merge the strong pixels into the open spots.
+
+    :param imageset: The imageset containing the image
+    :param index: The index of the image in the imageset
+    :return: The shoeboxes of the spots closed by this image
+
+    '''
+    plists = Extract(
+      imageset,
+      self.threshold_image,
+      self.mask,
+      self.max_strong_pixel_fraction,
+      self.region_of_interest)((index, index+1))
+    return self.add_pixels(plists)
+
+  def add_pixels(self, plists):
+    '''
+    Merge pixel lists for the next frames into the open spots.
+
+    :param plists: The list of pixel lists for each panel
+    :return: The shoeboxes of the spots which have been closed
+
+    '''
+    from dials.array_family import flex
+    from dials.model.data import PixelList
+    if self.pixels is None:
+      self.pixels = [PixelList(p.size(), p.first_frame()) for p in plists]
+      self.held = [None for p in plists]
+      self.first_frame = plists[0].first_frame()
+    assert len(plists) == len(self.pixels), "Inconsistent number of panels"
+    shoeboxes = flex.shoebox()
+    for i in range(len(plists)):
+      pl = flex.pixel_list([self.pixels[i], plists[i]]).merge()
+      closed, self.pixels[i] = self._split(pl, i)
+      shoeboxes.extend(closed)
+    return shoeboxes
+
+  def finish(self):
+    '''
+    Close all the open spots.
+
+    :return: The shoeboxes of the spots which were open
+
+    '''
+    from dials.array_family import flex
+    shoeboxes = flex.shoebox()
+    if self.pixels is not None:
+      for i in range(len(self.pixels)):
+        pl = self._all_pixels(i)
+        if pl.num_pixels() > 0:
+          shoeboxes.extend(flex.shoebox(pl, i, 0, False))
+    self.pixels = None
+    self.held = None
+    return shoeboxes
+
+  def finish_pixel_lists(self):
+    '''
+    Get the pixels of the open spots without labelling them, so that they
+    can be merged with the pixels from the neighbouring frames.
+
+    :return: The list of pixel lists for each panel, covering all the frames
+             which were added
+
+    '''
+    assert self.pixels is not None, "No frames have been added"
+    result = [self._all_pixels(i) for i in range(len(self.pixels))]
+    self.pixels = None
+    self.held = None
+    return result
+
+  def get_state(self):
+    '''
+    Get the state of the extraction, so it can be saved and resumed later.
+
+    :return: A dictionary of the open and held pixels and the first frame
+
+    '''
+    return {
+      'first_frame' : self.first_frame,
+      'pixels'      : self.pixels,
+      'held'        : self.held,
+    }
+
+  def set_state(self, state):
+    '''
+    Resume the extraction from a saved state.
+
+    :param state: The state returned by get_state
+
+    '''
+    self.first_frame = state['first_frame']
+    self.pixels = state['pixels']
+    self.held = state['held']
+
+  def num_open_pixels(self):
+    '''
+    :return: The number of pixels in the open spots
+
+    '''
+    if self.pixels is None:
+      return 0
+    num = sum(pl.num_pixels() for pl in self.pixels)
+    num += sum(len(h[0]) for h in self.held if h is not None)
+    return num
+
+  def _all_pixels(self, panel):
+    '''
+    Get a pixel list of the held and open spots on a panel, covering all the
+    frames which were added.
+
+    :param panel: The panel number
+    :return: The pixel list
+
+    '''
+    from dials.array_family import flex
+    from dials.model.data import PixelList
+    pl = self.pixels[panel]
+    frame_range = (self.first_frame, pl.last_frame())
+    if self.held[panel] is None:
+      return PixelList(pl.size(), frame_range, pl.values(), pl.coords())
+
+    # Put the pixels back in frame order
+    values = self.held[panel][0].deep_copy()
+    coords = self.held[panel][1].deep_copy()
+    values.extend(pl.values())
+    coords.extend(pl.coords())
+    z = coords.as_vec3_double().parts()[0]
+    perm = flex.sort_permutation(z, stable=True)
+    return PixelList(pl.size(), frame_range,
+                     values.select(perm), coords.select(perm))
+
+  def _split(self, pl, panel):
+    '''
+    Split the pixels into closed spots and a pixel list of the open spots.
+    When holding the first frame, the pixels of closed spots on the first
+    frame are moved to the held pixels, so they are not labelled again.
+
+    :param pl: The pixel list
+    :param panel: The panel number
+    :return: The closed shoeboxes and the pixel list of open spots
+
+    '''
+    from dials.array_family import flex
+    from dials.model.data import PixelList
+    if pl.num_pixels() == 0:
+      return flex.shoebox(), PixelList(pl.size(), pl.last_frame())
+    shoeboxes = flex.shoebox(pl, panel, 0, False)
+    z0, z1 = shoeboxes.bounding_boxes().parts()[4:6]
+    is_open = z1 == pl.last_frame()
+    is_closed = ~is_open
+    labels = pl.labels_3d().as_size_t()
+    if self.hold_first_frame:
+      is_held = is_closed & (z0 == self.first_frame)
+      if is_held.count(True) > 0:
+        pixel_is_held = is_held.select(labels)
+        values = pl.values().select(pixel_is_held)
+        coords = pl.coords().select(pixel_is_held)
+        if self.held[panel] is None:
+          self.held[panel] = (values, coords)
+        else:
+          self.held[panel][0].extend(values)
+          self.held[panel][1].extend(coords)
+        is_closed = is_closed & ~is_held
+    if is_open.count(True) == 0:
+      return (
+        shoeboxes.select(is_closed),
+        PixelList(pl.size(), pl.last_frame()))
+    pixel_is_open = is_open.select(labels)
+    coords = pl.coords().select(pixel_is_open)
+    values = pl.values().select(pixel_is_open)
+    frame_range = (coords[0][0], pl.last_frame())
+    return (
+      shoeboxes.select(is_closed),
+      PixelList(pl.size(), frame_range, values, coords))
+
+
+def template_filename(template, number):
+  '''
+  Get the filename for an image number from a template.
+
+  :param template: The filename template (e.g. image_####.cbf)
+  :param number: The image number
+  :return: The filename
+
+  '''
+  i1 = template.rfind('#') + 1
+  i0 = i1
+  while i0 > 0 and template[i0-1] == '#':
+    i0 -= 1
+  assert i1 > 0, "Invalid template: %s" % template
+  return '%s%0*d%s' % (template[:i0], i1 - i0, number, template[i1:])
+
+
 class SpotFinder(object):
   '''
   A class to do spot finding and filtering.
@@ -269,13 +623,14 @@ class SpotFinder(object):
   '''
 
   def __init__(self, find_spots=None, filter_spots=None, scan_range=None,
-               write_hot_mask=True):
+               write_hot_mask=True, follow=None):
     '''
     Initialise the class.
 
     :param find_spots: The spot finding algorithm
     :param filter_spots: The spot filtering algorithm
     :param scan_range: The scan range to find spots over
+    :param follow: The parameters for following a sweep being collected
 
     '''
 
@@ -285,6 +640,7 @@ class SpotFinder(object):
     self.filter_spots = filter_spots
     self.scan_range = scan_range
     self.write_hot_mask = write_hot_mask
+    self.follow = follow
 
   def __call__(self, datablock):
     '''
@@ -300,17 +656,31 @@ class SpotFinder(object):
 
     # Loop through all the imagesets and find the strong spots
     reflections = flex.reflection_table()
-    for i, imageset in enumerate(datablock.extract_imagesets()):
+    imagesets = datablock.extract_imagesets()
+    hot_masks = []
+    for i, imageset in enumerate(imagesets):
 
       # Find the strong spots in the sweep
       info('-' * 80)
       info('Finding strong spots in imageset %d' % i)
       info('-' * 80)
-      table, hot_mask = self._find_in_imageset(imageset)
+      if self.follow is not None and self.follow.enable:
+        table, hot_mask, sweep = self._follow_imageset(imageset)
+        if sweep is not imageset:
+          self._replace_imageset(datablock, i, sweep)
+          imagesets[i] = sweep
+      else:
+        table, hot_mask = self._find_in_imageset(imageset)
       table['id'] = flex.size_t(table.nrows(), i)
       reflections.extend(table)
+      hot_masks.append(hot_mask)
 
-      if self.write_hot_mask:
+    if self.write_hot_mask:
+
+      # Combine the hot masks once all imagesets have been processed so the
+      # result does not depend on the order of the imagesets
+      hot_masks = self._combine_hot_masks(imagesets, hot_masks)
+      for i, (imageset, hot_mask) in enumerate(zip(imagesets, hot_masks)):
         if imageset.external_lookup.mask.data is not None:
           and_mask = []
           for m1, m2 in zip(imageset.external_lookup.mask.data, hot_mask):
@@ -339,7 +709,6 @@ class SpotFinder(object):
 
     '''
     from dials.array_family import flex
-    from dials.util.command_line import Command
     from dxtbx.imageset import ImageSweep
     from logging import info
 
@@ -370,6 +739,21 @@ class SpotFinder(object):
     # Get the list of shoeboxes
     shoeboxes = flex.shoebox(spots_all)
 
+    # Compute the observations and filter the spots
+    return self._process_shoeboxes(imageset, shoeboxes)
+
+  def _process_shoeboxes(self, imageset, shoeboxes):
+    '''
+    Compute the observations from the shoeboxes and filter the spots.
+
+    :param imageset: The imageset
+    :param shoeboxes: The spot shoeboxes
+    :return: The observed spots
+
+    '''
+    from dials.array_family import flex
+    from logging import info
+
     # Calculate the spot centroids
     info('Calculating {0} spot centroids'.format(len(shoeboxes)))
     centroid = shoeboxes.centroid_valid()
@@ -384,9 +768,10 @@ class SpotFinder(object):
     observed = flex.observation(shoeboxes.panels(), centroid, intensity)
 
     if self.write_hot_mask:
+      from dials.algorithms.peak_finding import mark_hot_pixels
+
       # Find spots which cover the whole scan range
-      bbox = flex.int6([sbox.bbox for sbox in shoeboxes])
-      z0, z1 = bbox.parts()[4:6]
+      z0, z1 = shoeboxes.bounding_boxes().parts()[4:6]
       zr = z1 - z0
       assert zr.all_gt(0)
       possible_hot_spots = (zr == len(imageset))
@@ -396,17 +781,12 @@ class SpotFinder(object):
       # Create the hot pixel mask
       hot_mask = tuple(flex.bool(flex.grid(p.get_image_size()[::-1]), True)
                        for p in imageset.get_detector())
+      num_hot_pixels = 0
       if num_possible_hot_spots > 0:
         hot_shoeboxes = shoeboxes.select(possible_hot_spots)
-        for sbox in hot_shoeboxes:
-          x0, x1, y0, y1 = sbox.bbox[0:4]
-          m = sbox.mask
-          p = sbox.panel
-          for y in range(m.all()[1]):
-            for x in range(m.all()[2]):
-              if m[:,y:y+1,x:x+1].all_ne(0):
-                hot_mask[p][y0+y,x0+x] = False
-      info('Found %d possible hot pixel(s)' % hot_mask.count(False))
+        for p, m in enumerate(hot_mask):
+          num_hot_pixels += mark_hot_pixels(m, hot_shoeboxes, p)
+      info('Found %d possible hot pixel(s)' % num_hot_pixels)
 
     else:
       hot_mask = None
@@ -421,3 +801,207 @@ class SpotFinder(object):
 
     # Return as a reflection list
     return flex.reflection_table(observed, shoeboxes), hot_mask
+
+  def _combine_hot_masks(self, imagesets, hot_masks):
+    '''
+    Combine the hot pixel masks of all imagesets on the same detector.
+
+    A pixel is hot if it is masked in any sweep of more than one image on
+    that detector. In a single image every spot covers the whole scan range,
+    so the masks from single images are ignored; a single image on a
+    detector with no other sweeps gets an empty hot mask.
+
+    :param imagesets: The list of imagesets
+    :param hot_masks: The hot pixel mask for each imageset
+    :return: The combined hot pixel mask for each imageset
+
+    '''
+    from dials.array_family import flex
+    from logging import info
+
+    # Combine the masks from the multi-image sweeps on each detector
+    combined = []
+    for imageset, hot_mask in zip(imagesets, hot_masks):
+      if len(imageset) <= 1:
+        continue
+      detector = imageset.get_detector()
+      for i, (d, m) in enumerate(combined):
+        if d == detector:
+          assert len(m) == len(hot_mask), "Inconsistent number of panels"
+          combined[i] = (d, tuple(m1 & m2 for m1, m2 in zip(m, hot_mask)))
+          break
+      else:
+        combined.append((detector, hot_mask))
+    for d, m in combined:
+      info('%d hot pixel(s) found on detector' % sum(
+        mm.count(False) for mm in m))
+
+    # Get the combined mask for each imageset
+    result = []
+    for imageset, hot_mask in zip(imagesets, hot_masks):
+      detector = imageset.get_detector()
+      for d, m in combined:
+        if d == detector:
+          result.append(m)
+          break
+      else:
+        result.append(tuple(flex.bool(m.accessor(), True) for m in hot_mask))
+    return result
+
+  def _follow_imageset(self, imageset):
+    '''
+    Do the spot finding on a sweep which is still being collected. Images are
+    processed as they appear and the spots are closed as soon as they have no
+    pixels on the latest image. Spot finding stops when no new image has
+    appeared within the timeout. If a checkpoint file is given, the state is
+    written to it periodically and spot finding resumes from it on restart.
+
+    :param imageset: The sweep to process
+    :return: The observed spots, the hot mask and the sweep covering all the
+             images processed
+
+    '''
+    from dials.array_family import flex
+    from dxtbx.imageset import ImageSweep
+    from logging import info
+    import cPickle as pickle
+    import os
+
+    if not isinstance(imageset, ImageSweep):
+      raise RuntimeError('Following images is only supported for sweeps')
+
+    # Create the incremental spot extractor
+    extract = IncrementalExtractSpots(
+      self.find_spots.threshold_image,
+      mask=self.find_spots.mask,
+      max_strong_pixel_fraction=self.find_spots.max_strong_pixel_fraction,
+      region_of_interest=self.find_spots.region_of_interest)
+
+    # Resume from the checkpoint if there is one
+    template = imageset.get_template()
+    first, last = imageset.get_scan().get_image_range()
+    shoeboxes = flex.shoebox()
+    next_image = first
+    checkpoint = self.follow.checkpoint
+    if checkpoint is not None and os.path.exists(checkpoint):
+      with open(checkpoint, 'rb') as infile:
+        state = pickle.load(infile)
+      if state['template'] != template:
+        raise RuntimeError('Checkpoint %s is for %s not %s' % (
+          checkpoint, state['template'], template))
+      next_image = state['next_image']
+      shoeboxes = state['shoeboxes']
+      extract.set_state(state['extract'])
+      info('Resuming spot finding from image %d using %s' % (
+        next_image, checkpoint))
+
+    def write_checkpoint():
+      state = {
+        'template'   : template,
+        'next_image' : next_image,
+        'shoeboxes'  : shoeboxes,
+        'extract'    : extract.get_state(),
+      }
+      with open(checkpoint + '.tmp', 'wb') as outfile:
+        pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+      os.rename(checkpoint + '.tmp', checkpoint)
+
+    # Process the images as they appear
+    info('\nFollowing images from {0}...'.format(template))
+    for number, sweep, index in self._follow_images(imageset, next_image):
+      closed = extract.add_image(sweep, index)
+      shoeboxes.extend(closed)
+      next_image = number + 1
+      info('Image %d: %d spots closed, %d pixels in open spots' % (
+        number, len(closed), extract.num_open_pixels()))
+      if (checkpoint is not None and
+          (next_image - first) % self.follow.checkpoint_interval == 0):
+        write_checkpoint()
+    if checkpoint is not None:
+      write_checkpoint()
+
+    # Close all the remaining spots
+    shoeboxes.extend(extract.finish())
+    info('Found {0} spots in images {1} to {2}'.format(
+      len(shoeboxes), first, next_image - 1))
+
+    # Get a sweep covering all the images
+    if next_image - 1 > last:
+      imageset = self._make_sweep(imageset, [
+        template_filename(template, i) for i in range(first, next_image)])
+
+    # Compute the observations and filter the spots
+    table, hot_mask = self._process_shoeboxes(imageset, shoeboxes)
+    return table, hot_mask, imageset
+
+  def _follow_images(self, imageset, start):
+    '''
+    Iterate through the images of the sweep and then through any new images
+    matching the sweep template as they are written.
+
+    :param imageset: The sweep
+    :param start: The image number to start from
+    :return: A generator yielding the image number, a sweep and the index of
+             the image in that sweep
+
+    '''
+    from time import sleep
+    import os
+    first, last = imageset.get_scan().get_image_range()
+    template = imageset.get_template()
+    number = start
+    while number <= last:
+      yield number, imageset, number - first
+      number += 1
+    waited = 0
+    last_size = None
+    while True:
+      filename = template_filename(template, number)
+      size = os.path.getsize(filename) if os.path.exists(filename) else None
+
+      # Only read the image once the file has stopped growing
+      if size is not None and size > 0 and size == last_size:
+        yield number, self._make_sweep(imageset, [filename]), 0
+        number += 1
+        waited = 0
+        last_size = None
+        continue
+      if waited >= self.follow.timeout:
+        break
+      last_size = size
+      sleep(self.follow.poll_interval)
+      waited += self.follow.poll_interval
+
+  def _replace_imageset(self, datablock, index, sweep):
+    '''
+    Replace an imageset in the datablock with the sweep extended by following
+    new images, so the datablock which is saved covers all the images.
+
+    :param datablock: The datablock
+    :param index: The index of the imageset in the datablock
+    :param sweep: The extended sweep
+
+    '''
+    assert index < len(datablock._imagesets), "Invalid imageset index"
+    datablock._imagesets[index] = sweep
+
+  def _make_sweep(self, imageset, filenames):
+    '''
+    Make a sweep from some image files, using the external lookups from
+    the original sweep.
+
+    :param imageset: The original sweep
+    :param filenames: The image filenames
+    :return: The new sweep
+
+    '''
+    from dxtbx.imageset import ImageSetFactory
+    sweeps = ImageSetFactory.new(filenames)
+    assert len(sweeps) == 1, "Images do not form a single sweep"
+    sweep = sweeps[0]
+    for name in ['mask', 'gain', 'pedestal']:
+      lookup1 = getattr(imageset.external_lookup, name)
+      lookup2 = getattr(sweep.external_lookup, name)
+      lookup2.data = lookup1.data
+      lookup2.filename = lookup1.filename
+    return sweep
@@ -39,6 +39,52 @@ def generate_phil_scope():
       .type = ints(size=2)
       .multiple = True
 
+    block_size = None
+      .type = int(value_min=1)
+      .help = "The number of images in each block of work when extracting"
+              "strong pixels in parallel. Blocks are handed to the processes"
+              "as they become free. By default there are about 4 blocks per"
+              "process."
+      .expert_level = 1
+
+    incremental = False
+      .type = bool
+      .help = "Label the spots in 3D as each image is added rather than"
+              "after all the images in a block have been read. Only the"
+              "pixels of spots which can still grow are held, so memory is"
+              "bounded by the spots in the current window of images rather"
+              "than the whole block. Useful for data with many strong pixels"
+              "(e.g. ice rings)."
+      .expert_level = 1
+
+    follow
+      .help = "Parameters for finding spots on a sweep while it is being"
+              "collected. Each image is processed as soon as it is written"
+              "and spots are completed as soon as their extent in z is closed."
+      .expert_level = 1
+    {
+      enable = False
+        .type = bool
+        .help = "Follow new images matching the sweep template"
+
+      timeout = 60
+        .type = float(value_min=0)
+        .help = "Stop when no new image has appeared for this many seconds"
+
+      poll_interval = 1
+        .type = float(value_min=0)
+        .help = "The time in seconds between checks for new images"
+
+      checkpoint = None
+        .type = path
+        .help = "A file in which to save the state so that spot finding"
+                "resumes from the last checkpoint if restarted"
+
+      checkpoint_interval = 10
+        .type = int(value_min=1)
+        .help = "The number of images between checkpoints"
+    }
+
     region_of_interest = None
       .type = ints(size=4)
       .help = "A region of interest to look for spots."
@@ -430,153 +476,60 @@ class BackgroundGradientFilter(object):
 
   def run(self, flags, sweep=None, shoeboxes=None, **kwargs):
     from dials.array_family import flex
-    from dials.algorithms.shoebox import MaskCode
-    from dials.algorithms.background.simple import Linear2dModeller
-    bg_code = MaskCode.Valid | MaskCode.BackgroundUsed
-    fg_code = MaskCode.Valid | MaskCode.Foreground
-    strong_code = MaskCode.Valid | MaskCode.Strong
-
-    modeller = Linear2dModeller()
-    expanded_shoeboxes = flex.shoebox()
-    detector = sweep.get_detector()
+    from dials.algorithms.peak_finding import background_gradients
 
-    zoffset = 0
-    if sweep.get_scan() is not None:
-      zoffset = sweep.get_scan().get_array_range()[0]
-
-    from libtbx.containers import OrderedDict
-    class image_data_cache(object):
-      def __init__(self, imageset, size=10):
-        self.imageset = imageset
-        self.size = size
-        self._image_data = OrderedDict()
-
-      def __getitem__(self, i):
-        image_data = self._image_data.get(i)
-        if image_data is None:
-          image_data = self.imageset[i]
-          if len(self._image_data) >= self.size:
-            # remove the oldest entry in the cache
-            del self._image_data[self._image_data.keys()[0]]
-          self._image_data[i] = image_data
-        return image_data
-
-    cache = image_data_cache(sweep)
-    #cache = sweep
-
-    # sort shoeboxes by centroid z
-    frame = shoeboxes.centroid_all().position_frame()
-    perm = flex.sort_permutation(frame)
-    shoeboxes = shoeboxes.select(perm)
+    detector = sweep.get_detector()
     buffer_size = 1
     bg_plus_buffer = self.background_size + buffer_size
 
-    import time
-    t0 = time.time()
-    for i, shoebox in enumerate(shoeboxes):
-      if not flags[perm[i]]:
-        continue
-      panel = detector[shoebox.panel]
-      trusted_range = panel.get_trusted_range()
-      max_x, max_y = panel.get_image_size()
-      bbox = shoebox.bbox
-      x1, x2, y1, y2, z1, z2 = bbox
-      # expand the bbox with a background region around the spotfinder shoebox
-      # perhaps also should use a buffer zone between the shoebox and the
-      # background region
-      expanded_bbox = (max(0, x1-bg_plus_buffer),
-                       min(max_x, x2+bg_plus_buffer),
-                       max(0, y1-bg_plus_buffer),
-                       min(max_y, y2+bg_plus_buffer),
-                       z1, z2)
-      shoebox.bbox = expanded_bbox
-    t1 = time.time()
-    info("Time expand_shoebox: %s" %(t1-t0))
-
+    # Only the spots which have not already been rejected are tested
+    selection = flags.iselection()
+    if len(selection) == 0:
+      return flags
+    panels = shoeboxes.panels().select(selection)
+    x1, x2, y1, y2, z1, z2 = shoeboxes.bounding_boxes().select(
+      selection).parts()
+
+    # Get the image size and trusted range of the panel for each spot
+    max_x = flex.int(len(panels), 0)
+    max_y = flex.int(len(panels), 0)
+    trusted_range = flex.vec2_double()
+    for i, panel in enumerate(detector):
+      on_panel = panels == i
+      max_x.set_selected(on_panel, panel.get_image_size()[0])
+      max_y.set_selected(on_panel, panel.get_image_size()[1])
+      trusted_range.append(panel.get_trusted_range())
+
+    # Expand the bboxes with a background region around the spotfinder
+    # shoeboxes, clipped to the panel
+    x1 = x1 - bg_plus_buffer
+    x1.set_selected(x1 < 0, 0)
+    y1 = y1 - bg_plus_buffer
+    y1.set_selected(y1 < 0, 0)
+    x2 = x2 + bg_plus_buffer
+    outside = x2 > max_x
+    x2.set_selected(outside, max_x.select(outside))
+    y2 = y2 + bg_plus_buffer
+    outside = y2 > max_y
+    y2.set_selected(outside, max_y.select(outside))
+
+    # Extract the pixels of the expanded shoeboxes from the images
     rlist = flex.reflection_table()
-    rlist['shoebox'] = shoeboxes
+    rlist['panel'] = panels
+    rlist['bbox'] = flex.int6(x1, x2, y1, y2, z1, z2)
+    rlist['shoebox'] = flex.shoebox(rlist['panel'], rlist['bbox'])
     rlist['shoebox'].allocate()
-    rlist['panel'] = shoeboxes.panels()
-    rlist['bbox'] = shoeboxes.bounding_boxes()
-
-    t0 = time.time()
     rlist.extract_shoeboxes(sweep)
-    t1 = time.time()
-
-    shoeboxes = rlist['shoebox']
-    shoeboxes.flatten()
-
-    t0 = time.time()
-    for i, shoebox in enumerate(shoeboxes):
-      if not flags[perm[i]]: continue
-      panel = detector[shoebox.panel]
-      trusted_range = panel.get_trusted_range()
-      max_x, max_y = panel.get_image_size()
-      ex1, ex2, ey1, ey2, ez1, ez2 = shoebox.bbox
-      data = shoebox.data
-      mask = flex.bool(data.accessor(), False)
-      for i_y, y in enumerate(range(ey1, ey2)):
-        for i_x, x in enumerate(range(ex1, ex2)):
-          value = data[0, i_y, i_x]
-          if (y >= (ey1+buffer_size) and y < (ey2-buffer_size) and
-              x >= (ex1+buffer_size) and x < (ex2-buffer_size)):
-            mask[0, i_y, i_x] = False # foreground
-          elif (value > trusted_range[0] and value < trusted_range[1]):
-            mask[0, i_y, i_x] = True # background
-
-      model = modeller.create(data.as_double(), mask)
-      d, a, b = model.params()[:3]
-      c = -1
-
-      if abs(a) > self.gradient_cutoff or abs(b) > self.gradient_cutoff:
-        flags[perm[i]] = False
-
-      # FIXME should this commented out section be removed?
-      #if abs(a) < self.gradient_cutoff and abs(b) < self.gradient_cutoff:
-        #flags[i] = False
-
-      #if x2-x1 > 10 or y2-y1 > 10:
-        #print a, b, d, flags[perm[i]]
-        #bg = flex.double(data.accessor())
-        #for x in range(ex2-ex1):
-          #for y in range(ey2-ey1):
-            #z = a * x + b * y + d
-            #bg[0,y,x] = z
-
-        #model = modeller.create(data-bg, mask)
-        #d, a, b = model.params()[:3]
-        #c = -1
-
-        #bg2 = flex.double(data.accessor())
-        #for x in range(ex2-ex1):
-          #for y in range(ey2-ey1):
-            #z = a * x + b * y + d
-            #bg2[0,y,x] = z
-        ##print a, b, d
-
-        #from matplotlib import pyplot
-        #fig, axes = pyplot.subplots(nrows=1, ncols=5)
-        #im0 = axes[0].imshow(data.as_numpy_array()[i_z,:,:], interpolation='none')
-        #im1 = axes[1].imshow(mask.as_numpy_array()[i_z,:,:], interpolation='none')
-        #im2 = axes[2].imshow(bg.as_numpy_array()[i_z,:,:], interpolation='none')
-        #im3 = axes[3].imshow((data-bg).as_numpy_array()[i_z,:,:], interpolation='none')
-        #im4 = axes[4].imshow(bg2.as_numpy_array()[i_z,:,:], interpolation='none')
-        ##pyplot.colorbar(im0)
-        ##pyplot.colorbar(im1)
-        ##pyplot.colorbar(im2)
-        ##pyplot.colorbar(im3)
-        #pyplot.show()
-
-      #from matplotlib import pyplot
-      #fig, axes = pyplot.subplots(nrows=1, ncols=2)
-      #im0 = axes[0].imshow(data.as_numpy_array()[i_z,:,:], interpolation='none')
-      #im1 = axes[1].imshow(bg.as_numpy_array()[i_z,:,:], interpolation='none')
-      #pyplot.colorbar(im1)
-      #pyplot.show()
-
-    t1 = time.time()
-    #print "Time fit_bg: %s" %(t1-t0)
-
+    expanded_shoeboxes = rlist['shoebox']
+    expanded_shoeboxes.flatten()
+
+    # Fit a plane to the background of all the shoeboxes and reject the
+    # spots where the gradient is too large
+    gx, gy = background_gradients(
+      expanded_shoeboxes, trusted_range, buffer_size).parts()
+    reject = ((flex.abs(gx) > self.gradient_cutoff) |
+              (flex.abs(gy) > self.gradient_cutoff))
+    flags.set_selected(selection.select(reject), False)
     return flags
 
   def __call__(self, flags, **kwargs):
@@ -596,6 +549,38 @@ class SpotDensityFilter(object):
     self.nbins = nbins
     self.gradient_cutoff = gradient_cutoff
 
+  @staticmethod
+  def in_dense_bins(obs_x, obs_y, dense, xedges, yedges):
+    '''
+    Select the spots which lie inside a dense histogram bin. The bin of each
+    spot is looked up once, rather than selecting the spots for each dense
+    bin in turn. Spots lying exactly on a bin edge are not inside any bin.
+
+    :param obs_x: The spot x coordinates
+    :param obs_y: The spot y coordinates
+    :param dense: The 2D numpy array of dense bins
+    :param xedges: The histogram bin edges in x
+    :param yedges: The histogram bin edges in y
+    :return: A flex.bool array, True for spots in dense bins
+
+    '''
+    import numpy as np
+    from scitbx.array_family import flex
+    x = obs_x.as_numpy_array()
+    y = obs_y.as_numpy_array()
+    nx = len(xedges) - 1
+    ny = len(yedges) - 1
+    ix = np.searchsorted(xedges, x, side='left') - 1
+    iy = np.searchsorted(yedges, y, side='left') - 1
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    ix = np.clip(ix, 0, nx - 1)
+    iy = np.clip(iy, 0, ny - 1)
+    inside &= (x > xedges[ix]) & (x < xedges[ix+1])
+    inside &= (y > yedges[iy]) & (y < yedges[iy+1])
+    dense = np.zeros((nx, ny), dtype=bool) | np.asarray(dense, dtype=bool)
+    selection = inside & dense[ix, iy]
+    return flex.bool(selection.tolist())
+
   def run(self, flags, sweep=None, observations=None, **kwargs):
     obs_x, obs_y = observations.centroids().px_position_xy().parts()
 
@@ -629,13 +614,8 @@ class SpotDensityFilter(object):
           g < self.gradient_cutoff and gradients[i-1] < self.gradient_cutoff):
         cutoff = hist.slot_centers()[i-1]-0.5*hist.slot_width()
 
-    H_flex = flex.double(np.ascontiguousarray(H))
-    isel = (H_flex > cutoff).iselection()
-    sel = np.column_stack(np.where(H > cutoff))
-    for (ix, iy) in sel:
-      flags.set_selected(
-        ((obs_x > xedges[ix]) & (obs_x < xedges[ix+1]) &
-         (obs_y > yedges[iy]) & (obs_y < yedges[iy+1])), False)
+    flags.set_selected(
+      self.in_dense_bins(obs_x, obs_y, H > cutoff, xedges, yedges), False)
 
     if 0:
       from matplotlib import pyplot
@@ -715,7 +695,22 @@ class SpotFinderFactory(object):
       find_spots=find_spots,
       filter_spots=filter_spots,
       scan_range=params.spotfinder.scan_range,
-      write_hot_mask=params.spotfinder.write_hot_mask)
+      write_hot_mask=params.spotfinder.write_hot_mask,
+      follow=params.spotfinder.follow)
+
+  @staticmethod
+  def default_min_spot_size(detector):
+    '''
+    Get the minimum spot size to use when the parameter is Auto
+
+    :param detector: The detector model
+    :returns: The minimum spot size for the detector type
+
+    '''
+    if detector[0].get_type() == 'SENSOR_PAD':
+      # smaller default value for pixel array detectors
+      return 3
+    return 6
 
   @staticmethod
   def configure_algorithm(params):
@@ -738,7 +733,9 @@ class SpotFinderFactory(object):
       mp_method=params.spotfinder.mp.method,
       nproc=params.spotfinder.mp.nproc,
       max_strong_pixel_fraction=params.spotfinder.filter.max_strong_pixel_fraction,
-      region_of_interest=params.spotfinder.region_of_interest)
+      region_of_interest=params.spotfinder.region_of_interest,
+      block_size=params.spotfinder.block_size,
+      incremental=params.spotfinder.incremental)
 
   @staticmethod
   def configure_threshold(params):
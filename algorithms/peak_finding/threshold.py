@@ -97,8 +97,8 @@ class XDSThresholdStrategy(ThresholdStrategy):
     self._min_count   = kwargs.get('min_count', 2)
     self._threshold   = kwargs.get('global_threshold', None)
 
-    # Save the constant gain
-    self._gain_map = None
+    # Save the constant gain maps for each image size
+    self._gain_map = {}
 
     # Create a buffer
     self.algorithm = {}
@@ -129,15 +129,19 @@ class XDSThresholdStrategy(ThresholdStrategy):
       self.algorithm[image.all()] = algorithm
 
     # Set the gain
+    gain_map = None
     if self._gain is not None:
       assert(self._gain > 0)
-      self._gain_map = flex.double(image.accessor(), self._gain)
-      self._gain = None
+      try:
+        gain_map = self._gain_map[image.all()]
+      except KeyError:
+        gain_map = flex.double(image.accessor(), self._gain)
+        self._gain_map[image.all()] = gain_map
 
     # Compute the threshold
     result = flex.bool(flex.grid(image.all()))
-    if self._gain_map:
-      algorithm(image, mask, self._gain_map, result)
+    if gain_map is not None:
+      algorithm(image, mask, gain_map, result)
     else:
       algorithm(image, mask, result)
 
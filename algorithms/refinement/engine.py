@@ -14,6 +14,7 @@ are the current concrete implementations"""
 from __future__ import division
 from logging import info, debug
 
+from math import sqrt
 from scitbx import lbfgs
 from scitbx.array_family import flex
 import libtbx
@@ -282,6 +283,11 @@ class Refinery(object):
     self._nproc = nproc
     return
 
+  def set_accumulate_normal_matrix(self, accumulate):
+    """to be implemented only by derived classes that solve normal equations"""
+
+    raise NotImplementedError()
+
   def run(self):
     """
     To be implemented by derived class. It is expected that each step of
@@ -423,6 +429,51 @@ class LBFGScurvs(AdaptLbfgs):
     return self._f, self._g, diags
 
 
+# The refinery whose target and prediction parameterisation are used by the
+# persistent worker processes. This is set before the workers are started, so
+# they inherit it when they are forked and it is never pickled
+_pool_refinery = None
+
+def _pool_worker(conn, ipart, npart):
+  """Worker process for the persistent pool of AdaptLstbx. The worker's copy
+  of the reflection manager is cut down to a fixed partition of the managed
+  reflections, so each worker only predicts its own reflections. Outlier
+  rejection has already been done when the target was constructed, so the
+  partition does not change during refinement. For each parameter vector x
+  received, the normal equations for the partition are sent back with the
+  residuals reduced to their weighted sum of squares and number, so only
+  O(nparam^2) data is returned. A parameter vector of None stops the worker"""
+
+  refinery = _pool_refinery
+  manager = refinery._target._reflection_manager
+  nobs = len(manager.get_obs())
+  manager.filter_obs(flex.size_t(range(ipart, nobs, npart)))
+
+  while True:
+    x = conn.recv()
+    if x is None: break
+    try:
+      refinery.x = x
+      refinery.prepare_for_step()
+      nparam = len(x)
+      sum_wr2 = 0.0
+      nelem = 0
+      normal_matrix = flex.double(nparam * (nparam + 1) // 2, 0.0)
+      jtwr = flex.double(nparam, 0.0)
+      if refinery._target.get_num_matches() > 0:
+        for block in refinery._target.split_matches_into_blocks():
+          r, w, nm, v = refinery._target.compute_normal_equations(block)
+          sum_wr2 += flex.sum(w * r * r)
+          nelem += len(r)
+          normal_matrix += nm
+          jtwr += v
+      conn.send((sum_wr2, nelem, normal_matrix, jtwr))
+    except Exception:
+      import traceback
+      conn.send(RuntimeError(traceback.format_exc()))
+  conn.close()
+  return
+
 class AdaptLstbx(
     Refinery,
     normal_eqns.non_linear_ls,
@@ -446,10 +497,76 @@ class AdaptLstbx(
 
     normal_eqns.non_linear_ls.__init__(self, n_parameters = len(self._parameters))
 
+    # by default, build the Jacobian for each block of reflections
+    self._accumulate_normal_matrix = False
+
+    # persistent pool of worker processes, used if nproc > 1, as a list of
+    # (process, connection) pairs
+    self._pool = None
+
   def set_nproc(self, nproc):
     self._nproc = nproc
     return
 
+  def set_accumulate_normal_matrix(self, accumulate):
+    """if accumulate is True, build_up forms the normal equations directly
+    from the gradients of each parameter rather than building the Jacobian
+    for each block of reflections. This uses much less memory for jobs with
+    many parameters, but means parameter correlations cannot be tracked"""
+
+    self._accumulate_normal_matrix = accumulate
+    return
+
+  def add_normal_equations(self, residuals, weights, normal_matrix, jtwr):
+    """add the contribution from a block of reflections, in the form returned
+    by Target.compute_normal_equations, to the normal equations. This has the
+    same effect as add_equations with the corresponding Jacobian"""
+
+    # the objective and number of equations
+    self.add_residuals(residuals, weights)
+    self._add_normal_matrix_and_rhs(normal_matrix, jtwr)
+
+    return
+
+  def add_reduced_normal_equations(self, sum_wr2, nelem, normal_matrix, jtwr):
+    """add the contribution from a block of reflections to the normal
+    equations, where the residuals have been reduced to their weighted sum of
+    squares, sum_wr2, and number, nelem"""
+
+    # an equivalent set of residuals, giving the same objective and number of
+    # equations
+    residuals = flex.double(nelem, 0.0)
+    weights = flex.double(nelem, 1.0)
+    if nelem > 0: residuals[0] = sqrt(sum_wr2)
+    self.add_residuals(residuals, weights)
+    self._add_normal_matrix_and_rhs(normal_matrix, jtwr)
+
+    return
+
+  def _add_normal_matrix_and_rhs(self, normal_matrix, jtwr):
+
+    # the diagonal of the normal matrix and the right hand side, which is
+    # -J^T.W.r, are added through one equation for each parameter
+    n = len(self.x)
+    ls = self.step_equations()
+    diag = flex.size_t([i * n - (i * (i - 1)) // 2 for i in range(n)])
+    for i, k in enumerate(diag):
+      w = normal_matrix[k]
+      if w == 0.0: continue
+      row = flex.double(n, 0.0)
+      row[i] = 1.0
+      ls.add_equation(right_hand_side=-jtwr[i] / w,
+                      design_matrix_row=row,
+                      weight=w)
+
+    # the off-diagonal elements are added to the normal matrix in place
+    off_diagonal = normal_matrix.deep_copy()
+    off_diagonal.set_selected(diag, 0.0)
+    a = self.normal_matrix_packed_u()
+    a += off_diagonal
+
+    return
+
   def restart(self):
     self.x = self.x_0.deep_copy()
     self.old_x = None
@@ -466,54 +583,113 @@ class AdaptLstbx(
     # observations... See http://en.wikipedia.org/wiki/Non-linear_least_squares
     # at 'diagonal weight matrix'
 
-    # set current parameter values
-    self.prepare_for_step()
+    # send the current parameter values to the persistent workers, if any,
+    # so they predict their partitions while the full set is predicted here.
+    # The connections are kept until the reply from each worker is received
+    use_pool = self._nproc > 1 and not objective_only
+    pending = []
+    if use_pool:
+      for process, conn in self._get_pool():
+        conn.send(self.x)
+        pending.append(conn)
+
+    completed = False
+    try:
 
-    # Reset the state to construction time, i.e. no equations accumulated
-    self.reset()
+      # set current parameter values
+      self.prepare_for_step()
 
-    if objective_only:
-      residuals, weights = self._target.compute_residuals()
-      self.add_residuals(residuals, weights)
-    else:
-      blocks = self._target.split_matches_into_blocks(nproc = self._nproc)
+      # Reset the state to construction time, i.e. no equations accumulated
+      self.reset()
 
-      if self._nproc > 1:
+      if objective_only:
+        residuals, weights = self._target.compute_residuals()
+        self.add_residuals(residuals, weights)
+      elif use_pool:
 
         # ensure the jacobian is not tracked
         self._jacobian = None
 
-        # processing functions
-        def task_wrapper(block):
-          residuals, jacobian, weights = \
-            self._target.compute_residuals_and_gradients(block)
-          return dict(residuals=residuals,
-                      jacobian=jacobian,
-                      weights=weights)
-        def callback_wrapper(result):
-          self.add_equations(result['residuals'],
-                             result['jacobian'],
-                             result['weights'])
-          # no longer need the result
-          result['residuals'] = None
-          result['jacobian'] = None
-          result['weights'] = None
-          return
-
-        task_results = easy_mp.parallel_map(
-          func=task_wrapper,
-          iterable=blocks,
-          processes=self._nproc,
-          callback=callback_wrapper,
-          method="multiprocessing",
-          #preserve_exception_message=True
-          )
+        # the workers return the normal equations for their partitions
+        # reduced to O(nparam^2)
+        while len(pending) > 0:
+          conn = pending.pop(0)
+          try:
+            result = conn.recv()
+          except EOFError:
+            result = RuntimeError("A refinement worker process was lost")
+          if isinstance(result, Exception):
+            raise result
+          self.add_reduced_normal_equations(*result)
 
       else:
-        for block in blocks:
-          residuals, self._jacobian, weights = \
-            self._target.compute_residuals_and_gradients(block)
-          self.add_equations(residuals, self._jacobian, weights)
+        blocks = self._target.split_matches_into_blocks(nproc = self._nproc)
+
+        if self._accumulate_normal_matrix:
+
+          # the jacobian is never built
+          self._jacobian = None
+
+          for block in blocks:
+            self.add_normal_equations(
+              *self._target.compute_normal_equations(block))
+
+        else:
+          for block in blocks:
+            residuals, self._jacobian, weights = \
+              self._target.compute_residuals_and_gradients(block)
+            self.add_equations(residuals, self._jacobian, weights)
+      completed = True
+
+    finally:
+
+      # if an exception was raised, receive the replies still outstanding so
+      # none is read as the result of a later step, then shut the workers down
+      for conn in pending:
+        try:
+          conn.recv()
+        except (EOFError, IOError):
+          pass
+      if use_pool and not completed:
+        self.close_pool()
+    return
+
+  def _get_pool(self):
+    """return the persistent pool of worker processes, starting them if
+    necessary. Each worker is given a fixed partition of the managed
+    reflections. The workers are forked with a copy of this refinery, so must
+    be started after the target and parameterisation are fully set up"""
+
+    global _pool_refinery
+    if self._pool is None:
+      import multiprocessing
+      _pool_refinery = self
+      self._pool = []
+      for ipart in range(self._nproc):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_pool_worker,
+          args=(child_conn, ipart, self._nproc))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._pool.append((process, parent_conn))
+    return self._pool
+
+  def close_pool(self):
+    """shut down the persistent pool of worker processes, if there is one"""
+
+    global _pool_refinery
+    if self._pool is not None:
+      for process, conn in self._pool:
+        try:
+          conn.send(None)
+        except IOError:
+          pass
+        conn.close()
+      for process, conn in self._pool:
+        process.join()
+      self._pool = None
+      _pool_refinery = None
     return
 
   def step_forward(self):
@@ -530,6 +706,9 @@ class AdaptLstbx(
   def finalise(self):
     """perform various post-run tasks"""
 
+    # the worker processes are no longer needed
+    self.close_pool()
+
     # it is possible to get here with zero steps taken by the minimiser. For
     # example by failing for the MAX_TRIAL_ITERATIONS reason before any forward
     # steps are taken with the LevMar engine. If so the below is invalid,
@@ -597,77 +776,83 @@ class GaussNewtonIterations(AdaptLstbx, normal_eqns_solving.iterations):
     libtbx.adopt_optional_init_args(self, kwds)
 
   def run(self):
-    self.n_iterations = 0
+    try:
+      self.n_iterations = 0
+
+      # prepare for first step
+      self.build_up()
 
-    # prepare for first step
-    self.build_up()
+      # return early if refinement is not possible
+      if self.dof < 1:
+        self.history.reason_for_termination = DOF_TOO_LOW
+        return
 
-    # return early if refinement is not possible
-    if self.dof < 1:
-      self.history.reason_for_termination = DOF_TOO_LOW
-      return
+      while True:
 
-    while True:
+        # set functional and gradients for the step (to add to the history)
+        self._f = self.objective()
+        self._g = -self.opposite_of_gradient()
 
-      # set functional and gradients for the step (to add to the history)
-      self._f = self.objective()
-      self._g = -self.opposite_of_gradient()
+        # cache some items for the journal prior to solve
+        pvn = self.parameter_vector_norm()
+        gn = self.opposite_of_gradient().norm_inf()
 
-      # cache some items for the journal prior to solve
-      pvn = self.parameter_vector_norm()
-      gn = self.opposite_of_gradient().norm_inf()
+        # debugging
+        #if self._verbosity > 3: self._print_normal_matrix()
 
-      # debugging
-      #if self._verbosity > 3: self._print_normal_matrix()
+        # solve the normal equations
+        self.solve()
 
-      # solve the normal equations
-      self.solve()
+        # standard journalling
+        self.update_journal()
+        debug("Step %d", self.history.get_nrows() - 1)
 
-      # standard journalling
-      self.update_journal()
-      debug("Step %d", self.history.get_nrows() - 1)
+        # add cached items to the journal
+        self.history.set_last_cell("parameter_vector_norm", pvn)
+        self.history.set_last_cell("gradient_norm", gn)
 
-      # add cached items to the journal
-      self.history.set_last_cell("parameter_vector_norm", pvn)
-      self.history.set_last_cell("gradient_norm", gn)
+        # extra journalling post solve
+        if self.history.has_key("solution"):
+          self.history.set_last_cell("solution", self.actual.step().deep_copy())
+        self.history.set_last_cell("solution_norm", self.step().norm())
+        self.history.set_last_cell("reduced_chi_squared", self.chi_sq())
 
-      # extra journalling post solve
-      if self.history.has_key("solution"):
-        self.history.set_last_cell("solution", self.actual.step().deep_copy())
-      self.history.set_last_cell("solution_norm", self.step().norm())
-      self.history.set_last_cell("reduced_chi_squared", self.chi_sq())
+        # test termination criteria
+        if self.test_for_termination():
+          self.history.reason_for_termination = TARGET_ACHIEVED
+          break
 
-      # test termination criteria
-      if self.test_for_termination():
-        self.history.reason_for_termination = TARGET_ACHIEVED
-        break
+        if self.test_rmsd_convergence():
+          self.history.reason_for_termination = RMSD_CONVERGED
+          break
+
+        if self.had_too_small_a_step():
+          self.history.reason_for_termination = STEP_TOO_SMALL
+          break
 
-      if self.test_rmsd_convergence():
-        self.history.reason_for_termination = RMSD_CONVERGED
-        break
+        if self.test_objective_increasing_but_not_nref():
+          self.history.reason_for_termination = OBJECTIVE_INCREASE
+          if self.step_backward():
+            self.history.reason_for_termination += ". Parameters set back one step"
+          self.prepare_for_step()
+          break
 
-      if self.had_too_small_a_step():
-        self.history.reason_for_termination = STEP_TOO_SMALL
-        break
+        if self.n_iterations == self._max_iterations:
+          self.history.reason_for_termination = MAX_ITERATIONS
+          break
 
-      if self.test_objective_increasing_but_not_nref():
-        self.history.reason_for_termination = OBJECTIVE_INCREASE
-        if self.step_backward():
-          self.history.reason_for_termination += ". Parameters set back one step"
-        self.prepare_for_step()
-        break
+        # prepare for next step
+        self.step_forward()
+        self.n_iterations += 1
+        self.build_up()
 
-      if self.n_iterations == self._max_iterations:
-        self.history.reason_for_termination = MAX_ITERATIONS
-        break
+      self.cf = self.step_equations().cholesky_factor_packed_u()
+      self.finalise()
 
-      # prepare for next step
-      self.step_forward()
-      self.n_iterations += 1
-      self.build_up()
+    finally:
 
-    self.cf = self.step_equations().cholesky_factor_packed_u()
-    self.finalise()
+      # the worker processes are shut down however refinement ends
+      self.close_pool()
 
     return
 
@@ -685,105 +870,110 @@ class LevenbergMarquardtIterations(GaussNewtonIterations):
       self._mu = value
 
   def run(self):
+    try:
+      # add an attribute to the journal
+      self.history.add_column("mu")
+      self.history.add_column("nu")
+
+      #FIXME need a much neater way of doing this stuff through
+      #inheritance
+      # set max iterations if not already.
+      if self._max_iterations is None:
+        self._max_iterations = 20
+
+      self.n_iterations = 0
+      nu = 2
+      self.build_up()
 
-    # add an attribute to the journal
-    self.history.add_column("mu")
-    self.history.add_column("nu")
+      # return early if refinement is not possible
+      if self.dof < 1:
+        self.history.reason_for_termination = DOF_TOO_LOW
+        return
 
-    #FIXME need a much neater way of doing this stuff through
-    #inheritance
-    # set max iterations if not already.
-    if self._max_iterations is None:
-      self._max_iterations = 20
+      a = self.normal_matrix_packed_u()
+      self.mu = self.tau*flex.max(a.matrix_packed_u_diagonal())
 
-    self.n_iterations = 0
-    nu = 2
-    self.build_up()
+      while True:
 
-    # return early if refinement is not possible
-    if self.dof < 1:
-      self.history.reason_for_termination = DOF_TOO_LOW
-      return
+        # set functional and gradients for the step
+        self._f = self.objective()
+        self._g = -self.opposite_of_gradient()
 
-    a = self.normal_matrix_packed_u()
-    self.mu = self.tau*flex.max(a.matrix_packed_u_diagonal())
-
-    while True:
-
-      # set functional and gradients for the step
-      self._f = self.objective()
-      self._g = -self.opposite_of_gradient()
-
-      # cache some items for the journal prior to solve
-      pvn = self.parameter_vector_norm()
-      gn = self.opposite_of_gradient().norm_inf()
-
-      # debugging
-      #if self._verbosity > 3: self._print_normal_matrix()
-
-      a.matrix_packed_u_diagonal_add_in_place(self.mu)
-
-      # solve the normal equations
-      self.solve()
-
-      # keep the cholesky factor for ESD calculation if we end this step. Doing
-      # it here ensures the normal equations are solved (cholesky_factor_packed_u
-      # can only be called if that is the case)
-      self.cf = self.step_equations().cholesky_factor_packed_u().deep_copy()
-
-      # standard journalling
-      self.update_journal()
-      debug("Step %d", self.history.get_nrows() - 1)
-
-      # add cached items to the journal
-      self.history.set_last_cell("parameter_vector_norm", pvn)
-      self.history.set_last_cell("gradient_norm", gn)
-
-      # extra journalling post solve
-      self.history.set_last_cell("mu", self.mu)
-      self.history.set_last_cell("nu", nu)
-      if self.history.has_key("solution"):
-        self.history.set_last_cell("solution", self.actual.step().deep_copy())
-      self.history.set_last_cell("solution_norm", self.step().norm())
-      self.history.set_last_cell("reduced_chi_squared", self.chi_sq())
-
-      # test termination criteria before taking the next forward step
-      if self.had_too_small_a_step():
-        self.history.reason_for_termination = STEP_TOO_SMALL
-        break
-      if self.test_for_termination():
-        self.history.reason_for_termination = TARGET_ACHIEVED
-        break
-      if self.test_rmsd_convergence():
-        self.history.reason_for_termination = RMSD_CONVERGED
-        break
-      if self.n_iterations == self._max_iterations:
-        self.history.reason_for_termination = MAX_ITERATIONS
-        break
-
-      h = self.step()
-      expected_decrease = 0.5*h.dot(self.mu*h - self._g)
-      self.step_forward()
-      self.n_iterations += 1
-      self.build_up(objective_only=True)
-      objective_new = self.objective()
-      actual_decrease = self._f - objective_new
-      rho = actual_decrease/expected_decrease
-      if rho > 0:
-        self.mu *= max(1/3, 1 - (2*rho - 1)**3)
-        nu = 2
-      else:
-        self.step_backward()
-        self.history.del_last_row()
-        if nu >= 8192:
-          self.history.reason_for_termination = MAX_TRIAL_ITERATIONS
-          break
-        self.mu *= nu
-        nu *= 2
+        # cache some items for the journal prior to solve
+        pvn = self.parameter_vector_norm()
+        gn = self.opposite_of_gradient().norm_inf()
 
-      # prepare for next step
-      self.build_up()
+        # debugging
+        #if self._verbosity > 3: self._print_normal_matrix()
+
+        a.matrix_packed_u_diagonal_add_in_place(self.mu)
+
+        # solve the normal equations
+        self.solve()
+
+        # keep the cholesky factor for ESD calculation if we end this step. Doing
+        # it here ensures the normal equations are solved (cholesky_factor_packed_u
+        # can only be called if that is the case)
+        self.cf = self.step_equations().cholesky_factor_packed_u().deep_copy()
+
+        # standard journalling
+        self.update_journal()
+        debug("Step %d", self.history.get_nrows() - 1)
+
+        # add cached items to the journal
+        self.history.set_last_cell("parameter_vector_norm", pvn)
+        self.history.set_last_cell("gradient_norm", gn)
+
+        # extra journalling post solve
+        self.history.set_last_cell("mu", self.mu)
+        self.history.set_last_cell("nu", nu)
+        if self.history.has_key("solution"):
+          self.history.set_last_cell("solution", self.actual.step().deep_copy())
+        self.history.set_last_cell("solution_norm", self.step().norm())
+        self.history.set_last_cell("reduced_chi_squared", self.chi_sq())
+
+        # test termination criteria before taking the next forward step
+        if self.had_too_small_a_step():
+          self.history.reason_for_termination = STEP_TOO_SMALL
+          break
+        if self.test_for_termination():
+          self.history.reason_for_termination = TARGET_ACHIEVED
+          break
+        if self.test_rmsd_convergence():
+          self.history.reason_for_termination = RMSD_CONVERGED
+          break
+        if self.n_iterations == self._max_iterations:
+          self.history.reason_for_termination = MAX_ITERATIONS
+          break
 
-    self.finalise()
+        h = self.step()
+        expected_decrease = 0.5*h.dot(self.mu*h - self._g)
+        self.step_forward()
+        self.n_iterations += 1
+        self.build_up(objective_only=True)
+        objective_new = self.objective()
+        actual_decrease = self._f - objective_new
+        rho = actual_decrease/expected_decrease
+        if rho > 0:
+          self.mu *= max(1/3, 1 - (2*rho - 1)**3)
+          nu = 2
+        else:
+          self.step_backward()
+          self.history.del_last_row()
+          if nu >= 8192:
+            self.history.reason_for_termination = MAX_TRIAL_ITERATIONS
+            break
+          self.mu *= nu
+          nu *= 2
+
+        # prepare for next step
+        self.build_up()
+
+      self.finalise()
+
+    finally:
+
+      # the worker processes are shut down however refinement ends
+      self.close_pool()
 
     return
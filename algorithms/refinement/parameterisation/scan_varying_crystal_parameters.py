@@ -66,9 +66,6 @@ class ScanVaryingCrystalOrientationParameterisation(ScanVaryingModelParameterisa
   def compose(self, t):
     """calculate state and derivatives for model at image number t"""
 
-    # Extract orientation from the initial state
-    U0 = self._initial_state
-
     # extract parameter sets from the internal list
     phi1_set, phi2_set, phi3_set = self._param
 
@@ -83,6 +80,23 @@ class ScanVaryingCrystalOrientationParameterisation(ScanVaryingModelParameterisa
     dphi2_dp = [e / phi2_sumweights for e in phi2_weights]
     dphi3_dp = [e / phi3_sumweights for e in phi3_weights]
 
+    self._compose_core((phi1, phi2, phi3), (dphi1_dp, dphi2_dp, dphi3_dp))
+
+    return
+
+  def _compose_core(self, vals, dvals_dp):
+    """calculate state and derivatives given the smoothed angles and their
+    derivatives wrt the underlying parameters"""
+
+    # Extract orientation from the initial state
+    U0 = self._initial_state
+
+    # extract parameter sets from the internal list
+    phi1_set, phi2_set, phi3_set = self._param
+
+    phi1, phi2, phi3 = vals
+    dphi1_dp, dphi2_dp, dphi3_dp = dvals_dp
+
     # convert angles to radians
     phi1rad, phi2rad, phi3rad = (phi1 / 1000., phi2 / 1000.,
                                  phi3 / 1000.)
@@ -170,13 +184,23 @@ class ScanVaryingCrystalUnitCellParameterisation(ScanVaryingModelParameterisatio
     # extract values and weights at time t using the smoother
     data = [self._smoother.value_weight(t, pset) for pset in self._param]
 
-    # obtain metrical matrix parameters on natural scale
-    vals = [val / 1.e5 for val, weights, sumweight in data]
+    vals = [val for val, weights, sumweight in data]
 
     # calculate derivatives of metrical matrix parameters wrt underlying
     # scan-varying parameters
     dvals_dp =  [tuple([e / sw for e in w]) for v, w, sw in data]
 
+    self._compose_core(vals, dvals_dp)
+
+    return
+
+  def _compose_core(self, vals, dvals_dp):
+    """calculate state and derivatives given the smoothed parameter values and
+    their derivatives wrt the underlying parameters"""
+
+    # obtain metrical matrix parameters on natural scale
+    vals = [val / 1.e5 for val in vals]
+
     # set parameter values in the symmetrizing object and obtain new B
     try:
       self._B_at_t = matrix.sqr(
@@ -10,6 +10,7 @@
 from __future__ import division
 from dials.algorithms.refinement.parameterisation.model_parameters \
         import Parameter, ModelParameterisation
+from scitbx.array_family import flex
 from math import exp
 import abc
 
@@ -185,6 +186,74 @@ class GaussianSmoother(object):
 
     return value, weight, sumweight
 
+  # Return the indices that bound the window of values averaged at each of
+  # the normalised coordinates z, as two flex.int arrays. This is the same
+  # choice as made for a single point in value_weight
+  def _windows(self, z):
+
+    n = len(z)
+    if self._nvalues <= 3:
+      return flex.int(n, 0), flex.int(n, self._nvalues)
+
+    # 1st point in array (index 0) is at position -0.5. Find the nearest
+    # naverage points that bracket z
+    i1 = (z - self._half_naverage).iround() + 1
+    i2 = i1 + self._naverage
+
+    # beginning of range, ensuring a separation of at least 2
+    sel = i1 < 0
+    i1.set_selected(sel, 0)
+    i2.set_selected(sel & (i2 < 2), 2)
+
+    # end of range, ensuring a separation of at least 2
+    sel = i2 > self._nvalues
+    i2.set_selected(sel, self._nvalues)
+    i1.set_selected(sel & (i1 > self._nvalues - 2), self._nvalues - 2)
+
+    return i1, i2
+
+  # Return interpolated values of param at many points, original unnormalised
+  # coordinates, as a flex.double. Also return the weights as a sparse matrix
+  # with a row for each point and a column for each position, and the sum of
+  # the weights at each point. Equivalent to calling value_weight for each
+  # point, but the calculation is done for all points at once, one position
+  # at a time, and each column of weights is set in one assignment.
+  def multi_value_weight(self, x, param):
+
+    from scitbx import sparse
+
+    x = flex.double(x)
+    npoints = len(x)
+    weight = sparse.matrix(npoints, len(self._positions))
+    value = flex.double(npoints, 0.0)
+    sumweight = flex.double(npoints, 0.0)
+
+    # normalised coordinates
+    z = (x - self._x0) / self._spacing
+    i1, i2 = self._windows(z)
+
+    # get values
+    values = param.value
+
+    for i in range(self._nvalues):
+
+      # the points for which this position lies within the averaging window
+      isel = ((i1 <= i) & (i2 > i)).iselection()
+      if len(isel) == 0: continue
+
+      ds = (z.select(isel) - self._positions[i]) / self._sigma
+      w = flex.exp(-ds*ds)
+      col = sparse.matrix_column(npoints)
+      col.set_selected(isel, w)
+      weight[:,i] = col
+      value.set_selected(isel, value.select(isel) + w * values[i])
+      sumweight.set_selected(isel, sumweight.select(isel) + w)
+
+    sel = sumweight > 0.0
+    value.set_selected(sel, value.select(sel) / sumweight.select(sel))
+
+    return value, weight, sumweight
+
   # Return number of points averaged
   def num_average(self):
     return self._naverage
@@ -264,6 +333,38 @@ class ScanVaryingModelParameterisation(ModelParameterisation):
 
     pass
 
+  @abc.abstractmethod
+  def _compose_core(self, vals, dvals_dp):
+    """compose the model state given the smoothed value of each parameter set
+    and the derivatives of those values wrt the underlying parameters, as
+    calculated by compose or compose_multi"""
+
+    pass
+
+  def compose_multi(self, t_values):
+    """compose the model state at each image number in t_values in turn,
+    yielding each image number once the state and derivatives have been
+    composed there, so that get_state and get_ds_dp may be called.
+
+    The smoothed parameter values and their derivatives are calculated for
+    all image numbers at once using the smoother's array API, rather than by
+    calling the smoother separately at each image number."""
+
+    smoothed = [self._smoother.multi_value_weight(t_values, pset) \
+                for pset in self._param]
+
+    # the derivatives of the smoothed values wrt the underlying parameters
+    # are the normalised weights. Transpose the sparse weight matrices so the
+    # weights for each image number are a sparse column, and only expand the
+    # column for one image number at a time
+    vals = [v for v, w, sw in smoothed]
+    weights = [(w.transpose(), sw) for v, w, sw in smoothed]
+
+    for j, t in enumerate(t_values):
+      self._compose_core([v[j] for v in vals],
+        [wt.col(j).as_dense_vector() / sw[j] for wt, sw in weights])
+      yield t
+
   def get_param_vals(self, only_free = True):
     """export the values of the internal list of parameters as a
     sequence of floats.
@@ -389,6 +490,62 @@ class ScanVaryingModelParameterisation(ModelParameterisation):
     return super(ScanVaryingModelParameterisation,
           self).calculate_state_uncertainties(self._var_cov)
 
+  def get_states_and_uncertainties(self, t_values):
+    """compose the model at each image number in t_values using compose_multi
+    and return a list of the states. If a variance-covariance matrix has
+    already been cached by calculate_state_uncertainties, also return a list
+    of the variance-covariance matrices of the state elements at each image
+    number, otherwise None.
+
+    The propagation of errors is done for all image numbers at once, rather
+    than by a separate matrix product at each image number."""
+
+    states = []
+    ds_dp = None
+    for t in self.compose_multi(t_values):
+      states.append(self.get_state())
+      grads = self.get_ds_dp()
+      if ds_dp is None: ds_dp = [flex.mat3_double() for g in grads]
+      for a, g in zip(ds_dp, grads):
+        a.append(g.elems)
+
+    if self._var_cov is None or not ds_dp: return states, None
+
+    # Build the transpose of the jacobian for all image numbers, as an n*(9*t)
+    # matrix. The row for each of the n parameters holds the gradients of
+    # state element 0 at every image number, followed by those of element 1,
+    # and so on. Then state_cov = jacobian * var_cov * jacobian_t at each image
+    # number has elements given by the column sums of the elementwise product
+    # of blocks of jacobian_t and var_cov * jacobian_t
+    nt = len(states)
+    nparam = len(ds_dp)
+    jacobian_t = flex.double()
+    for g in ds_dp:
+      g = g.as_double()
+      g.reshape(flex.grid(nt, 9))
+      jacobian_t.extend(g.matrix_transpose().as_1d())
+    jacobian_t.reshape(flex.grid(nparam, 9 * nt))
+    tmp = self._var_cov.matrix_multiply(jacobian_t)
+
+    ones = flex.double(nparam, 1.0)
+    ones.reshape(flex.grid(1, nparam))
+    state_cov = flex.double(flex.grid(81, nt))
+    for i in range(9):
+      jac_i = jacobian_t.matrix_copy_block(0, i * nt, nparam, nt)
+      for j in range(i, 9):
+        tmp_j = tmp.matrix_copy_block(0, j * nt, nparam, nt)
+        cov_ij = ones.matrix_multiply(jac_i * tmp_j)
+        state_cov.matrix_paste_block_in_place(cov_ij, 9 * i + j, 0)
+        if j != i:
+          state_cov.matrix_paste_block_in_place(cov_ij, 9 * j + i, 0)
+    state_cov = state_cov.matrix_transpose().as_1d()
+
+    from scitbx import matrix
+    state_covs = [matrix.sqr(tuple(state_cov[81 * k: 81 * (k + 1)])) \
+                  for k in range(nt)]
+
+    return states, state_covs
+
   def set_state_uncertainties(self, var_cov_list):
     """Send the calculated variance-covariance matrices for model state elements
     for all scan points back to the model for storage alongside the model state
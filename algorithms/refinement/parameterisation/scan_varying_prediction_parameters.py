@@ -85,6 +85,42 @@ class VaryingCrystalPredictionParameterisation(XYPhiPredictionParameterisation):
 
     return
 
+  def _get_states_at_frames(self, parameterisation, state, frames, cache):
+    """Get the model state and its derivatives from the parameterisation at
+    each of the specified distinct frames, as a flex.mat3_double of states and
+    a list of flex.mat3_double of derivatives, one for each free parameter.
+    States already composed at the same frames during this call to compose
+    are reused, while the rest are composed together using the smoother's
+    array API. If there is no parameterisation, the supplied state is
+    returned for every frame with no derivatives"""
+
+    if parameterisation is None:
+      return flex.mat3_double(len(frames), state.elems), []
+
+    key = id(parameterisation)
+    missing = [f for f in frames if (key, f) not in cache]
+    if len(missing) > 0:
+      if hasattr(parameterisation, 'compose_multi'):
+        for f in parameterisation.compose_multi(missing):
+          cache[(key, f)] = (parameterisation.get_state().elems,
+                             [e.elems for e in parameterisation.get_ds_dp()])
+      else:
+        # not scan-varying, so the same state at every frame
+        static = (parameterisation.get_state().elems,
+                  [e.elems for e in parameterisation.get_ds_dp()])
+        for f in missing: cache[(key, f)] = static
+
+    states = flex.mat3_double()
+    ds_dp = None
+    for f in frames:
+      s, d = cache[(key, f)]
+      states.append(s)
+      if ds_dp is None: ds_dp = [flex.mat3_double() for e in d]
+      for a, e in zip(ds_dp, d):
+        a.append(e)
+
+    return states, ds_dp
+
   def compose(self, reflections):
     """Compose scan-varying crystal parameterisations at the specified image
     number, for the specified experiment, for all reflections. Put the U, B and
@@ -92,41 +128,55 @@ class VaryingCrystalPredictionParameterisation(XYPhiPredictionParameterisation):
 
     self._prepare_for_compose(reflections)
 
+    # states and derivatives composed during this call, by parameterisation
+    # and integer frame, so each is only composed once per image
+    cache = {}
+
     for iexp, exp in enumerate(self._experiments):
 
       # select the reflections of interest
       sel = reflections['id'] == iexp
       isel = sel.iselection()
+      if len(isel) == 0: continue
 
-      # get their frame numbers
-      obs_image_numbers = (reflections['xyzobs.px.value'].parts()[2]).select(isel)
+      # get their integer frame numbers. The model states are composed at the
+      # start of the image on which each reflection is observed, so that they
+      # are shared by all the reflections on that image
+      obs_image_numbers = flex.floor(
+        (reflections['xyzobs.px.value'].parts()[2]).select(isel)).iround()
 
       # identify which crystal parameterisations to use for this experiment
       xl_op = self._get_xl_orientation_parameterisation(iexp)
       xl_ucp = self._get_xl_unit_cell_parameterisation(iexp)
 
-      # get state and derivatives for each reflection
-      for i, frame in zip(isel, obs_image_numbers):
-
-        # model states at current frame
-        U = self._get_state_from_parameterisation(xl_op, frame)
-        if U is None: U = exp.crystal.get_U()
-
-        B = self._get_state_from_parameterisation(xl_ucp, frame)
-        if B is None: B = exp.crystal.get_B()
-
-        # set states and their derivatives into reflections
-        row = {'u_matrix':U.elems,
-               'b_matrix':B.elems}
-        if xl_op is not None:
-          for j, dU in enumerate(xl_op.get_ds_dp()):
-            colname = "dU_dp{0}".format(j)
-            row[colname] = dU
-        if xl_ucp is not None:
-          for j, dB in enumerate(xl_ucp.get_ds_dp()):
-            colname = "dB_dp{0}".format(j)
-            row[colname] = dB
-        reflections[i] = row
+      # sort the reflections by frame and find the runs on each image
+      perm = flex.sort_permutation(obs_image_numbers)
+      frames = obs_image_numbers.select(perm)
+      starts = [0]
+      if len(frames) > 1:
+        starts.extend((frames[1:] != frames[:-1]).iselection() + 1)
+      ends = starts[1:] + [len(frames)]
+
+      # get states and derivatives once for each distinct frame
+      distinct = list(frames.select(flex.size_t(starts)))
+      U_states, dU_states = self._get_states_at_frames(xl_op,
+        exp.crystal.get_U(), distinct, cache)
+      B_states, dB_states = self._get_states_at_frames(xl_ucp,
+        exp.crystal.get_B(), distinct, cache)
+      group = flex.size_t()
+      for i_group, (i_start, i_end) in enumerate(zip(starts, ends)):
+        group.extend(flex.size_t(i_end - i_start, i_group))
+
+      # set states and their derivatives into reflections
+      isel = isel.select(perm)
+      reflections['u_matrix'].set_selected(isel, U_states.select(group))
+      reflections['b_matrix'].set_selected(isel, B_states.select(group))
+      for j, states in enumerate(dU_states):
+        colname = "dU_dp{0}".format(j)
+        reflections[colname].set_selected(isel, states.select(group))
+      for j, states in enumerate(dB_states):
+        colname = "dB_dp{0}".format(j)
+        reflections[colname].set_selected(isel, states.select(group))
 
     # set the UB matrices for prediction
     reflections['ub_matrix'] = reflections['u_matrix'] * reflections['b_matrix']
@@ -152,6 +202,48 @@ class VaryingCrystalPredictionParameterisation(XYPhiPredictionParameterisation):
 
     return U*B
 
+  @staticmethod
+  def _get_states_and_uncertainties(parameterisation, state, frames):
+    """Get the model states and their variance-covariance matrices at each of
+    the specified frames, taking care of whether there is a scan-varying
+    parameterisation or not. Where there is no parameterisation the supplied
+    state is used, and the variance-covariance matrices are None"""
+
+    if parameterisation is None:
+      return [state] * len(frames), [None] * len(frames)
+
+    if not hasattr(parameterisation, 'get_states_and_uncertainties'):
+      return [parameterisation.get_state()] * len(frames), [None] * len(frames)
+
+    states, covs = parameterisation.get_states_and_uncertainties(frames)
+    if covs is None: covs = [None] * len(frames)
+    return states, covs
+
+  def get_scan_point_states(self, experiment_id, frames):
+    """Extract the setting matrices from the contained scan-dependent crystal
+    parameterisations at each of the specified image numbers, along with the
+    variance-covariance matrices of the U and B states there. Each
+    parameterisation is composed for all image numbers together and errors are
+    propagated for all image numbers at once, so this is equivalent to, but
+    much faster than, calling get_UB and calculate_model_state_uncertainties
+    at each image number in turn"""
+
+    # called by refiner.run for setting the crystal scan points
+
+    # identify which crystal parameterisations to use for this experiment
+    xl_op = self._get_xl_orientation_parameterisation(experiment_id)
+    xl_ucp = self._get_xl_unit_cell_parameterisation(experiment_id)
+    crystal = self._experiments[experiment_id].crystal
+
+    frames = list(frames)
+    U_list, u_cov_list = self._get_states_and_uncertainties(xl_op,
+      crystal.get_U(), frames)
+    B_list, b_cov_list = self._get_states_and_uncertainties(xl_ucp,
+      crystal.get_B(), frames)
+    A_list = [U * B for U, B in zip(U_list, B_list)]
+
+    return A_list, u_cov_list, b_cov_list
+
   # overloaded for the scan-varying case
   def _get_U_B_for_experiment(self, crystal, reflections, isel):
     """helper function to return either a single U, B pair (for scan-static) or
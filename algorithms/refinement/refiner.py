@@ -224,6 +224,19 @@ refinement
       .help = "Maximum number of iterations in refinement before termination."
               "None implies the engine supplies its own default."
       .type = int(value_min=1)
+
+    accumulate_normal_matrix = False
+      .help = "For engines that solve the normal equations (GaussNewton and"
+              "LevMar), form the normal matrix directly from the gradients of"
+              "each parameter, block by block, rather than building the"
+              "Jacobian matrix. The gradients are held for a limited number"
+              "of reflections at a time, so memory use does not grow with"
+              "gradient_calculation_blocksize. Parameter correlations cannot"
+              "be tracked in this mode. If nproc > 1 these engines always"
+              "accumulate the normal matrix this way, using a persistent pool"
+              "of worker processes that each predict a fixed share of the"
+              "reflections, and this setting is ignored."
+      .type = bool
   }
 
   target
@@ -652,7 +665,7 @@ class RefinerFactory(object):
     # build refiner interface and return
     return Refiner(reflections, experiments, crystal_ids,
                     pred_param, param_reporter, refman, target, refinery,
-                    verbosity=verbosity)
+                    verbosity=verbosity, nproc=params.refinement.mp.nproc)
 
   @staticmethod
   def config_sparse(params, experiments):
@@ -1191,6 +1204,13 @@ class RefinerFactory(object):
         warning("Could not set nproc={0} for refinement engine of type {1}".format(
           nproc, options.engine))
 
+    if options.accumulate_normal_matrix:
+      try:
+        engine.set_accumulate_normal_matrix(True)
+      except NotImplementedError:
+        warning("Could not set accumulate_normal_matrix=True for refinement "
+                "engine of type {0}".format(options.engine))
+
     return engine
 
   @staticmethod
@@ -1387,7 +1407,7 @@ class Refiner(object):
 
   def __init__(self, reflections, experiments, crystal_ids,
                pred_param, param_reporter, refman, target, refinery,
-               verbosity=0):
+               verbosity=0, nproc=1):
     """
     Mandatory arguments:
       reflections - Input ReflectionList data
@@ -1404,6 +1424,7 @@ class Refiner(object):
       goniometer - A dxtbx Goniometer object
       scan - A dxtbx Scan object
       verbosity - An integer verbosity level
+      nproc - The number of processes to use for post-refinement calculations
 
     """
 
@@ -1438,6 +1459,7 @@ class Refiner(object):
     self._param_report = param_reporter
 
     self._verbosity = verbosity
+    self._nproc = nproc
 
     return
 
@@ -1789,19 +1811,29 @@ class Refiner(object):
       import VaryingCrystalPredictionParameterisationFast
     if isinstance(self._pred_param, VaryingCrystalPredictionParameterisation) or \
        isinstance(self._pred_param, VaryingCrystalPredictionParameterisationFast):
-      for iexp, exp in enumerate(self._experiments):
-        ar_range = exp.scan.get_array_range()
-        A_list = [self._pred_param.get_UB(t, iexp) for t in range(ar_range[0],
-                                                            ar_range[1]+1)]
-        exp.crystal.set_A_at_scan_points(A_list)
+      # get setting matrices and state covariance matrices for the whole range
+      # of images of each experiment. Experiments are independent, so may be
+      # done in parallel
+      def scan_point_states(iexp):
+        ar_range = self._experiments[iexp].scan.get_array_range()
+        return self._pred_param.get_scan_point_states(iexp,
+          range(ar_range[0], ar_range[1]+1))
+
+      iexps = range(len(self._experiments))
+      if self._nproc > 1 and len(iexps) > 1:
+        from libtbx import easy_mp
+        results = easy_mp.parallel_map(
+          func=scan_point_states,
+          iterable=iexps,
+          processes=self._nproc,
+          method="multiprocessing",
+          preserve_order=True)
+      else:
+        results = [scan_point_states(iexp) for iexp in iexps]
 
-        # get state covariance matrices the whole range of images. We select
-        # the first element of this at each image because crystal scan-varying
-        # parameterisations are not multi-state
-        state_cov_list = [self._pred_param.calculate_model_state_uncertainties(
-          obs_image_number=t, experiment_id=iexp) for t in range(ar_range[0],
-                                                            ar_range[1]+1)]
-        u_cov_list, b_cov_list = zip(*state_cov_list)
+      for iexp, (exp, result) in enumerate(zip(self._experiments, results)):
+        A_list, u_cov_list, b_cov_list = result
+        exp.crystal.set_A_at_scan_points(A_list)
 
         # return these to the model parameterisations to be set in the models
         self._pred_param.set_model_state_uncertainties(
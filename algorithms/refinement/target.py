@@ -45,6 +45,10 @@ class Target(object):
   rmsd_names = ["RMSD_X", "RMSD_Y", "RMSD_Phi"]
   rmsd_units = ["mm", "mm", "rad"]
 
+  # Limit on the number of gradient values held at once by
+  # compute_normal_equations
+  _max_normal_equations_gradient_elements = 10000000
+
   def __init__(self, experiments, reflection_predictor, ref_manager,
                prediction_parameterisation, gradient_calculation_blocksize=None):
 
@@ -350,6 +354,79 @@ class Target(object):
 
     return(residuals, jacobian, weights)
 
+  def compute_normal_equations(self, block=None):
+    """return the vector of residuals plus their weights, together with the
+    normal matrix J^T.W.J as a packed upper triangle and the vector J^T.W.r, for
+    non-linear least squares methods. These are accumulated over sub-blocks of
+    the matches from a dense Jacobian of only the parameters with non-zero
+    gradients in the sub-block, so the Jacobian of the whole block is never
+    formed and no more than about _max_normal_equations_gradient_elements
+    gradient values are held at once, whatever the size of the block"""
+
+    self.update_matches()
+    if block is not None:
+      matches = block
+    else:
+      matches = self._matches
+
+    residuals, weights = self._extract_residuals_and_weights(matches)
+    nparam = len(self._prediction_parameterisation)
+    nrows = max(1, self._max_normal_equations_gradient_elements // (3 * nparam))
+
+    def process_one_gradient(result):
+      # copy gradients out of the result
+      dX = result[self._grad_names[0]]
+      dY = result[self._grad_names[1]]
+      dZ = result[self._grad_names[2]]
+      # reset result
+      for k in result.keys():
+        result[k] = None
+      # keep only the concatenated gradients, or None if they are all zero,
+      # as is the case for many parameters in multi-experiment or
+      # hierarchical detector refinement
+      grads = self._concatenate_gradients(dX, dY, dZ)
+      if grads.all_eq(0.0): grads = None
+      result['grads'] = grads
+      return result
+
+    normal_matrix = flex.double(nparam * (nparam + 1) // 2, 0.0)
+    jtwr = flex.double(nparam, 0.0)
+    for start in range(0, len(matches), nrows):
+      sub_matches = matches[start:start + nrows]
+      sub_residuals, sub_weights = self._extract_residuals_and_weights(
+        sub_matches)
+      results = self.calculate_gradients(sub_matches,
+          callback=process_one_gradient)
+      grads = [result['grads'] for result in results]
+      nonzero = [i for i, g in enumerate(grads) if g is not None]
+      if len(nonzero) == 0: continue
+
+      # pack the weighted gradients of the parameters with non-zero gradients
+      # into the columns of a dense matrix, J', so that the contribution to
+      # J^T.W.J is formed with one matrix product. The gradients are released
+      # as they are packed to keep within the memory bound
+      sqrt_w = flex.sqrt(sub_weights)
+      wr = sqrt_w * sub_residuals
+      jw = flex.double(flex.grid(len(sub_residuals), len(nonzero)))
+      for col, i in enumerate(nonzero):
+        g = sqrt_w * grads[i]
+        grads[i] = None
+        jtwr[i] += flex.sum(g * wr)
+        jw.matrix_paste_column_in_place(g, col)
+      jtwj = jw.matrix_transpose_multiply(jw)
+      jtwj = jtwj.matrix_upper_triangle_as_packed_u()
+
+      # the positions of the elements in the packed upper triangle of the
+      # full normal matrix
+      indices = flex.size_t()
+      cols = flex.size_t(nonzero)
+      for col, i in enumerate(nonzero):
+        indices.extend(cols[col:] + (i * nparam - (i * (i + 1)) // 2))
+      normal_matrix.set_selected(indices,
+                                 normal_matrix.select(indices) + jtwj)
+
+    return(residuals, weights, normal_matrix, jtwr)
+
   @staticmethod
   def _build_jacobian(dX_dp, dY_dp, dZ_dp, nelem, nparam):
     """construct Jacobian from lists of gradient vectors. This method may be
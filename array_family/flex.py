@@ -158,11 +158,8 @@ class reflection_table_aux(boost.python.injector, reflection_table):
 
     if params.spotfinder.filter.min_spot_size is Auto:
       detector = datablock.extract_imagesets()[0].get_detector()
-      if detector[0].get_type() == 'SENSOR_PAD':
-        # smaller default value for pixel array detectors
-        params.spotfinder.filter.min_spot_size = 3
-      else:
-        params.spotfinder.filter.min_spot_size = 6
+      params.spotfinder.filter.min_spot_size = \
+        SpotFinderFactory.default_min_spot_size(detector)
       info('Setting spotfinder.filter.min_spot_size=%i' %(
         params.spotfinder.filter.min_spot_size))
 
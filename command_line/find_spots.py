@@ -27,6 +27,13 @@ of the user. The output will be a file (strong.pickle) containing a list of spot
 centroids and intensities which can be used in the dials.index program. To view
 a list of parameters for spot finding use the --show-config option.
 
+Spot finding can also be started during data collection. With
+spotfinder.follow.enable=True, each image is processed as soon as it is
+written and spots are completed as soon as they end; spot finding stops when
+no new image has appeared for spotfinder.follow.timeout seconds. With
+spotfinder.follow.checkpoint=checkpoint.pickle, a restarted job resumes from
+the last checkpoint.
+
 Examples::
 
   dials.find_spots image1.cbf
@@ -37,6 +44,8 @@ Examples::
 
   dials.find_spots datablock.json output.reflections=strong.pickle
 
+  dials.find_spots image_0001.cbf spotfinder.follow.enable=True
+
 '''
 
 # Set the phil scope
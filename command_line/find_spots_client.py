@@ -1,30 +1,183 @@
 from __future__ import division
+import threading
 
-def work(host, port, filename, params):
+_local = threading.local()
+
+# Every kept-alive connection, from all threads, so they can be closed
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
+def _connection(host, port):
+  '''Get a kept-alive connection to the server for the current thread.'''
   import httplib
-  conn = httplib.HTTPConnection(host, port)
+  key = (host, port)
+  connections = getattr(_local, 'connections', None)
+  if connections is None:
+    connections = _local.connections = {}
+  if key not in connections:
+    connections[key] = httplib.HTTPConnection(host, port)
+    with _all_connections_lock:
+      _all_connections.append(connections[key])
+  return connections[key]
+
+def close_connections():
+  '''
+  Close all kept-alive connections, so the server processes holding them are
+  free to handle other clients.
+
+  '''
+  with _all_connections_lock:
+    for conn in _all_connections:
+      conn.close()
+    del _all_connections[:]
+
+def work(host, port, filename, params, keep_alive=False):
+  import httplib
+  from socket import error as socket_error
   path = filename
   for param in params:
     path += ';%s' % param
-  conn.request('GET', path)
-  return conn.getresponse().read()
+  if not keep_alive:
+    conn = httplib.HTTPConnection(host, port)
+    conn.request('GET', path)
+    try:
+      return conn.getresponse().read()
+    finally:
+      conn.close()
+  conn = _connection(host, port)
+  try:
+    conn.request('GET', path)
+    return conn.getresponse().read()
+  except (httplib.HTTPException, socket_error):
+    # The server may have dropped the connection, so try once more
+    conn.close()
+    conn.request('GET', path)
+    return conn.getresponse().read()
+
+def work_batch(host, port, params, filenames=None, template=None,
+               image_range=None):
+  '''
+  Send a batch of images to the server and yield the response for each image
+  as soon as it is received.
+
+  :param host: The server host
+  :param port: The server port
+  :param params: The spot finding parameters
+  :param filenames: The list of filenames
+  :param template: The filename template (instead of filenames)
+  :param image_range: The inclusive range of images for the template
+  :return: A generator yielding (filename, response) pairs
+
+  '''
+  import httplib
+  import json
+  import re
+  if template is not None:
+    assert image_range is not None, "image_range required with template"
+    request = { 'template' : template, 'image_range' : list(image_range) }
+  else:
+    assert filenames is not None, "filenames or template required"
+    request = { 'filenames' : list(filenames) }
+  request['params'] = list(params)
+  body = json.dumps(request)
+  conn = httplib.HTTPConnection(host, port)
+  try:
+    conn.request('POST', '/batch', body, {
+      'Content-Type' : 'application/json',
+      'Content-Length' : str(len(body)) })
+    response = conn.getresponse()
+    if response.status != 200:
+      raise RuntimeError('Batch request failed: %s %s' % (
+        response.status, response.reason))
+    lines = []
+    while True:
+      line = response.fp.readline()
+      if not line:
+        break
+      lines.append(line)
+      if line.strip().endswith('</response>'):
+        text = ''.join(lines).strip()
+        lines = []
+        match = re.search('<image>(.*)</image>', text)
+        yield (match.group(1) if match is not None else None), text
+  finally:
+    conn.close()
+
+def _split(items, n):
+  '''Split a list into at most n contiguous chunks of similar size.'''
+  n = max(1, min(n, len(items)))
+  return [items[i * len(items) // n:(i + 1) * len(items) // n]
+          for i in range(n)]
+
+def work_all_batch(host, port, params, filenames=None, template=None,
+                   image_range=None, nproc=None):
+  '''
+  Split the images into one batch per process and send the batches to the
+  server concurrently. The responses are printed as they arrive.
+
+  :return: A dictionary of the responses for each filename and the list of
+           filenames in image order
+
+  '''
+  from multiprocessing.pool import ThreadPool as thread_pool
+  if nproc is None:
+    nproc = _nproc()
+  if template is not None:
+    indices = range(image_range[0], image_range[1] + 1)
+    batches = [dict(template=template, image_range=(b[0], b[-1]))
+               for b in _split(indices, nproc)]
+  else:
+    batches = [dict(filenames=b) for b in _split(list(filenames), nproc)]
+  lock = threading.Lock()
+  results = { }
+  def run(batch):
+    names = []
+    for filename, response in work_batch(host, port, params, **batch):
+      with lock:
+        print response
+        results[filename] = response
+      names.append(filename)
+    return names
+  pool = thread_pool(processes=len(batches))
+  try:
+    order = pool.map(run, batches)
+  finally:
+    pool.close()
+    pool.join()
+  return results, [name for names in order for name in names]
 
 def _nproc():
   from libtbx.introspection import number_of_processors
   return number_of_processors(return_value_if_unknown=-1)
 
-def work_all(host, port, filenames, params, plot=False, table=False, grid=None, nproc=None):
+def work_all(host, port, filenames, params, plot=False, table=False, grid=None,
+             nproc=None, batch=False, template=None, image_range=None,
+             keep_alive=False):
   from multiprocessing.pool import ThreadPool as thread_pool
   if nproc is None:
     nproc=_nproc()
-  pool = thread_pool(processes=nproc)
-  threads = { }
-  for filename in filenames:
-    threads[filename] = pool.apply_async(work, (host, port, filename, params))
-  results = { }
-  for filename in filenames:
-    results[filename] = threads[filename].get()
-    print results[filename]
+  if batch or template is not None:
+    results, filenames = work_all_batch(
+      host, port, params, filenames=filenames, template=template,
+      image_range=image_range, nproc=nproc)
+  else:
+    pool = thread_pool(processes=nproc)
+    try:
+      threads = { }
+      for filename in filenames:
+        threads[filename] = pool.apply_async(
+          work, (host, port, filename, params, keep_alive))
+      results = { }
+      for filename in filenames:
+        results[filename] = threads[filename].get()
+        print results[filename]
+    finally:
+      pool.close()
+      pool.join()
+      # each kept-alive connection occupies a server process until it is
+      # closed, so never leave them open
+      if keep_alive:
+        close_connections()
 
   if plot or table:
 
@@ -108,6 +261,23 @@ table = False
   .type = bool
 grid = None
   .type = ints(size=2, value_min=1)
+keep_alive = False
+  .type = bool
+  .help = "Without batch=True, send the images from each client thread over"
+          "one kept-alive connection. Each connection occupies a server"
+          "process until all the images have been sent, so nproc should not"
+          "exceed the number of server processes."
+batch = False
+  .type = bool
+  .help = "Send the images to the server in one batch per process and"
+          "receive the results as they are processed"
+template = None
+  .type = str
+  .help = "A filename template (e.g. image_####.cbf) to use in batch mode"
+          "instead of a list of filenames"
+image_range = None
+  .type = ints(size=2)
+  .help = "The inclusive range of images to use with the template"
 """)
 
 if __name__ == '__main__':
@@ -139,9 +309,17 @@ if __name__ == '__main__':
   if len(unhandled) and unhandled[0] == 'stop':
     stopped = stop(params.host, params.port, params.nproc)
     print 'Stopped %d findspots processes' % stopped
+  elif params.template is not None:
+    if params.image_range is None:
+      raise RuntimeError('image_range must be set with template')
+    work_all(params.host, params.port, None, unhandled, plot=params.plot,
+             table=params.table, grid=params.grid, nproc=nproc,
+             batch=True, template=params.template,
+             image_range=params.image_range)
   else:
     if len(filenames) == 1:
       print work(params.host, params.port, filenames[0], unhandled)
     else:
       work_all(params.host, params.port, filenames, unhandled, plot=params.plot,
-               table=params.table, grid=params.grid, nproc=nproc)
+               table=params.table, grid=params.grid, nproc=nproc,
+               batch=params.batch, keep_alive=params.keep_alive)
@@ -48,6 +48,19 @@ Any valid ``dials.find_spots`` parameter may be passed to
 
   dials.find_spots_client /path/to/image.cbf min_spot_size=2 d_min=2
 
+Many images can be sent to the server in batches, with the results for each
+image returned as soon as it is processed. The images are split into one
+batch per process, and each batch is processed by one server process::
+
+  dials.find_spots_client batch=True [nproc=8] /path/to/image_*.cbf
+  dials.find_spots_client batch=True template=/path/to/image_####.cbf image_range=1,1000
+
+Without batch=True, each client thread sends its images one at a time. With
+keep_alive=True it uses a single kept-alive connection to do so. Idle
+connections are closed by the server after a timeout (in seconds)::
+
+  dials.find_spots_server [nproc=8] [timeout=10]
+
 To stop the server::
 
   dials.find_spots_client stop [host=hostname] [port=1234]
@@ -56,7 +69,37 @@ To stop the server::
 
 stop = False
 
-def work(filename, cl=[]):
+# Parsed parameters and configured spot finders are cached in each server
+# process and reused across requests with the same command line
+_cache = {}
+_max_cache_size = 32
+
+def _cached(key, create):
+  '''
+  Get a cached object, creating it if necessary.
+
+  :param key: The cache key
+  :param create: A function to create the object
+  :return: The object
+
+  '''
+  try:
+    return _cache[key]
+  except KeyError:
+    if len(_cache) >= _max_cache_size:
+      _cache.clear()
+    result = _cache[key] = create()
+    return result
+
+def _parse_parameters(cl):
+  '''
+  Parse the command line into the server and spot finding parameters.
+
+  :param cl: The command line arguments
+  :return: index, integrate, the spot finding parameters and the remaining
+           command line arguments
+
+  '''
   import libtbx.phil
   phil_scope = libtbx.phil.parse('''\
 index = False
@@ -71,31 +114,112 @@ integrate = False
   integrate = params.extract().integrate
 
   from dials.command_line.find_spots import phil_scope as params
-  from dxtbx.datablock import DataBlockFactory
-  from dials.array_family import flex
   interp = params.command_line_argument_interpreter()
   params, unhandled = interp.process_and_fetch(
     unhandled, custom_processor='collect_remaining')
   params = params.extract()
   # no need to write the hot mask in the server/client
   params.spotfinder.write_hot_mask = False
+  return index, integrate, params, unhandled
+
+def _create_spot_finder(params, detector):
+  '''
+  Configure a spot finder for the detector. The spot finder keeps its
+  threshold algorithm buffers, keyed by image size, so they are reused when
+  the spot finder is reused for later images.
+
+  :param params: The spot finding parameters
+  :param detector: The detector model
+  :return: The spot finder
+
+  '''
+  from dials.algorithms.peak_finding.spotfinder_factory \
+    import SpotFinderFactory
+  from libtbx import Auto
+  import copy
+  params = copy.deepcopy(params)
+  if params.spotfinder.filter.min_spot_size is Auto:
+    params.spotfinder.filter.min_spot_size = \
+      SpotFinderFactory.default_min_spot_size(detector)
+  return SpotFinderFactory.from_parameters(params)
+
+def _detector_key(detector):
+  '''
+  :return: A key describing the detector properties that the spot finder
+           configuration depends on
+
+  '''
+  return tuple((p.get_type(), p.get_image_size()) for p in detector)
+
+def warm_up():
+  '''
+  Import the modules needed to process requests so that this is not done on
+  the first request received by each process.
+
+  '''
+  import dials.algorithms.peak_finding.spotfinder_factory
+  import dials.algorithms.peak_finding.per_image_analysis
+  import dials.algorithms.indexing.indexer
+  import dials.algorithms.integration.integrator
+  import dials.algorithms.profile_model.factory
+  import dials.command_line.find_spots
+  import dials.command_line.integrate
+  import dxtbx.datablock
+
+def work(filename, cl=[]):
+  from dxtbx.datablock import DataBlockFactory
+  from dials.array_family import flex
+  from time import time
+
+  # The time taken for each stage of the processing
+  timing = []
+
+  st = time()
+  index, integrate, params, unhandled = _cached(
+    ('parameters', tuple(cl)), lambda: _parse_parameters(cl))
+  timing.append(('parse', time() - st))
+
+  st = time()
   datablock = DataBlockFactory.from_filenames([filename])[0]
-  reflections = flex.reflection_table.from_observations(datablock, params)
-  from dials.algorithms.peak_finding import per_image_analysis
   imageset = datablock.extract_imagesets()[0]
+  timing.append(('datablock', time() - st))
+
+  st = time()
+  from libtbx import Auto
+  detector = imageset.get_detector()
+  if params.spotfinder.threshold.xds.global_threshold is Auto:
+    # the global threshold is estimated from each image so can't be reused
+    find_spots = _create_spot_finder(params, detector)
+  else:
+    find_spots = _cached(
+      ('spot_finder', tuple(cl), _detector_key(detector)),
+      lambda: _create_spot_finder(params, detector))
+  reflections = find_spots(datablock)
+  timing.append(('spot_finding', time() - st))
+
+  st = time()
+  from dials.algorithms.peak_finding import per_image_analysis
   stats = per_image_analysis.stats_single_image(
     imageset, reflections,
     i=imageset.get_scan().get_image_range()[0]-1, plot=False)
+  timing.append(('analysis', time() - st))
+  stats.timing = timing
 
   if index and stats.n_spots_no_ice > 10:
     import logging
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
     from dials.algorithms.indexing import indexer
-    interp = indexer.master_phil_scope.command_line_argument_interpreter()
-    params, unhandled = interp.process_and_fetch(
-      unhandled, custom_processor='collect_remaining')
+    import copy
+    st = time()
+    def parse_indexing_parameters():
+      interp = indexer.master_phil_scope.command_line_argument_interpreter()
+      params, remaining = interp.process_and_fetch(
+        unhandled, custom_processor='collect_remaining')
+      return params.extract(), remaining
+    params, unhandled = _cached(
+      ('indexing_parameters', tuple(cl)), parse_indexing_parameters)
+    params = copy.deepcopy(params)
     imagesets = [imageset]
-    params = params.extract()
     params.indexing.scan_range=[]
 
     if (imageset.get_goniometer() is not None and
@@ -115,17 +239,23 @@ integrate = False
       stats.crystal = None
       stats.n_indexed = None
       stats.fraction_indexed = None
+    timing.append(('indexing', time() - st))
 
     if integrate and stats.crystal is not None:
 
       from dials.algorithms.profile_model.factory import ProfileModelFactory
       from dials.algorithms.integration.integrator import IntegratorFactory
       from dials.command_line.integrate import phil_scope
-      interp = phil_scope.command_line_argument_interpreter()
-      params, unhandled = interp.process_and_fetch(
-        unhandled, custom_processor='collect_remaining')
+      st = time()
+      def parse_integration_parameters():
+        interp = phil_scope.command_line_argument_interpreter()
+        params, remaining = interp.process_and_fetch(
+          unhandled, custom_processor='collect_remaining')
+        return params.extract(), remaining
+      params, unhandled = _cached(
+        ('integration_parameters', tuple(cl)), parse_integration_parameters)
+      params = copy.deepcopy(params)
       imagesets = [imageset]
-      params = params.extract()
 
       params.profile.gaussian_rs.min_spots = 0
 
@@ -172,51 +302,139 @@ integrate = False
       #print len(reflections)
 
       stats.integrated_intensity = flex.sum(reflections['intensity.sum.value'])
+      timing.append(('integration', time() - st))
 
   return stats
   return stats.n_spots_total, stats.n_spots_no_ice
 
+def format_response(filename, stats):
+  '''
+  Format the statistics for an image as an xml response.
+
+  :param filename: The image filename
+  :param stats: The image statistics
+  :return: The response string
+
+  '''
+  response = [
+    '<image>%s</image>' % filename,
+    '<spot_count>%s</spot_count>' % stats.n_spots_total,
+    '<spot_count_no_ice>%s</spot_count_no_ice>' % stats.n_spots_no_ice,
+    '<d_min>%.2f</d_min>' % stats.estimated_d_min,
+    '<d_min_method_1>%.2f</d_min_method_1>' % stats.d_min_distl_method_1,
+    '<d_min_method_2>%.2f</d_min_method_2>' % stats.d_min_distl_method_2,
+    '<total_intensity>%.0f</total_intensity>' % stats.total_intensity,
+  ]
+  if hasattr(stats, 'crystal') and stats.crystal is not None:
+    response.append(
+      '<unit_cell>%.6g %.6g %.6g %.6g %.6g %.6g</unit_cell>' %stats.crystal.get_unit_cell().parameters())
+    response.append(
+      '<n_indexed>%i</n_indexed>' %stats.n_indexed)
+    response.append(
+      '<fraction_indexed>%.2f</fraction_indexed>' %stats.fraction_indexed)
+  if hasattr(stats, 'integrated_intensity'):
+    response.append(
+      '<integrated_intensity>%.0f</integrated_intensity>' %stats.integrated_intensity)
+  for stage, t in stats.timing:
+    response.append('<time_%s>%.4f</time_%s>' % (stage, t, stage))
+  return '<response>\n%s\n</response>' % ('\n'.join(response))
+
+def expand_template(template, image_range):
+  '''
+  Get the filenames from a template (e.g. /path/to/image_####.cbf) and an
+  inclusive range of image numbers.
+
+  :param template: The filename template
+  :param image_range: The first and last image numbers
+  :return: The list of filenames
+
+  '''
+  import re
+  match = list(re.finditer('#+', template))
+  if len(match) == 0:
+    raise RuntimeError('Invalid template: %s' % template)
+  i0, i1 = match[-1].span()
+  fmt = '%s%%0%dd%s' % (template[:i0], i1 - i0, template[i1:])
+  first, last = image_range
+  return [fmt % i for i in range(first, last + 1)]
+
 class handler(server_base.BaseHTTPRequestHandler):
+
+  # HTTP/1.1 allows clients to send many requests over one connection
+  protocol_version = 'HTTP/1.1'
+
+  # Each server process handles one connection at a time, so close idle
+  # connections rather than waiting on them forever (set from the phil
+  # parameter in main)
+  timeout = 10
+
   def do_GET(s):
     '''Respond to a GET request.'''
-    s.send_response(200)
-    s.send_header('Content-type', 'text/xml')
-    s.end_headers()
     if s.path == '/Ctrl-C':
       global stop
       stop = True
+      s.send_response(200)
+      s.send_header('Content-type', 'text/xml')
+      s.send_header('Content-Length', '0')
+      s.send_header('Connection', 'close')
+      s.end_headers()
+      s.close_connection = 1
       return
     filename = s.path.split(';')[0]
     params = s.path.split(';')[1:]
     proc = current_process().name
     try:
       stats = work(filename, params)
-      response = [
-        '<image>%s</image>' % filename,
-        '<spot_count>%s</spot_count>' % stats.n_spots_total,
-        '<spot_count_no_ice>%s</spot_count_no_ice>' % stats.n_spots_no_ice,
-        '<d_min>%.2f</d_min>' % stats.estimated_d_min,
-        '<d_min_method_1>%.2f</d_min_method_1>' % stats.d_min_distl_method_1,
-        '<d_min_method_2>%.2f</d_min_method_2>' % stats.d_min_distl_method_2,
-        '<total_intensity>%.0f</total_intensity>' % stats.total_intensity,
-      ]
-      if hasattr(stats, 'crystal') and stats.crystal is not None:
-        response.append(
-          '<unit_cell>%.6g %.6g %.6g %.6g %.6g %.6g</unit_cell>' %stats.crystal.get_unit_cell().parameters())
-        response.append(
-          '<n_indexed>%i</n_indexed>' %stats.n_indexed)
-        response.append(
-          '<fraction_indexed>%.2f</fraction_indexed>' %stats.fraction_indexed)
-      if hasattr(stats, 'integrated_intensity'):
-        response.append(
-          '<integrated_intensity>%.0f</integrated_intensity>' %stats.integrated_intensity)
-
-      s.wfile.write('<response>\n%s\n</response>' % ('\n'.join(response)))
-
+      response = format_response(filename, stats)
     except Exception, e:
       #import traceback
       #traceback.print_exc()
-      s.wfile.write('<response>error: %s</response>' % str(e))
+      response = '<response>error: %s</response>' % str(e)
+    s.send_response(200)
+    s.send_header('Content-type', 'text/xml')
+    s.send_header('Content-Length', str(len(response)))
+    s.end_headers()
+    s.wfile.write(response)
+    return
+
+  def do_POST(s):
+    '''
+    Respond to a batch request. The body is a json object with either a list
+    of "filenames" or a "template" and inclusive "image_range", and optionally
+    a list of "params". The response for each image is written and flushed as
+    soon as the image is processed and the connection is closed at the end.
+
+    '''
+    import json
+    if s.path.split(';')[0] != '/batch':
+      s.send_error(404, 'Unknown request: %s' % s.path)
+      return
+    try:
+      length = int(s.headers.getheader('Content-Length'))
+      request = json.loads(s.rfile.read(length))
+      if 'template' in request:
+        filenames = expand_template(
+          request['template'], request['image_range'])
+      else:
+        filenames = request['filenames']
+      params = [str(p) for p in request.get('params', [])]
+    except Exception, e:
+      s.send_error(400, 'Invalid batch request: %s' % str(e))
+      return
+    s.send_response(200)
+    s.send_header('Content-type', 'text/xml')
+    s.send_header('Connection', 'close')
+    s.end_headers()
+    s.close_connection = 1
+    for filename in filenames:
+      filename = str(filename)
+      try:
+        response = format_response(filename, work(filename, params))
+      except Exception, e:
+        response = '<response>\n<image>%s</image>\nerror: %s\n</response>' % (
+          filename, str(e))
+      s.wfile.write(response + '\n')
+      s.wfile.flush()
     return
 
 def serve(httpd):
@@ -234,10 +452,16 @@ nproc = Auto
   .type = int(value_min=1)
 port = 1701
   .type = int(value_min=1)
+timeout = 10
+  .type = float(value_min=0)
+  .help = "Time in seconds after which an idle connection is closed. Each"
+          "server process handles one connection at a time, so a client that"
+          "keeps a connection open blocks that process until then."
 ''')
 
 
-def main(nproc, port):
+def main(nproc, port, timeout=10):
+  handler.timeout = timeout
   server_class = server_base.HTTPServer
   httpd = server_class(('', port), handler)
   print time.asctime(), 'start'
@@ -245,6 +469,9 @@ def main(nproc, port):
   # catch TERM signal to allow finalizers to run and reap daemonic children
   signal.signal(signal.SIGTERM, lambda *args: sys.exit(-signal.SIGTERM))
 
+  # import everything before forking so the server processes start warm
+  warm_up()
+
   for j in range(nproc - 1):
     proc = Process(target=serve, args=(httpd,))
     proc.daemon = True
@@ -266,4 +493,4 @@ if __name__ == '__main__':
   if params.nproc is libtbx.Auto:
     from libtbx.introspection import number_of_processors
     params.nproc = number_of_processors(return_value_if_unknown=-1)
-  main(params.nproc, params.port)
+  main(params.nproc, params.port, params.timeout)
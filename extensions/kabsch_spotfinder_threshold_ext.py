@@ -81,6 +81,16 @@ class KabschSpotFinderThresholdExt(SpotFinderThresholdIface):
 
     '''
     self.params = params
+    self._algorithm = None
+
+  def __getstate__(self):
+    '''
+    Don't pickle the algorithm buffers; they are recreated when needed.
+
+    '''
+    state = self.__dict__.copy()
+    state['_algorithm'] = None
+    return state
 
   def compute_threshold(self, image, mask):
     '''
@@ -100,15 +110,18 @@ class KabschSpotFinderThresholdExt(SpotFinderThresholdIface):
       info("Setting global_threshold: %i" %(
         params.spotfinder.threshold.xds.global_threshold))
 
-    from dials.algorithms.peak_finding.threshold import XDSThresholdStrategy
-    self._algorithm = XDSThresholdStrategy(
-      kernel_size=params.spotfinder.threshold.xds.kernel_size,
-      gain=params.spotfinder.threshold.xds.gain,
-      mask=params.spotfinder.lookup.mask,
-      n_sigma_b=params.spotfinder.threshold.xds.sigma_background,
-      n_sigma_s=params.spotfinder.threshold.xds.sigma_strong,
-      min_count=params.spotfinder.threshold.xds.min_local,
-      global_threshold=params.spotfinder.threshold.xds.global_threshold)
+    # Create the algorithm once so that the buffers for each image size are
+    # reused for every image and panel
+    if self._algorithm is None:
+      from dials.algorithms.peak_finding.threshold import XDSThresholdStrategy
+      self._algorithm = XDSThresholdStrategy(
+        kernel_size=params.spotfinder.threshold.xds.kernel_size,
+        gain=params.spotfinder.threshold.xds.gain,
+        mask=params.spotfinder.lookup.mask,
+        n_sigma_b=params.spotfinder.threshold.xds.sigma_background,
+        n_sigma_s=params.spotfinder.threshold.xds.sigma_strong,
+        min_count=params.spotfinder.threshold.xds.min_local,
+        global_threshold=params.spotfinder.threshold.xds.global_threshold)
 
     return self._algorithm(image, mask)
 
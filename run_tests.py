@@ -45,6 +45,12 @@ tst_list = (
     "$D/test/model/data/tst_observation.py",
     "$D/test/model/data/tst_shoebox.py",
     "$D/test/model/data/tst_pixel_list.py",
+    "$D/test/algorithms/peak_finding/tst_incremental_extract_spots.py",
+    "$D/test/algorithms/peak_finding/tst_background_gradients.py",
+    "$D/test/algorithms/peak_finding/tst_combine_hot_masks.py",
+    "$D/test/algorithms/peak_finding/tst_mark_hot_pixels.py",
+    "$D/test/algorithms/peak_finding/tst_pixel_list_merger.py",
+    "$D/test/algorithms/peak_finding/tst_spot_density_filter.py",
     "$D/test/algorithms/statistics/tst_fast_mcd.py",
     "$D/test/algorithms/spot_prediction/tst_index_generator.py",
     "$D/test/algorithms/spot_prediction/tst_ray_predictor.py",
@@ -72,6 +78,7 @@ tst_list = (
     "$D/test/algorithms/integration/tst_summation.py",
     "$D/test/algorithms/integration/tst_profile_fitting_rs.py",
     "$D/test/algorithms/integration/tst_corrections.py",
+    "$D/test/algorithms/integration/tst_image_cache.py",
     "$B/test/algorithms/spatial_indexing/tst_quadtree",
     "$B/test/algorithms/spatial_indexing/tst_octree",
     "$B/test/algorithms/spatial_indexing/tst_collision_detection",
@@ -134,6 +141,10 @@ tst_list = (
     ["$D/test/command_line/tst_discover_better_experimental_model.py", "2"],
     "$D/test/algorithms/indexing/tst_compare_orientation_matrices.py",
     "$D/test/algorithms/indexing/tst_symmetry.py",
+    "$D/test/algorithms/indexing/tst_basis_vector_combinations.py",
+    "$D/test/algorithms/indexing/tst_real_space_grid_search.py",
+    "$D/test/algorithms/indexing/tst_fft3d.py",
+    "$D/test/algorithms/indexing/tst_nearest_neighbour_cache.py",
     "$D/scratch/rjg/unit_cell_refinement.py",
     )
 
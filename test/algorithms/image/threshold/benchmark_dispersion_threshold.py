@@ -0,0 +1,48 @@
+from __future__ import division
+
+class Benchmark(object):
+  '''
+  Time the dispersion threshold for detector sized images. The first image
+  includes computing the plan for the mask; later images reuse it.
+
+  '''
+
+  def __init__(self, nframes=5):
+    self.nframes = nframes
+
+  def run(self):
+    for name, size in [
+        ('Pilatus 6M', (2527, 2463)),
+        ('Eiger 16M', (4371, 4150))]:
+      for gain in [False, True]:
+        first, rest = self.time_frames(size, gain)
+        print '%-10s (gain=%-5s): first frame %10.0f us, other frames %10.0f us' % (
+          name, gain, first * 1e6, rest * 1e6)
+
+  def time_frames(self, size, gain):
+    from dials.algorithms.image.threshold import DispersionThreshold
+    from dials.array_family import flex
+    from time import time
+    image = flex.random_int_gaussian_distribution(size[0]*size[1], 10, 3)
+    image.reshape(flex.grid(size))
+    mask = flex.random_bool(size[0]*size[1], 0.99)
+    mask.reshape(flex.grid(size))
+    gain_map = flex.double(flex.grid(size), 1.0)
+    result = flex.bool(flex.grid(size))
+    algorithm = DispersionThreshold(size, (3, 3), 6, 3, 0, 2)
+    times = []
+    for i in range(self.nframes):
+      st = time()
+      if gain:
+        algorithm(image, mask, gain_map, result)
+      else:
+        algorithm(image, mask, result)
+      times.append(time() - st)
+    return times[0], sum(times[1:]) / (len(times) - 1)
+
+if __name__ == '__main__':
+  import sys
+  nframes = 5
+  if len(sys.argv) > 1:
+    nframes = int(sys.argv[1])
+  Benchmark(max(2, nframes)).run()
@@ -26,6 +26,7 @@ class Test:
     self.tst_kabsch_w_gain()
     self.tst_kabsch_debug()
     self.tst_dispersion_threshold()
+    self.tst_dispersion_threshold_plans()
 
   def tst_niblack(self):
     from dials.algorithms.image.threshold import niblack
@@ -122,6 +123,39 @@ class Test:
 
     print 'OK'
 
+  def tst_dispersion_threshold_plans(self):
+    from dials.algorithms.image.threshold import kabsch
+    from dials.algorithms.image.threshold import DispersionThreshold
+    from dials.array_family import flex
+    nsig_b = 3
+    nsig_s = 3
+    algorithm = DispersionThreshold(
+      self.image.all(),
+      self.size,
+      nsig_b,
+      nsig_s,
+      0,
+      self.min_count)
+
+    # Alternate between two masks as for two panels
+    mask2 = flex.random_bool(self.mask.size(), 0.9)
+    mask2.reshape(self.mask.accessor())
+    for i in range(2):
+      for mask in [self.mask, mask2]:
+        expected = kabsch(
+          self.image,
+          mask,
+          self.size,
+          nsig_b,
+          nsig_s,
+          self.min_count)
+        result = flex.bool(flex.grid(self.image.all()))
+        algorithm(self.image, mask, result)
+        assert(result.all_eq(expected))
+    assert(algorithm.num_plans() == 2)
+
+    print 'OK'
+
 if __name__ == '__main__':
   from dials.test import cd_auto
   with cd_auto(__file__):
@@ -0,0 +1,58 @@
+from __future__ import division
+import math
+
+def exercise_screen_basis_vector_combinations():
+  from dials.algorithms.indexing.indexer import \
+       screen_basis_vector_combinations
+  from dials.array_family import flex
+  from scitbx import matrix
+  import random
+  random.seed(0)
+
+  # random vectors plus some nearly parallel and coplanar ones
+  vectors = [matrix.col((random.uniform(-50, 50),
+                         random.uniform(-50, 50),
+                         random.uniform(-50, 50))) for i in range(20)]
+  vectors.append(vectors[0] * 2 + matrix.col((0.1, 0, 0)))
+  vectors.append(-vectors[1])
+  vectors.append(vectors[2] + vectors[3])
+  vectors.append(vectors[4] - 3 * vectors[5])
+
+  n = len(vectors)
+  combinations = flex.vec3_int()
+  for i in range(n):
+    for j in range(i+1, n):
+      for k in range(j+1, n):
+        combinations.append((i, j, k))
+
+  min_angle = 20/180 * math.pi
+  sel = screen_basis_vector_combinations(vectors, combinations, min_angle)
+  assert len(sel) == len(combinations)
+
+  # compare with the angle tests done one combination at a time
+  half_pi = 0.5 * math.pi
+  n_rejected = 0
+  for (i, j, k), keep in zip(combinations, sel):
+    a, b, c = vectors[i], vectors[j], vectors[k]
+    angle = a.angle(b)
+    expected = True
+    if angle < min_angle or (math.pi-angle) < min_angle:
+      expected = False
+    elif abs(half_pi-a.cross(b).angle(c)) < min_angle:
+      expected = False
+    assert keep == expected
+    if not expected:
+      n_rejected += 1
+  assert n_rejected > 0
+  assert sel.count(True) > 0
+
+  # no combinations
+  assert len(screen_basis_vector_combinations(
+    vectors, flex.vec3_int(), min_angle)) == 0
+
+def run():
+  exercise_screen_basis_vector_combinations()
+  print "OK"
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,32 @@
+from __future__ import division
+from libtbx.test_utils import approx_equal
+
+def exercise_fft3d_real_part_squared():
+  from dials.algorithms.indexing import fft3d_real_part_squared
+  from scitbx.array_family import flex
+  from scitbx import fftpack
+  import random
+  random.seed(0)
+
+  # compare with the full complex to complex transform, for even and odd
+  # grid dimensions
+  for gridding in [(8, 8, 8), (6, 10, 7), (9, 5, 12), (1, 4, 3)]:
+    grid = flex.double(flex.grid(gridding), 0)
+    for i in range(grid.size()):
+      if random.random() < 0.1:
+        grid[i] = random.random()
+    fft = fftpack.complex_to_complex_3d(gridding)
+    grid_complex = flex.complex_double(
+      reals=grid, imags=flex.double(grid.size(), 0))
+    expected = flex.pow2(flex.real(fft.forward(grid_complex)))
+    result = grid.deep_copy()
+    fft3d_real_part_squared(result)
+    assert result.all() == gridding
+    assert approx_equal(result, expected)
+
+def run():
+  exercise_fft3d_real_part_squared()
+  print "OK"
+
+if __name__ == '__main__':
+  run()
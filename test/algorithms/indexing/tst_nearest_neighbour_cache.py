@@ -0,0 +1,45 @@
+from __future__ import division
+
+def exercise_nearest_neighbour_cache():
+  from dials.algorithms.indexing import NearestNeighbourCache
+  from dials.algorithms.indexing import AssignIndicesLocal
+  from scitbx.array_family import flex
+  from scitbx import matrix
+  import random
+  random.seed(0)
+
+  # reciprocal lattice points of a random subset of a lattice
+  A = matrix.sqr((0.02, 0.001, 0, 0, 0.025, 0.002, 0, 0, 0.03))
+  rlps = flex.vec3_double()
+  for i in range(500):
+    hkl = matrix.col([random.randint(-10, 10) for j in range(3)])
+    rlps.append((A * hkl).elems)
+  phi = flex.double(len(rlps), 0)
+  UB_matrices = flex.mat3_double([A])
+
+  cache = NearestNeighbourCache()
+  nn = cache(rlps, 20)
+  assert len(nn) == 20 * len(rlps)
+
+  # the neighbours are reused while the points are unchanged
+  assert cache(rlps.deep_copy(), 20) is nn
+  assert cache(rlps, 10) is not nn
+  nn = cache(rlps, 20)
+  moved = rlps.deep_copy()
+  moved[0] = (0, 0, 0)
+  assert cache(moved, 20) is not nn
+  nn = cache(rlps, 20)
+
+  # the assignment is the same with precomputed neighbours
+  expected = AssignIndicesLocal(rlps, phi, UB_matrices, nearest_neighbours=20)
+  result = AssignIndicesLocal(
+    rlps, phi, UB_matrices, nearest_neighbour_indices=nn)
+  assert result.miller_indices().all_eq(expected.miller_indices())
+  assert result.crystal_ids().all_eq(expected.crystal_ids())
+
+def run():
+  exercise_nearest_neighbour_cache()
+  print "OK"
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,57 @@
+from __future__ import division
+import math
+from libtbx.test_utils import approx_equal
+
+def exercise_compute_functional_batch():
+  from dials.algorithms.indexing.real_space_grid_search import \
+       compute_functional_batch
+  from scitbx.array_family import flex
+  import random
+  random.seed(0)
+
+  rlps = flex.vec3_double([
+    (random.uniform(-0.3, 0.3), random.uniform(-0.3, 0.3),
+     random.uniform(-0.3, 0.3)) for i in range(500)])
+  vectors = flex.vec3_double([
+    (random.uniform(-50, 50), random.uniform(-50, 50),
+     random.uniform(-50, 50)) for i in range(200)])
+
+  expected = flex.double()
+  for v in vectors:
+    expected.append(flex.sum(flex.cos(2 * math.pi * rlps.dot(v))))
+
+  # a single block, many small blocks, and blocks split over processes
+  for max_block_size in (2**24, 500 * 7):
+    result = compute_functional_batch(
+      rlps, vectors, max_block_size=max_block_size)
+    assert approx_equal(result, expected)
+  result = compute_functional_batch(rlps, vectors, nproc=2)
+  assert approx_equal(result, expected)
+  assert len(compute_functional_batch(rlps, flex.vec3_double())) == 0
+
+def exercise_local_grid_directions():
+  from dials.algorithms.indexing.real_space_grid_search import \
+       local_grid_directions
+  from scitbx import matrix
+
+  centre = matrix.col((1, 2, 3)).normalize()
+  radius = 0.1
+  step = 0.02
+  directions = local_grid_directions(centre, radius, step)
+  assert len(directions) > 1
+  found_centre = False
+  for d in directions:
+    d = matrix.col(d)
+    assert approx_equal(d.length(), 1)
+    assert d.angle(centre) <= math.sqrt(2) * radius + 1e-6
+    if d.angle(centre) < 1e-6:
+      found_centre = True
+  assert found_centre
+
+def run():
+  exercise_compute_functional_batch()
+  exercise_local_grid_directions()
+  print "OK"
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,121 @@
+from __future__ import division
+
+class FakeImageSet(object):
+
+  def __init__(self, nimages, npixels):
+    self.nimages = nimages
+    self.npixels = npixels
+    self.nread = 0
+
+  def get_path(self, index):
+    return 'image_%03d.cbf' % index
+
+  def get_corrected_data(self, index):
+    from dials.array_family import flex
+    self.nread += 1
+    return (flex.double(self.npixels, index),)
+
+  def get_mask(self, index):
+    from dials.array_family import flex
+    return (flex.bool(self.npixels, True),)
+
+  def __len__(self):
+    return self.nimages
+
+
+class Test(object):
+
+  def __init__(self):
+    self.npixels = 100
+    self.size = self.npixels * 9
+
+  def run(self):
+    self.tst_disabled()
+    self.tst_cached()
+    self.tst_lru_eviction()
+    self.tst_resize()
+    self.tst_read_ahead()
+
+  def tst_disabled(self):
+    from dials.algorithms.integration.processor import ImageCache
+    imageset = FakeImageSet(10, self.npixels)
+    cache = ImageCache()
+    for i in range(2):
+      for j in range(len(imageset)):
+        image, mask, cached = cache.read(imageset, j, j)
+        assert(not cached)
+    assert(imageset.nread == 20)
+    assert(len(cache) == 0)
+    print 'OK'
+
+  def tst_cached(self):
+    from dials.algorithms.integration.processor import ImageCache
+    imageset = FakeImageSet(10, self.npixels)
+    cache = ImageCache(10 * self.size)
+    for i in range(2):
+      for j in range(len(imageset)):
+        image, mask, cached = cache.read(imageset, j, j)
+        assert(cached == (i > 0))
+        assert(image[0].all_eq(j))
+    assert(imageset.nread == 10)
+    assert(cache.memory == 10 * self.size)
+    print 'OK'
+
+  def tst_lru_eviction(self):
+    from dials.algorithms.integration.processor import ImageCache
+    imageset = FakeImageSet(10, self.npixels)
+    cache = ImageCache(5 * self.size)
+    for j in range(10):
+      cache.read(imageset, j, j)
+    assert(len(cache) == 5)
+    assert(cache.memory == 5 * self.size)
+
+    # The most recent images are kept
+    for j in range(5, 10):
+      image, mask, cached = cache.read(imageset, j, j)
+      assert(cached)
+    image, mask, cached = cache.read(imageset, 0, 0)
+    assert(not cached)
+
+    # Image 5 was the least recently used so has now been evicted
+    image, mask, cached = cache.read(imageset, 5, 5)
+    assert(not cached)
+    image, mask, cached = cache.read(imageset, 9, 9)
+    assert(cached)
+    print 'OK'
+
+  def tst_resize(self):
+    from dials.algorithms.integration.processor import ImageCache
+    imageset = FakeImageSet(10, self.npixels)
+    cache = ImageCache(10 * self.size)
+    for j in range(10):
+      cache.read(imageset, j, j)
+    assert(len(cache) == 10)
+    cache.resize(3 * self.size)
+    assert(len(cache) == 3)
+    assert(cache.memory == 3 * self.size)
+    cache.resize(self.size // 2)
+    assert(len(cache) == 0)
+    cache.read(imageset, 0, 0)
+    assert(len(cache) == 0)
+    cache.clear()
+    assert(cache.memory == 0)
+    print 'OK'
+
+  def tst_read_ahead(self):
+    from dials.algorithms.integration.processor import ImageReader
+    for read_ahead in [0, 1, 4]:
+      imageset = FakeImageSet(10, self.npixels)
+      reader = ImageReader(imageset, 0, read_ahead)
+      for j, (image, mask) in enumerate(reader):
+        assert(image[0].all_eq(j))
+        assert(mask[0].all_eq(True))
+      assert(j == 9)
+      assert(reader.num_read == 10)
+      assert(reader.num_cached == 0)
+      assert(reader.wait_time >= 0)
+    print 'OK'
+
+if __name__ == '__main__':
+  test = Test()
+  test.run()
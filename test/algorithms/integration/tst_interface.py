@@ -7,6 +7,7 @@ class TestJobList(object):
     self.tst_split_blocks_1_frame()
     self.tst_split_blocks_non_overlapping()
     self.tst_split_blocks_overlapping()
+    self.tst_add_jobs()
 
   def tst_split_blocks_1_frame(self):
     from dials.array_family import flex
@@ -234,6 +235,27 @@ class TestJobList(object):
     print 'OK'
 
 
+  def tst_add_jobs(self):
+    from dials.algorithms.integration.integrator import JobList
+    from scitbx.array_family import shared
+    jobs = JobList()
+    jobs.add((0, 1), (0, 100), 20)
+    jobs.add((1, 2), (0, 100), shared.tiny_int_2([
+      (0, 50),
+      (30, 60),
+      (50, 80),
+      (60, 100)]))
+    assert(len(jobs) == 13)
+    groups = [jobs[i].index() for i in range(len(jobs))]
+    assert(groups == [0] * 9 + [1] * 4)
+    frames = [jobs[i].frames() for i in range(9, 13)]
+    assert(frames == [(0, 50), (30, 60), (50, 80), (60, 100)])
+    for i in range(9, 13):
+      assert(jobs[i].expr() == (1, 2))
+
+    print 'OK'
+
+
 class TestReflectionManager(object):
 
   def __init__(self):
@@ -399,9 +421,120 @@ class TestReflectionManager(object):
     print 'OK'
 
 
+class TestBalancedJobs(object):
+
+  def __init__(self):
+    from dials.array_family import flex
+    from random import randint, seed
+    seed(0)
+
+    class Panel(object):
+      def get_image_size(self):
+        return (100, 100)
+
+    # Create reflections on frames 10 to 110, with many more on the first
+    # frames so that the cost per frame is not uniform
+    self.detector = [Panel(), Panel()]
+    self.array_range = (10, 110)
+    bbox = flex.int6()
+    for i in range(5000):
+      if i < 3000:
+        z0 = randint(10, 30)
+      else:
+        z0 = randint(10, 108)
+      z1 = z0 + randint(1, 5)
+      x0 = randint(0, 90)
+      y0 = randint(0, 90)
+      bbox.append((x0, x0 + randint(1, 10), y0, y0 + randint(1, 10), z0, z1))
+    self.reflections = flex.reflection_table()
+    self.reflections['id'] = flex.int(len(bbox), 0)
+    self.reflections['bbox'] = bbox
+
+  def run(self):
+    self.tst_balanced()
+    self.tst_memory()
+    self.tst_too_few_frames()
+
+  def compute_pixels(self):
+    frame0, frame1 = self.array_range
+    pixels = [0] * (frame1 - frame0)
+    for x0, x1, y0, y1, z0, z1 in self.reflections['bbox']:
+      for z in range(max(z0, frame0), min(z1, frame1)):
+        pixels[z - frame0] += (x1 - x0) * (y1 - y0)
+    return pixels
+
+  def compute_cost(self, read_cost=0.02):
+    npixels = sum(p.get_image_size()[0] * p.get_image_size()[1]
+                  for p in self.detector)
+    return [p + read_cost * npixels for p in self.compute_pixels()]
+
+  def compute_jobs(self, nproc, min_block_size, max_memory=None):
+    from dials.algorithms.integration.processor import Manager
+    from dials.algorithms.integration.processor import Parameters
+    params = Parameters()
+    params.mp.nproc = nproc
+    manager = Manager(None, self.reflections, params)
+    jobs = manager.compute_balanced_jobs(0, 1, self.array_range,
+                                         min_block_size, self.detector,
+                                         max_memory=max_memory)
+    return [tuple(j) for j in jobs]
+
+  def tst_balanced(self):
+    frame0, frame1 = self.array_range
+    cost = self.compute_cost()
+    for nproc in (1, 2, 4, 7):
+      min_block_size = 4
+      jobs = self.compute_jobs(nproc, min_block_size)
+      assert len(jobs) == 2 * nproc
+
+      # The jobs cover the full frame range
+      assert jobs[0][0] == frame0
+      assert jobs[-1][1] == frame1
+
+      # Each job covers two segments and adjacent jobs share one
+      for j0, j1 in zip(jobs[:-1], jobs[1:]):
+        assert j0[0] < j1[0] < j0[1] < j1[1]
+      for j0, j2 in zip(jobs[:-2], jobs[2:]):
+        assert j0[1] == j2[0]
+      boundaries = [j[0] for j in jobs] + [jobs[-2][1], jobs[-1][1]]
+      for b0, b1 in zip(boundaries[:-1], boundaries[1:]):
+        assert b1 - b0 >= min_block_size // 2
+
+      # The segments have roughly equal cost
+      target = sum(cost) / (2 * nproc + 1)
+      max_frame_cost = max(cost)
+      for b0, b1 in zip(boundaries[:-1], boundaries[1:]):
+        segment = sum(cost[b0 - frame0:b1 - frame0])
+        assert abs(segment - target) <= 2 * max_frame_cost
+    print 'OK'
+
+  def tst_memory(self):
+    frame0, frame1 = self.array_range
+    pixels = self.compute_pixels()
+
+    # With a small memory limit there are more jobs than needed for the
+    # number of processors and the shoeboxes of each job fit in the limit
+    max_memory = 12 * 2 * 30000
+    jobs = self.compute_jobs(2, 2, max_memory=max_memory)
+    assert len(jobs) > 4
+    assert jobs[0][0] == frame0
+    assert jobs[-1][1] == frame1
+    for j0, j1 in jobs:
+      assert 12 * sum(pixels[j0 - frame0:j1 - frame0]) <= max_memory
+    print 'OK'
+
+  def tst_too_few_frames(self):
+
+    # With too few frames for three segments there is a single job
+    jobs = self.compute_jobs(4, 80)
+    assert jobs == [self.array_range]
+    jobs = self.compute_jobs(1, 100)
+    assert jobs == [self.array_range]
+    print 'OK'
+
 class TestIntegrator3D(object):
 
-  def __init__(self, nproc):
+  def __init__(self, nproc, scheduler='static'):
     from dxtbx.model.experiment.experiment_list import ExperimentListFactory
     from dials.algorithms.profile_model.gaussian_rs import Model
     import libtbx.load_env
@@ -424,6 +557,7 @@ class TestIntegrator3D(object):
       sigma_b=0.024*pi/180.0,
       sigma_m=0.044*pi/180.0)
     self.nproc = nproc
+    self.scheduler = scheduler
 
     rlist = flex.reflection_table.from_predictions(exlist[0])
     rlist['id'] = flex.size_t(len(rlist), 0)
@@ -443,9 +577,10 @@ class TestIntegrator3D(object):
 
     params = phil_scope.fetch(parse('''
       integration.block.size=%d
+      integration.block.scheduler=%s
       integration.mp.nproc=%d
       integration.profile_fitting=False
-    ''' % (5, self.nproc))).extract()
+    ''' % (5, self.scheduler, self.nproc))).extract()
 
     output = StringIO.StringIO()
     stdout = sys.stdout
@@ -632,21 +767,144 @@ class TestSummation(object):
     return result
 
 
+class TestSpill(object):
+
+  def __init__(self):
+    from dxtbx.model.experiment.experiment_list import ExperimentListFactory
+    from dials.algorithms.profile_model.gaussian_rs import Model
+    import libtbx.load_env
+    from dials.array_family import flex
+    from os.path import join
+    from math import pi
+    try:
+      dials_regression = libtbx.env.dist_path('dials_regression')
+    except KeyError, e:
+      print 'FAIL: dials_regression not configured'
+      exit(0)
+
+    path = join(dials_regression, "centroid_test_data", "experiments.json")
+
+    exlist = ExperimentListFactory.from_json_file(path)
+    exlist[0].profile = Model(
+      None,
+      n_sigma=3,
+      sigma_b=0.024*pi/180.0,
+      sigma_m=0.044*pi/180.0)
+
+    rlist = flex.reflection_table.from_predictions(exlist[0])
+    rlist['id'] = flex.size_t(len(rlist), 0)
+    self.rlist = rlist
+    self.exlist = exlist
+
+  def run(self):
+    from dials.algorithms.integration.processor import Task
+    from libtbx.test_utils import approx_equal
+    from tempfile import mkdtemp
+    from os import listdir, rmdir
+    from os.path import exists
+
+    # Integrate with all the shoeboxes in memory
+    result1 = self.integrate('')
+
+    # Integrate with a tiny memory limit so that the shoeboxes are spilled,
+    # recording the spill files which are created
+    spill_directory = mkdtemp()
+    spill_files = []
+    create_spill_file = Task.create_spill_file
+    def record_spill_file(task):
+      filename = create_spill_file(task)
+      spill_files.append(filename)
+      return filename
+    Task.create_spill_file = record_spill_file
+    try:
+      result2 = self.integrate('''
+        integration.block.max_memory_usage=1e-12
+        integration.block.spill_directory=%s
+      ''' % spill_directory)
+    finally:
+      Task.create_spill_file = create_spill_file
+
+    # Check the shoeboxes were spilled and the files removed
+    assert len(spill_files) > 0
+    assert not any(exists(f) for f in spill_files)
+    assert len(listdir(spill_directory)) == 0
+    rmdir(spill_directory)
+
+    # Check the results are the same
+    assert len(result1) == len(result2)
+    assert result1['bbox'].all_eq(result2['bbox'])
+    assert result1['flags'].all_eq(result2['flags'])
+    assert result1['miller_index'].all_eq(result2['miller_index'])
+    assert approx_equal(result1['intensity.sum.value'],
+                        result2['intensity.sum.value'])
+    assert approx_equal(result1['intensity.sum.variance'],
+                        result2['intensity.sum.variance'])
+    assert approx_equal(result1['xyzobs.px.value'],
+                        result2['xyzobs.px.value'])
+    assert approx_equal(result1['background.mean'],
+                        result2['background.mean'])
+    print 'OK'
+
+  def integrate(self, extra_phil):
+    from dials.algorithms.integration.integrator import IntegratorFactory
+    from dials.algorithms.integration.integrator import phil_scope as master_phil_scope
+    from libtbx.phil import parse
+    import sys
+    import StringIO
+
+    rlist = self.rlist.copy()
+
+    output = StringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+
+    try:
+      phil_scope = parse('''
+        integration.intensity.algorithm=sum
+        integration.intensity.sum.integrator=3d
+        integration.block.size=0.5
+        integration.profile_fitting=False
+        %s
+      ''' % extra_phil)
+
+      params = master_phil_scope.fetch(source=phil_scope).extract()
+
+      integrator = IntegratorFactory.create(
+        params,
+        self.exlist,
+        rlist)
+
+      result = integrator.integrate()
+    except Exception:
+      print output
+      raise
+
+    sys.stdout = stdout
+
+    return result
+
+
 class Test(object):
 
   def __init__(self):
     self.test0 = TestJobList()
     self.test1 = TestReflectionManager()
+    self.test7 = TestBalancedJobs()
     self.test2 = TestIntegrator3D(nproc=1)
     self.test3 = TestIntegrator3D(nproc=2)
-    self.test4 = TestSummation()
+    self.test4 = TestIntegrator3D(nproc=2, scheduler='dynamic')
+    self.test5 = TestSummation()
+    self.test6 = TestSpill()
 
   def run(self):
     self.test0.run()
     self.test1.run()
+    self.test7.run()
     self.test2.run()
     self.test3.run()
     self.test4.run()
+    self.test5.run()
+    self.test6.run()
 
 if __name__ == '__main__':
   test = Test()
@@ -0,0 +1,60 @@
+from __future__ import division
+
+def benchmark(name, func, repeats=3):
+  ''' Time a function and return the best of several runs. '''
+  from time import time
+  best = None
+  for i in range(repeats):
+    st = time()
+    result = func()
+    elapsed = time() - st
+    if best is None or elapsed < best:
+      best = elapsed
+  print '%-40s %8.3f s' % (name, best)
+  return result, best
+
+def run(n_spots):
+  from dials.algorithms.peak_finding.spotfinder_factory \
+    import SpotDensityFilter
+  from tst_spot_density_filter import generate_centroids
+  from tst_spot_density_filter import reference_in_dense_bins
+  from tst_spot_density_filter import FakeObservations
+  from dials.array_family import flex
+  import numpy as np
+
+  xy = generate_centroids(
+    n_background=int(n_spots * 0.7),
+    n_cluster=int(n_spots * 0.3),
+    n_grid=0)
+  obs_x, obs_y = xy.parts()
+  print 'Spots: %d' % len(xy)
+
+  # The binned lookup against the per bin loop, for a range of cutoffs
+  H, xedges, yedges = np.histogram2d(
+    obs_x.as_numpy_array(), obs_y.as_numpy_array(), bins=50)
+  for cutoff in [0, int(H.mean()), int(H.max() // 2)]:
+    dense = H > cutoff
+    print 'Dense bins: %d' % dense.sum()
+    expected, t0 = benchmark('  per bin loop', lambda:
+      reference_in_dense_bins(obs_x, obs_y, dense, xedges, yedges))
+    result, t1 = benchmark('  binned lookup', lambda:
+      SpotDensityFilter.in_dense_bins(obs_x, obs_y, dense, xedges, yedges))
+    assert result.all_eq(expected)
+    print '  speedup: %.1fx' % (t0 / max(t1, 1e-9))
+
+  # The whole filter
+  observations = FakeObservations(xy)
+  benchmark('SpotDensityFilter', lambda:
+    SpotDensityFilter().run(flex.bool(len(xy), True),
+                            observations=observations))
+
+if __name__ == '__main__':
+  import sys
+  from random import seed
+  seed(0)
+  if len(sys.argv) > 1:
+    sizes = [int(a) for a in sys.argv[1:]]
+  else:
+    sizes = [10000, 100000, 1000000]
+  for n_spots in sizes:
+    run(n_spots)
@@ -0,0 +1,84 @@
+from __future__ import division
+
+class Test(object):
+
+  def __init__(self):
+    from dials.model.data import Shoebox
+    from dials.array_family import flex
+    from random import randint, uniform, seed
+    seed(0)
+
+    # Create some flattened shoeboxes with a sloping background
+    self.trusted_range = flex.vec2_double([(-1, 200), (0, 300)])
+    self.shoeboxes = flex.shoebox()
+    for i in range(1000):
+      x0 = randint(0, 1000)
+      y0 = randint(0, 1000)
+      x1 = randint(5, 15) + x0
+      y1 = randint(5, 15) + y0
+      sbox = Shoebox((x0, x1, y0, y1, 0, 1))
+      sbox.panel = randint(0, 1)
+      sbox.allocate()
+      a = uniform(50, 100)
+      b = uniform(-6, 6)
+      c = uniform(-6, 6)
+      data = flex.float(flex.grid(1, y1 - y0, x1 - x0))
+      for y in range(y1 - y0):
+        for x in range(x1 - x0):
+          data[0, y, x] = a + b * x + c * y + uniform(-1, 1)
+      data[0, 0, 0] = 1000
+      sbox.data = data
+      self.shoeboxes.append(sbox)
+
+  def run(self):
+    from time import time
+    from dials.array_family import flex
+    from dials.algorithms.peak_finding import background_gradients
+
+    buffer_size = 1
+    st = time()
+    expected = self.reference(buffer_size)
+    time_reference = time() - st
+
+    st = time()
+    gradients = background_gradients(
+      self.shoeboxes, self.trusted_range, buffer_size)
+    time_batched = time() - st
+
+    # The gradients should be identical to fitting each shoebox in turn
+    assert len(gradients) == len(expected)
+    for g1, g2 in zip(gradients, expected):
+      assert g1 == g2
+    print 'Reference: %.4f seconds' % time_reference
+    print 'Batched:   %.4f seconds' % time_batched
+    print 'OK'
+
+  def reference(self, buffer_size):
+    ''' Fit the background of each shoebox one at a time. '''
+    from dials.array_family import flex
+    from dials.algorithms.background.simple import Linear2dModeller
+    modeller = Linear2dModeller()
+    result = flex.vec2_double()
+    for shoebox in self.shoeboxes:
+      trusted_range = self.trusted_range[shoebox.panel]
+      ex1, ex2, ey1, ey2, ez1, ez2 = shoebox.bbox
+      data = shoebox.data
+      mask = flex.bool(data.accessor(), False)
+      for i_y, y in enumerate(range(ey1, ey2)):
+        for i_x, x in enumerate(range(ex1, ex2)):
+          value = data[0, i_y, i_x]
+          if (y >= (ey1+buffer_size) and y < (ey2-buffer_size) and
+              x >= (ex1+buffer_size) and x < (ex2-buffer_size)):
+            mask[0, i_y, i_x] = False # foreground
+          elif (value > trusted_range[0] and value < trusted_range[1]):
+            mask[0, i_y, i_x] = True # background
+      model = modeller.create(data.as_double(), mask)
+      d, a, b = model.params()[:3]
+      result.append((a, b))
+    return result
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
@@ -0,0 +1,84 @@
+from __future__ import division
+
+class FakeImageSet(object):
+
+  def __init__(self, detector, num_images):
+    self.detector = detector
+    self.num_images = num_images
+
+  def __len__(self):
+    return self.num_images
+
+  def get_detector(self):
+    return self.detector
+
+class Test(object):
+
+  def __init__(self):
+    from dials.algorithms.peak_finding.spot_finder import SpotFinder
+    self.spot_finder = SpotFinder(
+      find_spots=lambda x: x,
+      filter_spots=lambda x: x)
+
+  def run(self):
+    self.tst_single_images_ignored()
+    self.tst_order_independent()
+
+  def make_mask(self, hot):
+    from dials.array_family import flex
+    mask = flex.bool(flex.grid(10, 10), True)
+    for y, x in hot:
+      mask[y,x] = False
+    return (mask,)
+
+  def tst_single_images_ignored(self):
+
+    # A single image on its own detector gets no hot pixels, and a single
+    # image on a detector with a sweep gets the mask from the sweep
+    imagesets = [
+      FakeImageSet("A", 1),
+      FakeImageSet("B", 1),
+      FakeImageSet("B", 10)]
+    hot_masks = [
+      self.make_mask([(1, 1), (2, 2)]),
+      self.make_mask([(3, 3)]),
+      self.make_mask([(4, 4)])]
+    result = self.spot_finder._combine_hot_masks(imagesets, hot_masks)
+    assert len(result) == 3
+    assert result[0][0].all_eq(True)
+    assert result[1][0].all_eq(self.make_mask([(4, 4)])[0])
+    assert result[2][0].all_eq(self.make_mask([(4, 4)])[0])
+    print 'OK'
+
+  def tst_order_independent(self):
+
+    # The hot pixels from all sweeps on a detector are combined, whatever
+    # the order of the imagesets
+    imagesets = [
+      FakeImageSet("A", 10),
+      FakeImageSet("A", 1),
+      FakeImageSet("A", 5),
+      FakeImageSet("B", 5)]
+    hot_masks = [
+      self.make_mask([(1, 1)]),
+      self.make_mask([(2, 2)]),
+      self.make_mask([(3, 3)]),
+      self.make_mask([(4, 4)])]
+    expected_a = self.make_mask([(1, 1), (3, 3)])[0]
+    expected_b = self.make_mask([(4, 4)])[0]
+    for order in [(0, 1, 2, 3), (3, 2, 1, 0), (1, 3, 0, 2)]:
+      result = self.spot_finder._combine_hot_masks(
+        [imagesets[i] for i in order],
+        [hot_masks[i] for i in order])
+      for i, m in zip(order, result):
+        if imagesets[i].get_detector() == "A":
+          assert m[0].all_eq(expected_a)
+        else:
+          assert m[0].all_eq(expected_b)
+    print 'OK'
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
@@ -0,0 +1,190 @@
+from __future__ import division
+
+class Test(object):
+
+  def __init__(self):
+    pass
+
+  def run(self):
+    self.tst_same_as_batch()
+    self.tst_blocks_same_as_batch()
+    self.tst_no_points()
+    self.tst_resume_same_as_uninterrupted()
+
+  def tst_same_as_batch(self):
+    from dials.algorithms.peak_finding.spot_finder \
+      import IncrementalExtractSpots
+    from dials.model.data import PixelList
+    from dials.array_family import flex
+    size = (100, 100)
+    sf = 10
+    nframes = 20
+
+    # Create the pixel lists for the whole sweep and for each frame
+    pl_all = PixelList(size, sf)
+    pl_frames = []
+    for i in range(nframes):
+      image = flex.random_int_gaussian_distribution(size[0]*size[1], 100, 5)
+      mask = flex.random_bool(size[0]*size[1], 0.05)
+      image.reshape(flex.grid(size))
+      mask.reshape(flex.grid(size))
+      pl_all.add_image(image, mask)
+      pl = PixelList(size, sf + i)
+      pl.add_image(image, mask)
+      pl_frames.append(pl)
+
+    # Label the whole sweep at once
+    expected = flex.shoebox(pl_all, 0, 0, False)
+
+    # Label the frames one at a time
+    extract = IncrementalExtractSpots(None)
+    shoeboxes = flex.shoebox()
+    for i, pl in enumerate(pl_frames):
+      closed = extract.add_pixels([pl])
+      for sbox in closed:
+        assert sbox.bbox[5] < sf + i + 1
+      shoeboxes.extend(closed)
+    shoeboxes.extend(extract.finish())
+    assert extract.num_open_pixels() == 0
+
+    # Check the spots are the same
+    def key(sbox):
+      return tuple(sbox.bbox), flex.sum(sbox.data)
+    assert len(shoeboxes) == len(expected)
+    for sbox1, sbox2 in zip(
+        sorted(shoeboxes, key=key), sorted(expected, key=key)):
+      assert sbox1.bbox == sbox2.bbox
+      assert sbox1.data.all_eq(sbox2.data)
+      assert sbox1.mask.all_eq(sbox2.mask)
+    print 'OK'
+
+  def tst_blocks_same_as_batch(self):
+    from dials.algorithms.peak_finding.spot_finder \
+      import IncrementalExtractSpots, PixelListMerger
+    from dials.model.data import PixelList
+    from dials.array_family import flex
+    size = (100, 100)
+    sf = 10
+    nframes = 20
+
+    # Create the pixel lists for the whole sweep and for each frame
+    pl_all = PixelList(size, sf)
+    pl_frames = []
+    for i in range(nframes):
+      image = flex.random_int_gaussian_distribution(size[0]*size[1], 100, 5)
+      mask = flex.random_bool(size[0]*size[1], 0.1)
+      image.reshape(flex.grid(size))
+      mask.reshape(flex.grid(size))
+      pl_all.add_image(image, mask)
+      pl = PixelList(size, sf + i)
+      pl.add_image(image, mask)
+      pl_frames.append(pl)
+
+    # Label the whole sweep at once
+    expected = flex.shoebox(pl_all, 0, 0, False)
+
+    # Label the frames in blocks, keeping the pixels of spots on the first
+    # and last frames of each block to merge with the neighbouring blocks
+    shoeboxes = flex.shoebox()
+    merger = PixelListMerger()
+    for i0, i1 in [(0, 7), (7, 8), (8, 20)]:
+      extract = IncrementalExtractSpots(None, hold_first_frame=True)
+      for i in range(i0, i1):
+        shoeboxes.extend(extract.add_pixels([pl_frames[i]]))
+      merger.add((i0, i1), extract.finish_pixel_lists())
+    pl = merger.finish()[0]
+    assert pl.frame_range() == pl_all.frame_range()
+    shoeboxes.extend(flex.shoebox(pl, 0, 0, False))
+
+    # Check the spots are the same
+    def key(sbox):
+      return tuple(sbox.bbox), flex.sum(sbox.data)
+    assert len(shoeboxes) == len(expected)
+    for sbox1, sbox2 in zip(
+        sorted(shoeboxes, key=key), sorted(expected, key=key)):
+      assert sbox1.bbox == sbox2.bbox
+      assert sbox1.data.all_eq(sbox2.data)
+      assert sbox1.mask.all_eq(sbox2.mask)
+    print 'OK'
+
+  def tst_no_points(self):
+    from dials.algorithms.peak_finding.spot_finder \
+      import IncrementalExtractSpots
+    from dials.model.data import PixelList
+    from dials.array_family import flex
+    size = (100, 100)
+    image = flex.int(flex.grid(size), 0)
+    mask = flex.bool(flex.grid(size), False)
+    extract = IncrementalExtractSpots(None)
+    for i in range(3):
+      plists = [PixelList(size, i), PixelList(size, i)]
+      for pl in plists:
+        pl.add_image(image, mask)
+      closed = extract.add_pixels(plists)
+      assert len(closed) == 0
+    assert len(extract.finish()) == 0
+    print 'OK'
+
+  def tst_resume_same_as_uninterrupted(self):
+    from dials.algorithms.peak_finding.spot_finder \
+      import IncrementalExtractSpots
+    from dials.model.data import PixelList
+    from dials.array_family import flex
+    import cPickle as pickle
+    size = (100, 100)
+    sf = 10
+    nframes = 20
+
+    # Create the pixel lists for each frame
+    pl_frames = []
+    for i in range(nframes):
+      image = flex.random_int_gaussian_distribution(size[0]*size[1], 100, 5)
+      mask = flex.random_bool(size[0]*size[1], 0.1)
+      image.reshape(flex.grid(size))
+      mask.reshape(flex.grid(size))
+      pl = PixelList(size, sf + i)
+      pl.add_image(image, mask)
+      pl_frames.append(pl)
+
+    def key(sbox):
+      return tuple(sbox.bbox), flex.sum(sbox.data)
+
+    for hold_first_frame in (False, True):
+
+      # Label the frames without interruption
+      extract = IncrementalExtractSpots(None, hold_first_frame=hold_first_frame)
+      expected = flex.shoebox()
+      for pl in pl_frames:
+        expected.extend(extract.add_pixels([pl]))
+      expected_open = extract.num_open_pixels()
+      expected.extend(extract.finish())
+
+      # Label the frames, saving the state midway and resuming from it in a
+      # new extractor
+      extract = IncrementalExtractSpots(None, hold_first_frame=hold_first_frame)
+      shoeboxes = flex.shoebox()
+      for pl in pl_frames[:nframes//2]:
+        shoeboxes.extend(extract.add_pixels([pl]))
+      state = pickle.dumps(extract.get_state(), pickle.HIGHEST_PROTOCOL)
+      extract = IncrementalExtractSpots(None, hold_first_frame=hold_first_frame)
+      extract.set_state(pickle.loads(state))
+      assert extract.num_open_pixels() > 0
+      for pl in pl_frames[nframes//2:]:
+        shoeboxes.extend(extract.add_pixels([pl]))
+      assert extract.num_open_pixels() == expected_open
+      shoeboxes.extend(extract.finish())
+
+      # Check the spots are the same
+      assert len(shoeboxes) == len(expected)
+      for sbox1, sbox2 in zip(
+          sorted(shoeboxes, key=key), sorted(expected, key=key)):
+        assert sbox1.bbox == sbox2.bbox
+        assert sbox1.data.all_eq(sbox2.data)
+        assert sbox1.mask.all_eq(sbox2.mask)
+    print 'OK'
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
@@ -0,0 +1,54 @@
+from __future__ import division
+
+class Test(object):
+
+  def __init__(self):
+    pass
+
+  def run(self):
+    from dials.model.data import Shoebox
+    from dials.array_family import flex
+    from dials.algorithms.peak_finding import mark_hot_pixels
+    from random import randint, random
+
+    # Create some shoeboxes on two panels with random masks
+    shoeboxes = flex.shoebox()
+    for i in range(100):
+      x0 = randint(0, 90)
+      y0 = randint(0, 90)
+      x1 = x0 + randint(1, 10)
+      y1 = y0 + randint(1, 10)
+      sbox = Shoebox((x0, x1, y0, y1, 0, randint(1, 3)))
+      sbox.panel = randint(0, 1)
+      sbox.allocate()
+      mask = flex.int(sbox.mask.accessor())
+      for j in range(len(mask)):
+        if random() < 0.8:
+          mask[j] = 5
+      sbox.mask = mask
+      shoeboxes.append(sbox)
+
+    # Compute the expected mask one pixel at a time
+    expected = [flex.bool(flex.grid(100, 100), True) for p in range(2)]
+    for sbox in shoeboxes:
+      x0, x1, y0, y1 = sbox.bbox[0:4]
+      m = sbox.mask
+      p = sbox.panel
+      for y in range(m.all()[1]):
+        for x in range(m.all()[2]):
+          if m[:,y:y+1,x:x+1].all_ne(0):
+            expected[p][y0+y,x0+x] = False
+
+    # Check the masks are the same
+    for p in range(2):
+      mask = flex.bool(flex.grid(100, 100), True)
+      count = mark_hot_pixels(mask, shoeboxes, p)
+      assert count == expected[p].count(False)
+      assert mask.all_eq(expected[p])
+    print 'OK'
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
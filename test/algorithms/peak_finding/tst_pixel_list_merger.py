@@ -0,0 +1,52 @@
+from __future__ import division
+
+class Test(object):
+
+  def __init__(self):
+    pass
+
+  def run(self):
+    from dials.algorithms.peak_finding.spot_finder import PixelListMerger
+    from dials.model.data import PixelList
+    from dials.array_family import flex
+    from random import shuffle
+    size = (100, 100)
+
+    # Create the pixel lists for blocks of images on two panels
+    blocks = [(0, 3), (3, 4), (4, 8), (8, 9), (9, 15), (15, 20)]
+    pl_all = [PixelList(size, 0) for p in range(2)]
+    pl_blocks = []
+    for i0, i1 in blocks:
+      plists = [PixelList(size, i0) for p in range(2)]
+      for i in range(i0, i1):
+        for p in range(2):
+          image = flex.random_int_gaussian_distribution(
+            size[0]*size[1], 100, 5)
+          mask = flex.random_bool(size[0]*size[1], 0.1)
+          image.reshape(flex.grid(size))
+          mask.reshape(flex.grid(size))
+          plists[p].add_image(image, mask)
+          pl_all[p].add_image(image, mask)
+      pl_blocks.append(plists)
+
+    # Add the blocks in a random order
+    order = range(len(blocks))
+    shuffle(order)
+    merger = PixelListMerger()
+    for i in order:
+      merger.add(blocks[i], pl_blocks[i])
+    result = merger.finish()
+
+    # Check the merged lists are the same as the lists for all images
+    assert len(result) == 2
+    for pl1, pl2 in zip(result, pl_all):
+      assert pl1.frame_range() == pl2.frame_range()
+      assert pl1.values().all_eq(pl2.values())
+      assert list(pl1.coords()) == list(pl2.coords())
+    print 'OK'
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
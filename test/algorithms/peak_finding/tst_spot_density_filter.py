@@ -0,0 +1,95 @@
+from __future__ import division
+
+def generate_centroids(n_background=5000, n_cluster=2000, n_grid=100):
+  ''' Generate spots with a dense cluster and some spots on bin edges. '''
+  from dials.array_family import flex
+  from random import random, randint
+  xy = flex.vec2_double()
+  for i in range(n_background):
+    xy.append((random() * 1000, random() * 1000))
+  for i in range(n_cluster):
+    xy.append((400 + random() * 50, 600 + random() * 50))
+  for i in range(n_grid):
+    xy.append((randint(0, 50) * 20, randint(0, 50) * 20))
+  return xy
+
+def reference_in_dense_bins(obs_x, obs_y, dense, xedges, yedges):
+  ''' Select the spots in dense bins by looping over the dense bins. '''
+  from dials.array_family import flex
+  import numpy as np
+  selection = flex.bool(len(obs_x), False)
+  for (ix, iy) in np.column_stack(np.where(dense)):
+    selection.set_selected(
+      ((obs_x > xedges[ix]) & (obs_x < xedges[ix+1]) &
+       (obs_y > yedges[iy]) & (obs_y < yedges[iy+1])), True)
+  return selection
+
+class FakeCentroids(object):
+
+  def __init__(self, xy):
+    self.xy = xy
+
+  def px_position_xy(self):
+    return self.xy
+
+class FakeObservations(object):
+
+  def __init__(self, xy):
+    self.xy = xy
+
+  def centroids(self):
+    return FakeCentroids(self.xy)
+
+class Test(object):
+
+  def __init__(self):
+    from random import seed
+    seed(0)
+    self.xy = generate_centroids()
+
+  def run(self):
+    self.tst_same_as_reference()
+    self.tst_filter()
+
+  def tst_same_as_reference(self):
+    from dials.algorithms.peak_finding.spotfinder_factory \
+      import SpotDensityFilter
+    from dials.array_family import flex
+    import numpy as np
+    obs_x, obs_y = self.xy.parts()
+    H, xedges, yedges = np.histogram2d(
+      obs_x.as_numpy_array(), obs_y.as_numpy_array(), bins=50)
+    for cutoff in [-1, 0, 2, 5, 10, 50, 100, 1000]:
+      dense = H > cutoff
+      result = SpotDensityFilter.in_dense_bins(
+        obs_x, obs_y, dense, xedges, yedges)
+      expected = reference_in_dense_bins(obs_x, obs_y, dense, xedges, yedges)
+      assert result.all_eq(expected)
+
+    # Spots on the outer edges of the histogram are never inside a bin
+    dense = np.ones(H.shape, dtype=bool)
+    result = SpotDensityFilter.in_dense_bins(
+      obs_x, obs_y, dense, xedges, yedges)
+    assert not result[flex.max_index(obs_x)]
+    assert not result[flex.max_index(obs_y)]
+    print 'OK'
+
+  def tst_filter(self):
+    from dials.algorithms.peak_finding.spotfinder_factory \
+      import SpotDensityFilter
+    from dials.array_family import flex
+
+    # The cluster is rejected and spots already rejected stay rejected
+    flags = flex.bool(len(self.xy), True)
+    flags.set_selected(flex.size_t(range(100)), False)
+    result = SpotDensityFilter().run(
+      flags, observations=FakeObservations(self.xy))
+    assert result[0:100].count(True) == 0
+    assert result[5000:7000].count(False) > 1000
+    print 'OK'
+
+if __name__ == '__main__':
+  from dials.test import cd_auto
+  with cd_auto(__file__):
+    test = Test()
+    test.run()
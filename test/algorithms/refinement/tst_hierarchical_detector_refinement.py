@@ -189,6 +189,55 @@ def test1():
                       track_parameter_correlation = False,
                       max_iterations = 20)
 
+  # check that accumulating the normal equations directly from the gradients
+  # gives the same equations as building the Jacobian
+  refinery.build_up()
+  streaming = Refinery(target = target,
+                       prediction_parameterisation = pred_param,
+                       log = None,
+                       verbosity = 0,
+                       max_iterations = 20)
+  streaming.set_accumulate_normal_matrix(True)
+  streaming.build_up()
+  from scitbx.array_family import flex
+  a = refinery.normal_matrix_packed_u()
+  b = streaming.normal_matrix_packed_u()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  a = refinery.opposite_of_gradient()
+  b = streaming.opposite_of_gradient()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  assert approx_equal(refinery.objective(), streaming.objective())
+
+  # and when the gradients are only held for 10 reflections at a time
+  target._max_normal_equations_gradient_elements = 30 * len(pred_param)
+  streaming.build_up()
+  del target._max_normal_equations_gradient_elements
+  a = refinery.normal_matrix_packed_u()
+  b = streaming.normal_matrix_packed_u()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  a = refinery.opposite_of_gradient()
+  b = streaming.opposite_of_gradient()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  assert approx_equal(refinery.objective(), streaming.objective())
+
+  # likewise for the normal equations assembled by a pool of worker processes
+  parallel = Refinery(target = target,
+                      prediction_parameterisation = pred_param,
+                      log = None,
+                      verbosity = 0,
+                      max_iterations = 20)
+  parallel.set_nproc(2)
+  parallel.build_up()
+  parallel.close_pool()
+  a = refinery.normal_matrix_packed_u()
+  b = parallel.normal_matrix_packed_u()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  a = refinery.opposite_of_gradient()
+  b = parallel.opposite_of_gradient()
+  assert approx_equal(a, b, eps=1.e-10 * flex.max(flex.abs(a)))
+  assert approx_equal(refinery.objective(), parallel.objective())
+  assert refinery.dof == parallel.dof
+
   # Refiner
   from dials.algorithms.refinement.refiner import Refiner
   refiner = Refiner(reflections=refs,
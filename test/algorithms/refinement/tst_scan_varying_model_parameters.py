@@ -63,6 +63,26 @@ class SmootherTest(object):
     vals = [v for v, w, sw in data]
     assert len(smooth_at) == len(vals)
 
+    # The array API must agree with evaluation at each point in turn, for
+    # various numbers of intervals and averaging windows, including points
+    # outside the x_range
+    smooth_at = [0.5 * e for e in range(-20, 220)]
+    for nintervals in (1, 2, 3, 5, 8):
+      for naverage in (1, 2, 3, 4, 5):
+        smoother = GaussianSmoother((1, 100), nintervals)
+        smoother.set_smoothing(naverage, -1.0)
+        param = ScanVaryingParameterSet(1.0, smoother.num_values())
+        param.value = [random.uniform(-1, 1) for e in param.value]
+        vals, weights, sumweights = smoother.multi_value_weight(smooth_at,
+                                                                param)
+        assert weights.n_rows == len(smooth_at)
+        assert weights.n_cols == smoother.num_values()
+        for i, x in enumerate(smooth_at):
+          v, w, sw = smoother.value_weight(x, param)
+          assert approx_equal(vals[i], v)
+          assert approx_equal(sumweights[i], sw)
+          assert approx_equal([weights[i, j] for j in range(len(w))], w)
+
     if self.do_plots:
       try:
         import matplotlib.pyplot as plt
@@ -248,6 +268,23 @@ class TestScanVaryingCrystalOrientationParameterisation(TestScanVaryingCrystalPa
       except ImportError as e:
         print "pyplot not available", e
 
+    # composing at many time points at once must agree with composing at
+    # each in turn
+    smooth_at = [self.image_range[0] + e * step_size \
+                 for e in range(num_points + 1)]
+    states = []
+    derivatives = []
+    for t in xl_op.compose_multi(smooth_at):
+      states.append(ScanVaryingCrystalOrientationParameterisation.get_state(
+        xl_op))
+      derivatives.append(xl_op.get_ds_dp())
+    assert len(states) == len(smooth_at)
+    for t, U, dU_dp in zip(smooth_at, states, derivatives):
+      xl_op.set_time_point(t)
+      assert approx_equal(U, xl_op.get_state())
+      for e, f in zip(dU_dp, xl_op.get_ds_dp()):
+        assert approx_equal(e, f)
+
     print "OK"
 
   def test_random(self):
@@ -352,6 +389,21 @@ class TestScanVaryingCrystalUnitCellParameterisation(TestScanVaryingCrystalParam
     for e, f in zip(an_ds_dp, fd_ds_dp):
       assert(approx_equal((e - f), null_mat, eps = 1.e-6))
 
+    # composing at many time points at once must agree with composing at
+    # each in turn
+    smooth_at = [1, 10.5, 33, 50, 72.25, 99, 100]
+    states = []
+    derivatives = []
+    for t in xl_ucp.compose_multi(smooth_at):
+      states.append(ScanVaryingCrystalUnitCellParameterisation.get_state(
+        xl_ucp))
+      derivatives.append(xl_ucp.get_ds_dp())
+    for t, B, dB_dp in zip(smooth_at, states, derivatives):
+      xl_ucp.set_time_point(t)
+      assert approx_equal(B, xl_ucp.get_state())
+      for e, f in zip(dB_dp, xl_ucp.get_ds_dp()):
+        assert approx_equal(e, f)
+
     print "OK"
     return
 
@@ -226,6 +226,47 @@ for i in range(len(deltas)):
 pred_param.set_param_vals(p_vals)
 pred_param.compose(reflections)
 
+# check that the standard version, which composes the states once per
+# image, gives the states composed at the start of each reflection's image in
+# turn. Duplicate the reflections so that more images are shared
+sv_pred_param = VaryingCrystalPredictionParameterisation(experiments,
+  [det_param], [s0_param], [xlo_param], [xluc_param])
+sv_reflections = reflections.copy()
+sv_reflections.extend(reflections)
+sv_pred_param.compose(sv_reflections)
+frames = flex.floor(sv_reflections['xyzobs.px.value'].parts()[2]).iround()
+for i, frame in enumerate(frames):
+  xlo_param.compose(frame)
+  xluc_param.compose(frame)
+  assert approx_equal(sv_reflections['u_matrix'][i],
+                      xlo_param.get_state().elems)
+  assert approx_equal(sv_reflections['b_matrix'][i],
+                      xluc_param.get_state().elems)
+  for j, dU in enumerate(xlo_param.get_ds_dp()):
+    assert approx_equal(sv_reflections["dU_dp{0}".format(j)][i], dU.elems)
+  for j, dB in enumerate(xluc_param.get_ds_dp()):
+    assert approx_equal(sv_reflections["dB_dp{0}".format(j)][i], dB.elems)
+
+# check the batched calculation of scan point setting matrices and state
+# uncertainties against calculation at each image in turn. Use an arbitrary
+# positive definite variance-covariance matrix for the parameters
+nparam = len(sv_pred_param)
+var_cov = flex.random_double(nparam * nparam)
+var_cov.reshape(flex.grid(nparam, nparam))
+var_cov = var_cov.matrix_multiply(var_cov.matrix_transpose())
+sv_pred_param.calculate_model_state_uncertainties(var_cov)
+ar_range = experiments[0].scan.get_array_range()
+frames = range(ar_range[0], ar_range[1] + 1)
+A_list, u_cov_list, b_cov_list = sv_pred_param.get_scan_point_states(0,
+                                                                     frames)
+assert len(A_list) == len(u_cov_list) == len(b_cov_list) == len(frames)
+for t, A, u_cov, b_cov in zip(frames, A_list, u_cov_list, b_cov_list):
+  assert approx_equal(A, sv_pred_param.get_UB(t, 0))
+  u_cov_t, b_cov_t = sv_pred_param.calculate_model_state_uncertainties(
+    obs_image_number=t, experiment_id=0)
+  assert approx_equal(u_cov, u_cov_t)
+  assert approx_equal(b_cov, b_cov_t)
+
 finish_time = time()
 print "Time Taken: ",finish_time - start_time
 
@@ -38,6 +38,7 @@ def run():
 
   try:
     exercise_client(port=port)
+    exercise_batch_and_keep_alive(port=port)
 
   finally:
     client_stop_command = "dials.find_spots_client port=%i stop" %port
@@ -112,6 +113,53 @@ def exercise_client(port):
   assert d_min == sorted([1.47, 1.55, 1.59, 1.61, 1.61, 1.61, 1.61, 1.62, 1.64]), d_min
 
 
+def get_spot_counts(responses):
+  from xml.dom import minidom
+  xmldoc = minidom.parseString("<document>%s</document>" % "\n".join(responses))
+  return sorted([int(node.childNodes[0].data)
+                 for node in xmldoc.getElementsByTagName('spot_count')])
+
+def exercise_batch_and_keep_alive(port):
+  import glob
+  from dials.command_line import find_spots_client
+  data_dir = os.path.join(dials_regression, "centroid_test_data")
+  filenames = sorted(glob.glob(os.path.join(data_dir, "*.cbf")))
+  assert len(filenames) == 9
+  expected = sorted([203, 196, 205, 209, 195, 205, 203, 207, 189])
+
+  # batch mode from the command line, with a list of files and with a template
+  for args in (filenames,
+               ["template=%s" % os.path.join(data_dir, "centroid_####.cbf"),
+                "image_range=1,9"]):
+    client_command = " ".join(
+      ["dials.find_spots_client", "port=%i" %port, "min_spot_size=3",
+       "nproc=2", "batch=True"] + args)
+    result = easy_run.fully_buffered(command=client_command).raise_if_errors()
+    assert get_spot_counts(result.stdout_lines) == expected
+
+  # batch requests yield a response for each image in order
+  responses = list(find_spots_client.work_batch(
+    'localhost', port, ['min_spot_size=3'], filenames=filenames[:3]))
+  assert [f for f, r in responses] == filenames[:3]
+
+  # kept-alive connections must be closed once the images are done, otherwise
+  # the server processes would be held and a second call would hang. The
+  # server has 3 processes, so also use more client threads than that, which
+  # relies on the server closing idle connections after its timeout
+  for nproc in (2, 4):
+    responses = []
+    for i in range(2):
+      find_spots_client.work_all(
+        'localhost', port, filenames, ['min_spot_size=3'], nproc=nproc,
+        keep_alive=True)
+      assert len(find_spots_client._all_connections) == 0
+    for filename in filenames:
+      responses.append(find_spots_client.work(
+        'localhost', port, filename, ['min_spot_size=3'], keep_alive=True))
+    find_spots_client.close_connections()
+    assert get_spot_counts(responses) == expected
+
+
 if __name__ == '__main__':
   from dials.test import cd_auto
   with cd_auto(__file__):